@@ -0,0 +1,231 @@
+import asyncio
+import json
+import mimetypes
+import os
+import re
+import time
+from urllib.parse import parse_qs
+
+from auth_TDX import close_async_http_client, get_endpoint_stats
+from eta_stream import ETA_STREAM_HEARTBEAT, format_sse_event
+from http_cache import conditional_json_response, upcoming_stops_delta
+from metrics import begin_request, end_request, observe_request, render_prometheus, request_spans, server_timing_header
+from tdx_cache import get_cache_stats
+from main import (
+    app as flask_app, CORS_ORIGINS, STATIC_DIR, eta_stream_hub,
+    parse_routes_args, parse_buses_for_route_args, parse_bus_info_args, parse_route_bus_info_args, parse_nearby_stops_args,
+    fetch_available_routes_logic_async, fetch_buses_for_route_logic_async, get_bus_stop_info_logic_async,
+    get_route_buses_info_logic_async, fetch_nearby_stops_logic_async
+)
+
+BUS_INFO_PATH = re.compile(r'^/api/bus_info/([^/]+)$')
+BUS_INFO_STREAM_PATH = re.compile(r'^/api/bus_info_stream/([^/]+)$')
+
+
+def _json_body(payload):
+    # Byte-for-byte the same as Flask's jsonify outside debug mode.
+    return (json.dumps(payload, ensure_ascii=True, sort_keys=True, separators=(",", ":")) + "\n").encode('utf-8')
+
+
+def _cors_headers(request_headers):
+    origin = request_headers.get('origin')
+    if origin and origin in CORS_ORIGINS:
+        return [(b'access-control-allow-origin', origin.encode('latin-1')), (b'vary', b'Origin')]
+    return []
+
+
+async def _send_response(send, status, body, content_type, extra_headers, include_body=True):
+    headers = [(b'content-type', content_type.encode('latin-1')), (b'content-length', str(len(body)).encode('latin-1'))]
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers + extra_headers})
+    await send({'type': 'http.response.body', 'body': body if include_body else b''})
+
+
+def _static_file(relative_path):
+    full_path = os.path.realpath(os.path.join(STATIC_DIR, relative_path))
+    if not full_path.startswith(os.path.realpath(STATIC_DIR) + os.sep) or not os.path.isfile(full_path):
+        return None, None
+    with open(full_path, 'rb') as f:
+        body = f.read()
+    content_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+    if content_type.startswith('text/') or content_type in ('application/javascript', 'text/javascript'):
+        content_type += '; charset=utf-8'
+    return body, content_type
+
+
+async def _dispatch(method, path, args):
+    if path == '/api/routes':
+        error_payload, route_keyword = parse_routes_args(args)
+        if error_payload:
+            return 400, error_payload
+        return 200, await fetch_available_routes_logic_async(route_keyword)
+
+    if path == '/api/buses_for_route':
+        try:
+            error_payload, selected_route_params = parse_buses_for_route_args(args)
+            if error_payload:
+                return 400, error_payload
+            return 200, await fetch_buses_for_route_logic_async(selected_route_params)
+        except Exception as e:
+            flask_app.logger.error(f"/api/buses_for_route 發生錯誤: {e}", exc_info=True)
+            return 500, {"error": "伺服器內部錯誤"}
+
+    if path == '/api/bus_info_for_route':
+        error_payload, route_name, direction = parse_route_bus_info_args(args)
+        if error_payload:
+            return 400, error_payload
+        return 200, await get_route_buses_info_logic_async(route_name, direction)
+
+    if path == '/api/nearby_stops':
+        error_payload, lat, lon, radius = parse_nearby_stops_args(args)
+        if error_payload:
+            return 400, error_payload
+        return 200, await fetch_nearby_stops_logic_async(lat, lon, radius)
+
+    bus_info_match = BUS_INFO_PATH.match(path)
+    if bus_info_match:
+        plate_numb = bus_info_match.group(1)
+        error_payload, route_name, direction = parse_bus_info_args(plate_numb, args)
+        if error_payload:
+            return 400, error_payload
+        bus_info = await get_bus_stop_info_logic_async(plate_numb, route_name_param=route_name, direction_param=direction)
+        since = args.get('since')
+        return 200, upcoming_stops_delta(bus_info, since) if since is not None else bus_info
+
+    return None, None
+
+
+async def _wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+async def _stream_bus_info(receive, send, plate_numb, args, cors_headers):
+    error_payload, route_name, direction = parse_bus_info_args(plate_numb, args)
+    if error_payload:
+        await _send_response(send, 400, _json_body(error_payload), 'application/json', cors_headers)
+        return
+
+    loop = asyncio.get_running_loop()
+    changed = asyncio.Event()
+
+    def on_publish():
+        loop.call_soon_threadsafe(changed.set)
+
+    topic = eta_stream_hub.acquire((plate_numb, route_name, direction), on_publish)
+    disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+    try:
+        headers = [(b'content-type', b'text/event-stream; charset=utf-8'), (b'cache-control', b'no-cache'), (b'x-accel-buffering', b'no')]
+        await send({'type': 'http.response.start', 'status': 200, 'headers': headers + cors_headers})
+        seen_version = 0
+        while True:
+            changed.clear()
+            with topic.condition:
+                version, payload = topic.version, topic.payload
+            if version != seen_version:
+                seen_version = version
+                await send({'type': 'http.response.body', 'body': format_sse_event(version, payload).encode('utf-8'), 'more_body': True})
+                continue
+
+            change_waiter = asyncio.ensure_future(changed.wait())
+            done, _ = await asyncio.wait({change_waiter, disconnected}, timeout=ETA_STREAM_HEARTBEAT, return_when=asyncio.FIRST_COMPLETED)
+            change_waiter.cancel()
+            if disconnected in done:
+                return
+            if not done:
+                await send({'type': 'http.response.body', 'body': format_sse_event(None, None).encode('utf-8'), 'more_body': True})
+    finally:
+        disconnected.cancel()
+        eta_stream_hub.release(topic, on_publish)
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await close_async_http_client()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    method = scope['method']
+    path = scope['path']
+    request_headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+    cors_headers = _cors_headers(request_headers)
+
+    if method == 'OPTIONS':
+        preflight_headers = list(cors_headers)
+        if cors_headers:
+            preflight_headers.append((b'access-control-allow-methods', b'GET, HEAD, OPTIONS'))
+            requested_headers = request_headers.get('access-control-request-headers')
+            if requested_headers:
+                preflight_headers.append((b'access-control-allow-headers', requested_headers.encode('latin-1')))
+        await _send_response(send, 200, b'', 'text/html; charset=utf-8', preflight_headers)
+        return
+
+    if method not in ('GET', 'HEAD'):
+        await _send_response(send, 405, b'Method Not Allowed', 'text/plain; charset=utf-8', cors_headers)
+        return
+    include_body = method == 'GET'
+
+    if path == '/' or path.startswith('/static/'):
+        body, content_type = _static_file('index.html' if path == '/' else path[len('/static/'):])
+        if body is None:
+            await _send_response(send, 404, b'Not Found', 'text/plain; charset=utf-8', cors_headers, include_body)
+        else:
+            await _send_response(send, 200, body, content_type, cors_headers, include_body)
+        return
+
+    if path == '/metrics':
+        body = render_prometheus(get_endpoint_stats(), get_cache_stats()).encode('utf-8')
+        await _send_response(send, 200, body, 'text/plain; version=0.0.4; charset=utf-8', cors_headers, include_body)
+        return
+
+    query_args = {
+        name: values[0]
+        for name, values in parse_qs(scope['query_string'].decode('latin-1'), keep_blank_values=True).items()
+    }
+
+    stream_match = BUS_INFO_STREAM_PATH.match(path)
+    if stream_match and include_body:
+        await _stream_bus_info(receive, send, stream_match.group(1), query_args, cors_headers)
+        return
+    started = time.perf_counter()
+    spans_token = begin_request()
+    try:
+        status, payload = await _dispatch(method, path, query_args)
+    except Exception as e:
+        flask_app.logger.error(f"{path} 發生錯誤: {e}", exc_info=True)
+        status, payload = 500, None
+    finally:
+        spans = request_spans()
+        end_request(spans_token)
+    elapsed = time.perf_counter() - started
+    response_headers = cors_headers
+    if path.startswith('/api/'):
+        route_label = '/api/bus_info/<plate_numb>' if BUS_INFO_PATH.match(path) else path
+        observe_request(route_label if status is not None else 'unmatched', status or 404, elapsed)
+        response_headers = cors_headers + [(b'server-timing', server_timing_header(spans, elapsed).encode('latin-1'))]
+
+    if status is None:
+        await _send_response(send, 404, b'Not Found', 'text/plain; charset=utf-8', response_headers, include_body)
+    elif payload is None:
+        await _send_response(send, 500, b'Internal Server Error', 'text/plain; charset=utf-8', response_headers, include_body)
+    elif status == 200:
+        status, body, cache_headers = conditional_json_response(
+            _json_body(payload), request_headers.get('if-none-match'), request_headers.get('accept-encoding')
+        )
+        response_headers = response_headers + [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in cache_headers]
+        await _send_response(send, status, body, 'application/json', response_headers, include_body)
+    else:
+        await _send_response(send, status, _json_body(payload), 'application/json', response_headers, include_body)
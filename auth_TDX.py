@@ -1,17 +1,51 @@
+import asyncio
 import requests
+from requests.adapters import HTTPAdapter
 import json
-from datetime import datetime, timedelta
+from contextlib import contextmanager
 import os
+import threading
+import time
+from urllib.parse import urlencode, urlparse
+
+from metrics import timed
+from request_budget import DEADLINE_EXCEEDED, DeadlineExceeded, cap_timeout, remaining_budget
+from tdx_rate_limit import TDXRateLimited, wait_for_slot, wait_for_slot_async
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
 
 app_id = os.environ.get('TDX_APP_ID', 'YOUR_TDX_APP_ID')
 app_key = os.environ.get('TDX_APP_KEY', 'YOUR_TDX_APP_KEY')
 
-auth_url="https://tdx.transportdata.tw/auth/realms/TDXConnect/protocol/openid-connect/token"
+auth_url=os.environ.get("TDX_AUTH_URL", "https://tdx.transportdata.tw/auth/realms/TDXConnect/protocol/openid-connect/token")
+
+TDX_CONNECT_TIMEOUT = float(os.environ.get('TDX_CONNECT_TIMEOUT', 3.05))
+TDX_READ_TIMEOUT = float(os.environ.get('TDX_READ_TIMEOUT', 15))
+TDX_MAX_RETRIES = int(os.environ.get('TDX_MAX_RETRIES', 2))
+TDX_BACKOFF_BASE = float(os.environ.get('TDX_BACKOFF_BASE', 0.5))
+TDX_BACKOFF_MAX = float(os.environ.get('TDX_BACKOFF_MAX', 4))
+TDX_POOL_MAXSIZE = int(os.environ.get('TDX_POOL_MAXSIZE', 16))
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+TDX_TOKEN_FILE = os.environ.get('TDX_TOKEN_FILE')
+TDX_TOKEN_EXPIRY_MARGIN = 900
+TDX_TOKEN_REFRESH_AHEAD = float(os.environ.get('TDX_TOKEN_REFRESH_AHEAD', 600))
+TDX_TOKEN_RETRY_INTERVAL = float(os.environ.get('TDX_TOKEN_RETRY_INTERVAL', 30))
 
-_access_token_cache = {
-    "token": None,
-    "expires_at": datetime.now()
-}
+
+_endpoint_stats = {}
+_endpoint_stats_lock = threading.Lock()
+
+_in_flight_calls = {}
+_in_flight_lock = threading.Lock()
 
 class Auth():
     def __init__(self, app_id, app_key):
@@ -28,43 +62,412 @@ class Auth():
             'client_secret' : self.app_key
         }
 
-def get_tdx_access_token():
-    global _access_token_cache
-    now = datetime.now()
-    if not _access_token_cache["token"] or _access_token_cache["expires_at"] <= (now + timedelta(minutes=10)):
-        auth_instance = Auth(app_id, app_key)
-        try:
-            auth_response = requests.post(auth_url, auth_instance.get_auth_header())
-            auth_response.raise_for_status()
-            auth_data = auth_response.json()
-            token = auth_data.get('access_token')
-            expires_in = auth_data.get('expires_in', 86400) 
-            _access_token_cache["token"] = token
-            _access_token_cache["expires_at"] = now + timedelta(seconds=expires_in - 900) 
+def _create_http_session():
+    session = requests.Session()
+    # Up to TDX_POOL_MAXSIZE connections per host are kept alive. Concurrency is capped by _connection_slots
+    # rather than pool_block, whose wait for a free connection has no timeout.
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=TDX_POOL_MAXSIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+_http_session = _create_http_session()
+_connection_slots = threading.BoundedSemaphore(TDX_POOL_MAXSIZE)
+
+def _endpoint_stats_entry(endpoint):
+    return _endpoint_stats.setdefault(endpoint, {
+        "calls": 0, "errors": 0, "retries": 0, "coalesced": 0, "throttled": 0,
+        "total_latency_seconds": 0.0, "max_latency_seconds": 0.0, "error_codes": {}
+    })
+
+def _record_endpoint_call(endpoint, elapsed_seconds, error_code):
+    with _endpoint_stats_lock:
+        stats = _endpoint_stats_entry(endpoint)
+        stats["calls"] += 1
+        stats["total_latency_seconds"] += elapsed_seconds
+        stats["max_latency_seconds"] = max(stats["max_latency_seconds"], elapsed_seconds)
+        if error_code is not None:
+            stats["errors"] += 1
+            stats["error_codes"][str(error_code)] = stats["error_codes"].get(str(error_code), 0) + 1
+
+def _record_endpoint_retry(endpoint):
+    with _endpoint_stats_lock:
+        _endpoint_stats_entry(endpoint)["retries"] += 1
+
+def _record_endpoint_throttled(endpoint):
+    with _endpoint_stats_lock:
+        _endpoint_stats_entry(endpoint)["throttled"] += 1
+
+def _record_endpoint_coalesced(endpoint):
+    with _endpoint_stats_lock:
+        _endpoint_stats_entry(endpoint)["coalesced"] += 1
+
+def get_endpoint_stats():
+    with _endpoint_stats_lock:
+        snapshot = {}
+        for endpoint, stats in _endpoint_stats.items():
+            snapshot[endpoint] = dict(stats, error_codes=dict(stats["error_codes"]))
+            snapshot[endpoint]["avg_latency_seconds"] = stats["total_latency_seconds"] / stats["calls"] if stats["calls"] else 0.0
+        return snapshot
+
+def _retry_delay(response, attempt):
+    retry_after = response.headers.get('Retry-After')
+    if retry_after and retry_after.strip().isdigit():
+        delay = float(retry_after.strip())
+        # A Retry-After longer than our backoff cap is not worth holding a worker for.
+        return delay if delay <= TDX_BACKOFF_MAX else None
+    return min(TDX_BACKOFF_MAX, TDX_BACKOFF_BASE * (2 ** attempt))
+
+def _request_new_token():
+    auth_instance = Auth(app_id, app_key)
+    started = time.monotonic()
+    try:
+        auth_response = _http_session.post(auth_url, auth_instance.get_auth_header(), timeout=(TDX_CONNECT_TIMEOUT, TDX_READ_TIMEOUT))
+        auth_response.raise_for_status()
+        auth_data = auth_response.json()
+        token = auth_data.get('access_token')
+        expires_in = auth_data.get('expires_in', 86400)
+        _record_endpoint_call('auth', time.monotonic() - started, None)
+        if not token:
+            return None
+        return (token, time.time() + expires_in - TDX_TOKEN_EXPIRY_MARGIN)
+    except json.JSONDecodeError:
+        _record_endpoint_call('auth', time.monotonic() - started, "JSON_DECODE_ERROR")
+        return None
+    except requests.exceptions.RequestException:
+        _record_endpoint_call('auth', time.monotonic() - started, "REQUEST_EXCEPTION")
+        return None
+
+class TokenManager():
+    def __init__(self, token_file=None, refresh_ahead=TDX_TOKEN_REFRESH_AHEAD, retry_interval=TDX_TOKEN_RETRY_INTERVAL):
+        self.token_file = token_file
+        self.refresh_ahead = refresh_ahead
+        self.retry_interval = retry_interval
+        # (token, expires_at); replaced as a whole so readers never see a half-updated pair.
+        self._state = (None, 0.0)
+        self._refresh_lock = threading.Lock()
+        self._refresher = None
+        self._refresher_pid = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        with self._start_lock:
+            if self._refresher is not None and self._refresher.is_alive() and self._refresher_pid == os.getpid():
+                return
+            self._refresher_pid = os.getpid()
+            self._refresher = threading.Thread(target=self._run_refresher, name='tdx-token-refresher', daemon=True)
+            self._refresher.start()
+
+    def get_token(self):
+        self.start()
+        token, expires_at = self._state
+        if token and time.time() < expires_at:
             return token
-        except requests.exceptions.RequestException:
+        return self.refresh()
+
+    def refresh(self, force=False):
+        with self._refresh_lock:
+            token, expires_at = self._state
+            if not force and token and time.time() < expires_at - self.refresh_ahead:
+                return token
+
+            shared_state = self._read_shared_state()
+            if shared_state and time.time() < shared_state[1] - self.refresh_ahead:
+                self._state = shared_state
+                return shared_state[0]
+
+            with self._shared_refresh_lock():
+                # Another worker may have refreshed while we were waiting for the file lock.
+                shared_state = self._read_shared_state()
+                if shared_state and time.time() < shared_state[1] - self.refresh_ahead:
+                    self._state = shared_state
+                    return shared_state[0]
+
+                with timed('token_refresh'):
+                    new_state = _request_new_token()
+                if new_state is None:
+                    # Keep serving the previous token for as long as it is still valid.
+                    return token if token and time.time() < expires_at else None
+                self._state = new_state
+                self._write_shared_state(new_state)
+                return new_state[0]
+
+    def _run_refresher(self):
+        while True:
+            token, expires_at = self._state
+            wait_seconds = expires_at - self.refresh_ahead - time.time()
+            if token and wait_seconds > 0:
+                time.sleep(min(wait_seconds, 3600))
+                continue
+            self.refresh()
+            token, expires_at = self._state
+            if not token or time.time() >= expires_at - self.refresh_ahead:
+                time.sleep(self.retry_interval)
+
+    def _read_shared_state(self):
+        if not self.token_file:
             return None
-        except json.JSONDecodeError:
+        try:
+            with open(self.token_file, encoding='utf-8') as f:
+                shared = json.load(f)
+            return (shared['token'], float(shared['expires_at']))
+        except (OSError, ValueError, KeyError, TypeError):
             return None
-    return _access_token_cache["token"]
 
-def fetch_tdx_data_with_token(api_url, access_token, params=None):
+    def _write_shared_state(self, state):
+        if not self.token_file:
+            return
+        temp_path = f"{self.token_file}.{os.getpid()}.tmp"
+        try:
+            # Created owner-only, so the bearer token is never readable by others, even before the rename;
+            # the fchmod covers a temp file left behind by a crashed worker, which O_CREAT would not re-mode.
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                os.fchmod(f.fileno(), 0o600)
+                json.dump({"token": state[0], "expires_at": state[1]}, f)
+            os.replace(temp_path, self.token_file)
+        except OSError:
+            pass
+
+    @contextmanager
+    def _shared_refresh_lock(self):
+        if not self.token_file or fcntl is None:
+            yield
+            return
+        try:
+            lock_file = open(f"{self.token_file}.lock", 'a')
+        except OSError:
+            yield
+            return
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+_token_manager = TokenManager(token_file=TDX_TOKEN_FILE)
+
+def get_token_manager():
+    return _token_manager
+
+def get_tdx_access_token():
+    return _token_manager.get_token()
+
+def tdx_request_key(api_url, params=None):
+    if not params:
+        return api_url
+    return api_url + '?' + urlencode(sorted(params.items()))
+
+def tdx_dataset_name(api_url):
+    path_parts = urlparse(api_url).path.split('/')
+    if 'Bus' in path_parts:
+        bus_index = path_parts.index('Bus')
+        if bus_index + 1 < len(path_parts):
+            return path_parts[bus_index + 1]
+    return 'UNKNOWN'
+
+def _check_budget():
+    # Nothing is sent once the request's deadline (see request_budget) has passed.
+    if remaining_budget() == 0:
+        raise DeadlineExceeded()
+
+def _budget_allows(seconds):
+    budget = remaining_budget()
+    return budget is None or seconds < budget
+
+def _budget_error(error_code):
+    return DEADLINE_EXCEEDED if remaining_budget() == 0 else error_code
+
+def _get_with_retries(api_url, headers, params, endpoint):
+    attempt = 0
+    while True:
+        wait_for_slot(endpoint)
+        _check_budget()
+        # Waiting for a connection counts against the connect timeout (and the request's budget).
+        if not _connection_slots.acquire(timeout=cap_timeout(TDX_CONNECT_TIMEOUT)):
+            raise requests.exceptions.ConnectTimeout("no TDX connection became free in time")
+        try:
+            response = _http_session.get(api_url, headers=headers, params=params, timeout=(cap_timeout(TDX_CONNECT_TIMEOUT), cap_timeout(TDX_READ_TIMEOUT)))
+        finally:
+            _connection_slots.release()
+        if response.status_code not in RETRY_STATUS_CODES or attempt >= TDX_MAX_RETRIES:
+            return response
+        delay = _retry_delay(response, attempt)
+        if delay is None or not _budget_allows(delay):
+            return response
+        response.close()
+        _record_endpoint_retry(endpoint)
+        time.sleep(delay)
+        attempt += 1
+
+class _InFlightCall():
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = (None, "REQUEST_EXCEPTION")
+
+def fetch_tdx_data_with_token(api_url, access_token, params=None, as_text=False):
+    # as_text returns the undecoded response body so the caller can decode it its own way (see tdx_cache).
     if not access_token:
         return (None, "NO_TOKEN")
-    
+    with timed('tdx', tdx_dataset_name(api_url)):
+        return _fetch_tdx_data_coalesced(api_url, access_token, params, as_text)
+
+def _in_flight_key(api_url, params, as_text):
+    request_key = tdx_request_key(api_url, params)
+    return request_key + '#text' if as_text else request_key
+
+def _leader_ran_out_of_budget(result):
+    # The shared result is the leader's deadline, not this caller's: one with time left fetches again instead.
+    return result[1] == DEADLINE_EXCEEDED and remaining_budget() != 0
+
+def _fetch_tdx_data_coalesced(api_url, access_token, params, as_text):
+    # Single-flight: concurrent callers asking for the same URL and params share one upstream request.
+    request_key = _in_flight_key(api_url, params, as_text)
+    while True:
+        with _in_flight_lock:
+            in_flight_call = _in_flight_calls.get(request_key)
+            is_leader = in_flight_call is None
+            if is_leader:
+                in_flight_call = _InFlightCall()
+                _in_flight_calls[request_key] = in_flight_call
+        if is_leader:
+            break
+
+        _record_endpoint_coalesced(tdx_dataset_name(api_url))
+        # A follower waits no longer than its own budget, which may be shorter than the leader's.
+        if not in_flight_call.done.wait(remaining_budget()):
+            return (None, DEADLINE_EXCEEDED)
+        if not _leader_ran_out_of_budget(in_flight_call.result):
+            return in_flight_call.result
+
+    try:
+        in_flight_call.result = _fetch_tdx_data_uncoalesced(api_url, access_token, params, as_text)
+    finally:
+        with _in_flight_lock:
+            del _in_flight_calls[request_key]
+        in_flight_call.done.set()
+    return in_flight_call.result
+
+def _fetch_tdx_data_uncoalesced(api_url, access_token, params, as_text):
     headers = {
         'authorization': 'Bearer ' + access_token,
         'Accept-Encoding': 'gzip'
     }
-    response = None
+    endpoint = tdx_dataset_name(api_url)
+    started = time.monotonic()
     try:
-        response = requests.get(api_url, headers=headers, params=params)
+        response = _get_with_retries(api_url, headers, params, endpoint)
         response.raise_for_status()
-        return (response.json(), None)
+        if as_text:
+            result = (response.content.decode('utf-8'), None)
+        else:
+            with timed('json_decode', endpoint):
+                result = (response.json(), None)
     except requests.exceptions.HTTPError as http_err:
-        status_code = http_err.response.status_code if http_err.response else "UNKNOWN_HTTP_STATUS"
-        return (None, status_code)
+        status_code = http_err.response.status_code if http_err.response is not None else "UNKNOWN_HTTP_STATUS"
+        result = (None, status_code)
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        result = (None, "JSON_DECODE_ERROR")
     except requests.exceptions.RequestException:
-        return (None, "REQUEST_EXCEPTION")
-    except json.JSONDecodeError:
-        return (None, "JSON_DECODE_ERROR")
\ No newline at end of file
+        result = (None, _budget_error("REQUEST_EXCEPTION"))
+    except TDXRateLimited:
+        # Held back locally rather than sent into a TDX 429; callers already report 429 as "too frequent".
+        _record_endpoint_throttled(endpoint)
+        return (None, _budget_error(429))
+    except DeadlineExceeded:
+        return (None, DEADLINE_EXCEEDED)
+    _record_endpoint_call(endpoint, time.monotonic() - started, result[1])
+    return result
+
+_async_http_client = None
+_async_in_flight_calls = {}
+
+def _get_async_http_client():
+    global _async_http_client
+    if httpx is None:
+        raise RuntimeError("The async TDX client requires the 'httpx' package.")
+    if _async_http_client is None:
+        _async_http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=TDX_POOL_MAXSIZE, max_keepalive_connections=TDX_POOL_MAXSIZE),
+            timeout=httpx.Timeout(TDX_READ_TIMEOUT, connect=TDX_CONNECT_TIMEOUT)
+        )
+    return _async_http_client
+
+async def close_async_http_client():
+    global _async_http_client
+    if _async_http_client is not None:
+        await _async_http_client.aclose()
+        _async_http_client = None
+
+async def fetch_tdx_data_async(api_url, access_token, params=None, as_text=False):
+    if not access_token:
+        return (None, "NO_TOKEN")
+    with timed('tdx', tdx_dataset_name(api_url)):
+        return await _fetch_tdx_data_async_coalesced(api_url, access_token, params, as_text)
+
+async def _fetch_tdx_data_async_coalesced(api_url, access_token, params, as_text):
+    # Same single-flight behaviour as fetch_tdx_data_with_token, scoped to the running event loop.
+    request_key = _in_flight_key(api_url, params, as_text)
+    while True:
+        in_flight_call = _async_in_flight_calls.get(request_key)
+        if in_flight_call is None:
+            break
+        _record_endpoint_coalesced(tdx_dataset_name(api_url))
+        try:
+            result = await asyncio.wait_for(asyncio.shield(in_flight_call), remaining_budget())
+        except asyncio.TimeoutError:
+            return (None, DEADLINE_EXCEEDED)
+        if not _leader_ran_out_of_budget(result):
+            return result
+
+    in_flight_call = asyncio.ensure_future(_fetch_tdx_data_async_uncoalesced(api_url, access_token, params, as_text))
+    _async_in_flight_calls[request_key] = in_flight_call
+    return await asyncio.shield(in_flight_call)
+
+async def _fetch_tdx_data_async_uncoalesced(api_url, access_token, params, as_text):
+    headers = {
+        'authorization': 'Bearer ' + access_token,
+        'Accept-Encoding': 'gzip'
+    }
+    endpoint = tdx_dataset_name(api_url)
+    started = time.monotonic()
+    try:
+        # Inside the try, so the in-flight entry is removed even when no client can be created.
+        client = _get_async_http_client()
+        attempt = 0
+        while True:
+            await wait_for_slot_async(endpoint)
+            _check_budget()
+            response = await client.get(
+                api_url, headers=headers, params=params,
+                timeout=httpx.Timeout(cap_timeout(TDX_READ_TIMEOUT), connect=cap_timeout(TDX_CONNECT_TIMEOUT))
+            )
+            if response.status_code not in RETRY_STATUS_CODES or attempt >= TDX_MAX_RETRIES:
+                break
+            delay = _retry_delay(response, attempt)
+            if delay is None or not _budget_allows(delay):
+                break
+            _record_endpoint_retry(endpoint)
+            await asyncio.sleep(delay)
+            attempt += 1
+        if response.status_code >= 400:
+            result = (None, response.status_code)
+        elif as_text:
+            result = (response.content.decode('utf-8'), None)
+        else:
+            with timed('json_decode', endpoint):
+                result = (response.json(), None)
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        result = (None, "JSON_DECODE_ERROR")
+    except httpx.HTTPError:
+        result = (None, _budget_error("REQUEST_EXCEPTION"))
+    except TDXRateLimited:
+        _record_endpoint_throttled(endpoint)
+        return (None, _budget_error(429))
+    except DeadlineExceeded:
+        return (None, DEADLINE_EXCEEDED)
+    finally:
+        _async_in_flight_calls.pop(_in_flight_key(api_url, params, as_text), None)
+    _record_endpoint_call(endpoint, time.monotonic() - started, result[1])
+    return result
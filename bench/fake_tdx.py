@@ -0,0 +1,308 @@
+import argparse
+import json
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+# Stand-in for the TDX auth and InterCity bus endpoints used by this service.
+# Point the app at it with TDX_API_BASE_URL=http://HOST:PORT/api/basic and
+# TDX_AUTH_URL=http://HOST:PORT/auth/token.
+
+DATASETS = ('StopOfRoute', 'S2STravelTime', 'RealTimeNearStop', 'EstimatedTimeOfArrival')
+FILTER_CLAUSE = re.compile(r"^\s*(\w+)\s+eq\s+('?)(.*?)\2\s*$")
+
+
+class SyntheticFixtures():
+    def __init__(self, route_count=20, stop_count=60, buses_per_direction=4, seconds_per_stop=90, seed=7):
+        self.stop_count = stop_count
+        self.buses_per_direction = buses_per_direction
+        self.seconds_per_stop = seconds_per_stop
+        self.started_at = time.time()
+        rng = random.Random(seed)
+        self.routes = {}
+        self.run_times = {}
+        for route_number in range(route_count):
+            route_name = str(1801 + route_number)
+            route_uid = f"THB{route_name}"
+            variants = []
+            for sub_suffix in ('', 'A'):
+                for direction in (0, 1):
+                    stops = self._stops(route_name, direction)
+                    if sub_suffix:
+                        stops = stops[::2]
+                    variants.append({
+                        "RouteUID": route_uid, "RouteID": route_name,
+                        "RouteName": {"Zh_tw": route_name, "En": route_name},
+                        "SubRouteUID": route_uid + sub_suffix, "SubRouteID": route_name + sub_suffix,
+                        "SubRouteName": {"Zh_tw": route_name + sub_suffix, "En": route_name + sub_suffix},
+                        "Direction": direction, "Stops": stops,
+                        "UpdateTime": "2025-01-01T00:00:00+08:00"
+                    })
+                    for from_stop, to_stop in zip(stops, stops[1:]):
+                        self.run_times[(from_stop["StopID"], to_stop["StopID"])] = rng.randint(40, 240)
+            self.routes[route_name] = variants
+
+    def _stops(self, route_name, direction):
+        stops = []
+        for sequence in range(1, self.stop_count + 1):
+            stops.append({
+                "StopUID": f"THB{route_name}{direction}{sequence:03d}", "StopID": f"{route_name}{direction}{sequence:03d}",
+                "StopName": {"Zh_tw": f"{route_name}站{direction}-{sequence}", "En": f"Stop {sequence}"},
+                "StopSequence": sequence,
+                "StopPosition": {"PositionLon": 121.0 + sequence * 0.01, "PositionLat": 25.0 + direction * 0.001 + sequence * 0.005}
+            })
+        return stops
+
+    def route_names(self, route_name):
+        if route_name is None:
+            return list(self.routes)
+        # TDX matches the route name in the path loosely, so partial names return several routes.
+        return [name for name in self.routes if route_name in name]
+
+    def stop_of_route(self, route_name):
+        return [variant for name in self.route_names(route_name) for variant in self.routes[name]]
+
+    def s2s_travel_time(self, route_name):
+        results = []
+        for variant in self.routes.get(route_name, []):
+            stops = variant["Stops"]
+            travel_times = []
+            for weekday in range(7):
+                for start_hour in range(0, 24, 3):
+                    s2s_times = [
+                        {"FromStopID": a["StopID"], "ToStopID": b["StopID"], "RunTime": self.run_times[(a["StopID"], b["StopID"])]}
+                        for a, b in zip(stops, stops[1:])
+                    ]
+                    travel_times.append({"Weekday": weekday, "StartHour": start_hour, "EndHour": start_hour + 3, "S2STimes": s2s_times})
+            results.append({
+                "RouteUID": variant["RouteUID"], "SubRouteUID": variant["SubRouteUID"],
+                "Direction": variant["Direction"], "TravelTimes": travel_times
+            })
+        return results
+
+    def _bus_positions(self, route_name):
+        # Buses advance one stop every seconds_per_stop so pollers and caches see changing data.
+        step = int((time.time() - self.started_at) // self.seconds_per_stop)
+        variant_by_direction = {v["Direction"]: v for v in self.routes.get(route_name, []) if not v["SubRouteUID"].endswith('A')}
+        positions = []
+        for direction, variant in sorted(variant_by_direction.items()):
+            for bus_number in range(self.buses_per_direction):
+                offset = bus_number * self.stop_count // self.buses_per_direction
+                sequence = (offset + step) % self.stop_count + 1
+                positions.append((f"{route_name}-{direction}{bus_number:02d}", variant, variant["Stops"][sequence - 1]))
+        return positions
+
+    def realtime_near_stop(self, route_name):
+        results = []
+        for plate_numb, variant, stop in self._bus_positions(route_name):
+            results.append({
+                "PlateNumb": plate_numb, "RouteUID": variant["RouteUID"], "RouteName": variant["RouteName"],
+                "SubRouteUID": variant["SubRouteUID"], "SubRouteName": variant["SubRouteName"],
+                "Direction": variant["Direction"], "StopUID": stop["StopUID"], "StopID": stop["StopID"],
+                "StopName": stop["StopName"], "StopSequence": stop["StopSequence"],
+                "DutyStatus": 0, "BusStatus": 0, "A2EventType": 1,
+                "GPSTime": time.strftime("%Y-%m-%dT%H:%M:%S+08:00", time.localtime())
+            })
+        return results
+
+    def estimated_time_of_arrival(self, route_name):
+        results = []
+        for plate_numb, variant, current_stop in self._bus_positions(route_name):
+            seconds = 0
+            stops = variant["Stops"]
+            for from_stop, to_stop in zip(stops[current_stop["StopSequence"] - 1:], stops[current_stop["StopSequence"]:]):
+                seconds += self.run_times[(from_stop["StopID"], to_stop["StopID"])]
+                results.append({
+                    "PlateNumb": plate_numb, "StopUID": to_stop["StopUID"], "StopID": to_stop["StopID"],
+                    "StopName": to_stop["StopName"], "RouteUID": variant["RouteUID"], "Direction": variant["Direction"],
+                    "EstimateTime": seconds, "StopStatus": 0,
+                    "DataTime": time.strftime("%Y-%m-%dT%H:%M:%S+08:00", time.localtime())
+                })
+        return results
+
+    def dataset(self, dataset, route_name):
+        if dataset == 'StopOfRoute':
+            return self.stop_of_route(route_name)
+        if route_name is None:
+            return [item for name in self.routes for item in self.dataset(dataset, name)]
+        if dataset == 'S2STravelTime':
+            return self.s2s_travel_time(route_name)
+        if dataset == 'RealTimeNearStop':
+            return self.realtime_near_stop(route_name)
+        return self.estimated_time_of_arrival(route_name)
+
+
+class RecordedFixtures():
+    # Replays raw TDX responses saved as <dir>/<Dataset>/<RouteName>.json (and <dir>/<Dataset>.json for the whole dataset).
+    def __init__(self, fixture_dir):
+        self.fixture_dir = fixture_dir
+
+    def dataset(self, dataset, route_name):
+        file_name = f"{route_name}.json" if route_name is not None else None
+        path = os.path.join(self.fixture_dir, dataset, file_name) if file_name else os.path.join(self.fixture_dir, f"{dataset}.json")
+        if not os.path.isfile(path):
+            return []
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+
+
+def apply_odata_filter(items, odata_filter):
+    if not odata_filter:
+        return items
+    for clause in odata_filter.split(' and '):
+        match = FILTER_CLAUSE.match(clause)
+        if match is None:
+            continue
+        field, quoted, value = match.group(1), match.group(2), match.group(3)
+        items = [item for item in items if (item.get(field) == value if quoted else str(item.get(field)) == value)]
+    return items
+
+
+def apply_odata_select(items, odata_select):
+    if not odata_select:
+        return items
+    fields = [field.strip() for field in odata_select.split(',') if field.strip()]
+    return [{field: item[field] for field in fields if field in item} for item in items]
+
+
+class FakeTDXServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, fixtures, latency=0.0, jitter=0.0, rate_429=0.0, retry_after=1):
+        super().__init__(address, FakeTDXHandler)
+        self.fixtures = fixtures
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self._stats_lock = threading.Lock()
+        self._rng = random.Random()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self.stats = {"requests": 0, "throttled": 0, "datasets": {}}
+
+    def record(self, dataset, throttled):
+        with self._stats_lock:
+            self.stats["requests"] += 1
+            self.stats["datasets"][dataset] = self.stats["datasets"].get(dataset, 0) + 1
+            if throttled:
+                self.stats["throttled"] += 1
+
+    def snapshot_stats(self):
+        with self._stats_lock:
+            return {"requests": self.stats["requests"], "throttled": self.stats["throttled"], "datasets": dict(self.stats["datasets"])}
+
+    def simulated_delay(self):
+        if self.latency <= 0 and self.jitter <= 0:
+            return 0
+        return max(0.0, self._rng.gauss(self.latency, self.jitter) if self.jitter else self.latency)
+
+    def should_throttle(self):
+        return self.rate_429 > 0 and self._rng.random() < self.rate_429
+
+
+class FakeTDXHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, extra_headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (extra_headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        content_length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(content_length)
+        if not urlparse(self.path).path.startswith('/auth'):
+            self._send_json(404, {"message": "Not Found"})
+            return
+        self.server.record('auth', False)
+        self._send_json(200, {"access_token": "fake-tdx-token", "expires_in": 86400, "token_type": "Bearer"})
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        query = parse_qs(parsed.query)
+        if parsed.path == '/__stats':
+            stats = self.server.snapshot_stats()
+            if query.get('reset', ['0'])[0] == '1':
+                self.server.reset_stats()
+            self._send_json(200, stats)
+            return
+
+        # /api/basic/v2/Bus/<Dataset>[/Streaming]/InterCity[/<RouteName>]
+        parts = [unquote(part) for part in parsed.path.split('/') if part]
+        if len(parts) > 5 and parts[5] == 'Streaming':
+            del parts[5]
+        if len(parts) < 6 or parts[:4] != ['api', 'basic', 'v2', 'Bus'] or parts[4] not in DATASETS or parts[5] != 'InterCity':
+            self._send_json(404, {"message": "Not Found"})
+            return
+        dataset = parts[4]
+        route_name = parts[6] if len(parts) > 6 else None
+
+        delay = self.server.simulated_delay()
+        if delay:
+            time.sleep(delay)
+        if self.server.should_throttle():
+            self.server.record(dataset, True)
+            self._send_json(429, {"message": "API rate limit exceeded"}, {'Retry-After': str(self.server.retry_after)})
+            return
+        self.server.record(dataset, False)
+
+        items = self.server.fixtures.dataset(dataset, route_name)
+        items = apply_odata_filter(items, query.get('$filter', [None])[0])
+        items = apply_odata_select(items, query.get('$select', [None])[0])
+        self._send_json(200, items)
+
+
+def start_fake_tdx_server(host='127.0.0.1', port=0, fixtures=None, **options):
+    server = FakeTDXServer((host, port), fixtures or SyntheticFixtures(), **options)
+    threading.Thread(target=server.serve_forever, name='fake-tdx', daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the TDX InterCity bus API.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--fixtures', help="directory of recorded TDX responses; synthetic data is generated when omitted")
+    parser.add_argument('--routes', type=int, default=20, help="number of synthetic routes")
+    parser.add_argument('--stops', type=int, default=60, help="stops per synthetic route")
+    parser.add_argument('--buses', type=int, default=4, help="synthetic buses per route direction")
+    parser.add_argument('--latency', type=float, default=0.05, help="mean upstream latency in seconds")
+    parser.add_argument('--jitter', type=float, default=0.01, help="standard deviation of the latency in seconds")
+    parser.add_argument('--rate-429', type=float, default=0.0, help="fraction of data requests answered with 429")
+    parser.add_argument('--retry-after', type=int, default=1, help="Retry-After seconds sent with injected 429s")
+    args = parser.parse_args()
+
+    if args.fixtures:
+        fixtures = RecordedFixtures(args.fixtures)
+    else:
+        fixtures = SyntheticFixtures(route_count=args.routes, stop_count=args.stops, buses_per_direction=args.buses)
+    server = FakeTDXServer(
+        (args.host, args.port), fixtures,
+        latency=args.latency, jitter=args.jitter, rate_429=args.rate_429, retry_after=args.retry_after
+    )
+    base = f"http://{args.host}:{server.server_port}"
+    print(f"fake TDX listening on {base}")
+    print(f"  TDX_API_BASE_URL={base}/api/basic TDX_AUTH_URL={base}/auth/token")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
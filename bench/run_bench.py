@@ -0,0 +1,207 @@
+import argparse
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+import requests
+
+# Drives /api/routes, /api/buses_for_route and /api/bus_info at a fixed request
+# rate and reports latency percentiles, throughput and, when the app is pointed
+# at bench/fake_tdx.py, how many TDX calls each API request cost.
+
+DEFAULT_MIX = 'routes:1,buses_for_route:2,bus_info:7'
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    position = min(len(sorted_values) - 1, max(0, int(round(fraction * (len(sorted_values) - 1)))))
+    return sorted_values[position]
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition(':')
+        weights[name.strip()] = int(weight or 1)
+    unknown = set(weights) - {'routes', 'buses_for_route', 'bus_info'}
+    if unknown:
+        raise ValueError(f"unknown endpoint(s) in --mix: {', '.join(sorted(unknown))}")
+    return weights
+
+
+class _ThreadLocalSession(threading.local):
+    def __init__(self):
+        self.session = requests.Session()
+
+
+def discover_targets(target, keywords, timeout):
+    # Walks the same path the web UI does so the request mix only hits routes and plates that exist.
+    session = requests.Session()
+    paths = {'routes': [], 'buses_for_route': [], 'bus_info': []}
+    for keyword in keywords:
+        paths['routes'].append('/api/routes?' + urlencode({'keyword': keyword}))
+        routes = session.get(target + paths['routes'][-1], timeout=timeout).json().get('routes', [])
+        for route in routes:
+            route_params = {
+                'direction': route['direction'], 'tdx_route_name_keyword': route['tdx_route_name_keyword'],
+                'route_uid': route.get('route_uid') or '', 'sub_route_uid': route.get('sub_route_uid') or '',
+                'display_name': route['display_name']
+            }
+            paths['buses_for_route'].append('/api/buses_for_route?' + urlencode(route_params))
+            buses = session.get(target + paths['buses_for_route'][-1], timeout=timeout).json().get('buses', [])
+            for bus in buses:
+                bus_params = {'route_name': route['tdx_route_name_keyword'], 'direction': route['direction']}
+                paths['bus_info'].append(f"/api/bus_info/{bus['plate_numb']}?" + urlencode(bus_params))
+    return paths
+
+
+def fetch_fake_tdx_stats(fake_tdx, reset=False):
+    if not fake_tdx:
+        return None
+    return requests.get(f"{fake_tdx}/__stats", params={'reset': '1' if reset else '0'}, timeout=5).json()
+
+
+def run_load(target, paths, weights, rps, duration, concurrency, timeout):
+    schedule = []
+    for endpoint, weight in weights.items():
+        if paths.get(endpoint):
+            schedule.extend([endpoint] * weight)
+    if not schedule:
+        raise RuntimeError("no request targets were discovered; check --keyword and that the app can reach TDX")
+
+    sessions = _ThreadLocalSession()
+    samples = []
+    samples_lock = threading.Lock()
+    counters = {endpoint: 0 for endpoint in paths}
+
+    def issue(endpoint, path, release_at):
+        # Measured from the scheduled release, not from when a pool thread got to it, so time a request spent
+        # queued behind a slow app counts against the latency (no coordinated omission).
+        try:
+            response = sessions.session.get(target + path, timeout=timeout)
+            ok = response.status_code == 200 and not response.json().get('error')
+        except (requests.exceptions.RequestException, ValueError):
+            ok = False
+        elapsed = time.perf_counter() - release_at
+        with samples_lock:
+            samples.append((endpoint, elapsed, ok))
+
+    total_requests = int(rps * duration)
+    late_requests = 0
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for request_number in range(total_requests):
+            # Open-loop pacing: requests are released on schedule whether or not earlier ones have finished.
+            release_at = started_at + request_number / rps
+            delay = release_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -0.1:
+                late_requests += 1
+            endpoint = schedule[request_number % len(schedule)]
+            endpoint_paths = paths[endpoint]
+            path = endpoint_paths[counters[endpoint] % len(endpoint_paths)]
+            counters[endpoint] += 1
+            executor.submit(issue, endpoint, path, release_at)
+    wall_seconds = time.perf_counter() - started_at
+    return samples, wall_seconds, late_requests
+
+
+def summarize(samples, wall_seconds, late_requests, upstream_stats):
+    def latency_summary(latencies, errors):
+        latencies.sort()
+        return {
+            "requests": len(latencies),
+            "errors": errors,
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 2) if latencies else None,
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+            "max_ms": round(latencies[-1] * 1000, 2) if latencies else None
+        }
+
+    per_endpoint = {}
+    for endpoint in sorted({sample[0] for sample in samples}):
+        endpoint_samples = [sample for sample in samples if sample[0] == endpoint]
+        per_endpoint[endpoint] = latency_summary([s[1] for s in endpoint_samples], sum(1 for s in endpoint_samples if not s[2]))
+
+    report = latency_summary([s[1] for s in samples], sum(1 for s in samples if not s[2]))
+    report["throughput_rps"] = round(len(samples) / wall_seconds, 2) if wall_seconds else None
+    report["late_requests"] = late_requests
+    report["endpoints"] = per_endpoint
+    if upstream_stats is not None:
+        report["upstream_requests"] = upstream_stats["requests"]
+        report["upstream_throttled"] = upstream_stats["throttled"]
+        report["upstream_per_request"] = round(upstream_stats["requests"] / len(samples), 3) if samples else None
+        report["upstream_datasets"] = upstream_stats["datasets"]
+    return report
+
+
+def compare_with_baseline(report, baseline, tolerance):
+    regressions = []
+    for metric in ('p50_ms', 'p95_ms', 'p99_ms', 'upstream_per_request'):
+        current, previous = report.get(metric), baseline.get(metric)
+        if current is None or not previous:
+            continue
+        if current > previous * (1 + tolerance):
+            regressions.append(f"{metric}: {previous} -> {current}")
+    return regressions
+
+
+def print_report(report):
+    print(f"requests={report['requests']} errors={report['errors']} throughput={report['throughput_rps']} req/s late={report['late_requests']}")
+    print(f"latency p50={report['p50_ms']}ms p95={report['p95_ms']}ms p99={report['p99_ms']}ms max={report['max_ms']}ms")
+    for endpoint, stats in report["endpoints"].items():
+        print(f"  {endpoint:<16} n={stats['requests']:<6} err={stats['errors']:<4} p50={stats['p50_ms']}ms p95={stats['p95_ms']}ms p99={stats['p99_ms']}ms")
+    if "upstream_requests" in report:
+        print(f"upstream calls={report['upstream_requests']} ({report['upstream_per_request']}/request) throttled={report['upstream_throttled']}")
+        print(f"  by dataset: {json.dumps(report['upstream_datasets'], sort_keys=True)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the bus API and report latency percentiles.")
+    parser.add_argument('--target', default='http://127.0.0.1:5001', help="base URL of the running app")
+    parser.add_argument('--fake-tdx', help="base URL of bench/fake_tdx.py, used to count upstream calls")
+    parser.add_argument('--keyword', action='append', help="route keyword(s) to discover targets from (default 18)")
+    parser.add_argument('--rps', type=float, default=20)
+    parser.add_argument('--duration', type=float, default=30, help="seconds of load")
+    parser.add_argument('--concurrency', type=int, default=64, help="maximum in-flight requests")
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f"endpoint weights (default {DEFAULT_MIX})")
+    parser.add_argument('--warmup', type=float, default=0, help="seconds of unmeasured load before the run")
+    parser.add_argument('--json', dest='json_path', help="write the report as JSON to this path")
+    parser.add_argument('--baseline', help="JSON report to compare against; exits 1 on regression")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed fractional regression vs --baseline")
+    args = parser.parse_args()
+
+    target = args.target.rstrip('/')
+    fake_tdx = args.fake_tdx.rstrip('/') if args.fake_tdx else None
+    weights = parse_mix(args.mix)
+    paths = discover_targets(target, args.keyword or ['18'], args.timeout)
+    print("targets: " + ", ".join(f"{endpoint}={len(endpoint_paths)}" for endpoint, endpoint_paths in paths.items()))
+
+    if args.warmup > 0:
+        run_load(target, paths, weights, args.rps, args.warmup, args.concurrency, args.timeout)
+    fetch_fake_tdx_stats(fake_tdx, reset=True)
+    samples, wall_seconds, late_requests = run_load(target, paths, weights, args.rps, args.duration, args.concurrency, args.timeout)
+    report = summarize(samples, wall_seconds, late_requests, fetch_fake_tdx_stats(fake_tdx))
+    print_report(report)
+
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare_with_baseline(report, json.load(f), args.tolerance)
+        if regressions:
+            print("regressions against baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+import json
+import os
+import threading
+import time
+
+ETA_STREAM_INTERVAL = float(os.environ.get('ETA_STREAM_INTERVAL', 15))
+ETA_STREAM_HEARTBEAT = float(os.environ.get('ETA_STREAM_HEARTBEAT', 15))
+ETA_STREAM_IDLE_GRACE = float(os.environ.get('ETA_STREAM_IDLE_GRACE', 30))
+# Streams the sync (gunicorn gthread) server keeps open per worker; each holds a request thread, so this must
+# stay well below --threads or open tabs starve every other endpoint. The ASGI app does not need a cap.
+ETA_STREAM_MAX_STREAMS = int(os.environ.get('ETA_STREAM_MAX_STREAMS', 16))
+# Ages that grow on every recompute while data is stale; a change in them alone is not worth an event.
+VOLATILE_FIELDS = ('data_age_seconds', 'stale_datasets', 'stale_static_datasets')
+
+
+class EtaTopic():
+    def __init__(self, key):
+        self.key = key
+        self.version = 0
+        self.payload = None
+        self.subscribers = 0
+        self.idle_since = None
+        self.listeners = set()
+        self.condition = threading.Condition()
+
+    def publish(self, payload):
+        with self.condition:
+            self.version += 1
+            self.payload = payload
+            listeners = list(self.listeners)
+            self.condition.notify_all()
+        for listener in listeners:
+            listener()
+
+
+class EtaStreamHub():
+    # One refresher thread per subscribed (plate, route, direction); every subscriber of that key shares its
+    # result and is only woken when the computed payload differs from the last one published.
+    def __init__(self, compute_fn, interval=ETA_STREAM_INTERVAL, idle_grace=ETA_STREAM_IDLE_GRACE):
+        self.compute_fn = compute_fn
+        self.interval = interval
+        self.idle_grace = idle_grace
+        self._topics = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key, listener=None):
+        with self._lock:
+            topic = self._topics.get(key)
+            is_new_topic = topic is None
+            if is_new_topic:
+                topic = self._topics[key] = EtaTopic(key)
+            with topic.condition:
+                topic.subscribers += 1
+                topic.idle_since = None
+                if listener is not None:
+                    topic.listeners.add(listener)
+        if is_new_topic:
+            threading.Thread(target=self._run_topic, args=(topic,), name='eta-stream', daemon=True).start()
+        return topic
+
+    def release(self, topic, listener=None):
+        with topic.condition:
+            topic.subscribers -= 1
+            topic.listeners.discard(listener)
+            if topic.subscribers == 0:
+                topic.idle_since = time.time()
+
+    def subscribe(self, key, heartbeat=ETA_STREAM_HEARTBEAT):
+        # Yields (version, payload) on every change and (None, None) as a keep-alive when nothing changed.
+        topic = self.acquire(key)
+        try:
+            seen_version = 0
+            while True:
+                with topic.condition:
+                    if topic.version == seen_version:
+                        topic.condition.wait(heartbeat)
+                    version, payload = topic.version, topic.payload
+                if version == seen_version:
+                    yield (None, None)
+                    continue
+                seen_version = version
+                yield (version, payload)
+        finally:
+            self.release(topic)
+
+    def _run_topic(self, topic):
+        last_body = None
+        while True:
+            try:
+                payload = self.compute_fn(*topic.key)
+            except Exception:
+                payload = None
+            if payload is not None:
+                comparable = {key: value for key, value in payload.items() if key not in VOLATILE_FIELDS} if isinstance(payload, dict) else payload
+                body = json.dumps(comparable, sort_keys=True, ensure_ascii=False)
+                if body != last_body:
+                    last_body = body
+                    topic.publish(payload)
+
+            time.sleep(self.interval)
+            with self._lock:
+                with topic.condition:
+                    if topic.subscribers == 0 and topic.idle_since is not None and time.time() - topic.idle_since >= self.idle_grace:
+                        del self._topics[topic.key]
+                        return
+
+
+def format_sse_event(version, payload):
+    if version is None:
+        return ": keep-alive\n\n"
+    return f"id: {version}\nevent: eta\ndata: {json.dumps(payload, ensure_ascii=False, separators=(',', ':'))}\n\n"
@@ -0,0 +1,117 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_BYTES = int(os.environ.get('HTTP_COMPRESS_MIN_BYTES', 512))
+DELTA_HISTORY_ENTRIES = int(os.environ.get('HTTP_DELTA_HISTORY_ENTRIES', 4096))
+
+
+def content_hash(body):
+    return hashlib.blake2b(body, digest_size=12).hexdigest()
+
+
+def negotiate_encoding(accept_encoding):
+    # Picks br or gzip from an Accept-Encoding header, honouring q-values; None means send it uncompressed.
+    if not accept_encoding:
+        return None
+    weights = {}
+    for part in accept_encoding.split(','):
+        coding, _, params = part.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        weights[coding.strip().lower()] = quality
+    candidates = [coding for coding in (('br', 'gzip') if brotli is not None else ('gzip',)) if weights.get(coding, weights.get('*', 0)) > 0]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda coding: weights.get(coding, weights.get('*', 0)))
+
+
+def compress_body(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=5)
+    # mtime=0 keeps the output, and so repeated responses, byte-identical.
+    return gzip.compress(body, compresslevel=6, mtime=0)
+
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    return any(candidate.strip().removeprefix('W/') == etag for candidate in if_none_match.split(','))
+
+
+def conditional_json_response(body, if_none_match=None, accept_encoding=None):
+    # Returns (status, body, headers) for a 200 JSON body: 304 with no body when the client already holds this
+    # content, otherwise the body, compressed when it is worth it. Each content-coding gets its own ETag.
+    encoding = negotiate_encoding(accept_encoding) if len(body) >= COMPRESS_MIN_BYTES else None
+    etag = f'"{content_hash(body)}-{encoding}"' if encoding else f'"{content_hash(body)}"'
+    headers = [('ETag', etag), ('Cache-Control', 'no-cache'), ('Vary', 'Accept-Encoding')]
+    if etag_matches(if_none_match, etag):
+        return 304, b'', headers
+    if encoding:
+        body = compress_body(body, encoding)
+        headers.append(('Content-Encoding', encoding))
+    return 200, body, headers
+
+
+class PayloadHistory():
+    # Recently served upcoming_stops lists keyed by the version they were sent as, so a client can later ask
+    # for only what changed since then. Versions are content hashes, so identical payloads share an entry.
+    def __init__(self, max_entries=DELTA_HISTORY_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def remember(self, version, upcoming_stops):
+        with self._lock:
+            self._entries[version] = upcoming_stops
+            self._entries.move_to_end(version)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, version):
+        with self._lock:
+            return self._entries.get(version)
+
+
+_payload_history = PayloadHistory()
+
+
+def upcoming_stops_delta(payload, since):
+    # since-mode for bus info: the payload gains a version, and when the client's version is still known,
+    # upcoming_stops is cut down to the stops that are new or whose arrival_status changed.
+    upcoming_stops = payload.get("upcoming_stops") or []
+    version = content_hash(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+    _payload_history.remember(version, upcoming_stops)
+
+    previous_stops = _payload_history.get(since) if since else None
+    if previous_stops is None:
+        return dict(payload, version=version, delta=False)
+
+    previous_status = {stop.get("stop_sequence"): stop.get("arrival_status") for stop in previous_stops}
+    current_sequences = {stop.get("stop_sequence") for stop in upcoming_stops}
+    return dict(
+        payload,
+        version=version,
+        since=since,
+        delta=True,
+        upcoming_stops=[
+            stop for stop in upcoming_stops
+            if stop.get("stop_sequence") not in previous_status or previous_status[stop.get("stop_sequence")] != stop.get("arrival_status")
+        ],
+        removed_stop_sequences=[sequence for sequence in previous_status if sequence not in current_sequences]
+    )
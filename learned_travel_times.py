@@ -0,0 +1,127 @@
+import os
+import threading
+from array import array
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+# Segment run times learned from the RealTimeNearStop positions the service already fetches: when a bus is
+# first seen at stop sequence n + 1 after stop n, the GPSTime difference is one observation of that segment.
+# Used where TDX's S2STravelTime has no run time for a segment or time slot. 0 disables learning.
+TDX_LEARNED_TRAVEL_TIMES_ENABLED = os.environ.get('TDX_LEARNED_TRAVEL_TIMES_ENABLED', '1') == '1'
+# Observations kept per worker; once full, each new one replaces the oldest, so medians follow recent traffic.
+TDX_LEARNED_LOG_ENTRIES = int(os.environ.get('TDX_LEARNED_LOG_ENTRIES', 200000))
+TDX_LEARNED_MIN_SAMPLES = int(os.environ.get('TDX_LEARNED_MIN_SAMPLES', 3))
+# Longer gaps usually mean the bus was not reported for a while (or waited at a terminal), not a slow segment.
+TDX_LEARNED_MAX_SEGMENT_SECONDS = float(os.environ.get('TDX_LEARNED_MAX_SEGMENT_SECONDS', 1800))
+TRACKED_BUSES = 8192
+# TDX reports local Taiwan time; a GPSTime without an offset is read as such.
+TDX_TIMEZONE = timezone(timedelta(hours=8))
+
+
+def _parse_gps_time(value):
+    # Always aware and in TDX_TIMEZONE, so reports with and without an offset compare, and slots are local hours.
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        return moment.replace(tzinfo=TDX_TIMEZONE)
+    return moment.astimezone(TDX_TIMEZONE)
+
+
+def _slot(moment):
+    return moment.weekday() * 24 + moment.hour
+
+
+class SegmentTravelTimeStore():
+    def __init__(self, max_entries=TDX_LEARNED_LOG_ENTRIES, min_samples=TDX_LEARNED_MIN_SAMPLES,
+                 max_segment_seconds=TDX_LEARNED_MAX_SEGMENT_SECONDS):
+        self.max_entries = max_entries
+        self.min_samples = min_samples
+        self.max_segment_seconds = max_segment_seconds
+        self._segment_ids = {}
+        # The observation log: parallel typed columns used as a ring once max_entries is reached.
+        self._log_segments = array('I')
+        self._log_slots = array('B')
+        self._log_seconds = array('f')
+        self._next_position = 0
+        # (segment id, weekday * 24 + hour) -> sorted run times of that cell's observations still in the log;
+        # kept sorted as observations come and go, so a median is a single index.
+        self._cells = {}
+        # Plate -> (sub route UID, direction, stop sequence, stop ID, first seen at that stop).
+        self._positions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def observe(self, bus):
+        plate_numb = bus.get('PlateNumb')
+        stop_sequence = bus.get('StopSequence')
+        stop_id = bus.get('StopID')
+        if not plate_numb or plate_numb == '-1' or not isinstance(stop_sequence, int) or not stop_id:
+            return
+        try:
+            seen_at = _parse_gps_time(bus.get('GPSTime'))
+        except (TypeError, ValueError):
+            return
+        route_key = (bus.get('SubRouteUID'), bus.get('Direction'))
+
+        with self._lock:
+            previous = self._positions.get(plate_numb)
+            if previous is not None:
+                if seen_at <= previous[4] or previous[:4] == route_key + (stop_sequence, stop_id):
+                    # A repeated or older report (cached or last-known-good data): the bus has not moved on.
+                    self._positions.move_to_end(plate_numb)
+                    return
+                seconds = (seen_at - previous[4]).total_seconds()
+                if previous[:2] == route_key and stop_sequence == previous[2] + 1 and seconds <= self.max_segment_seconds:
+                    self._record((previous[3], stop_id), _slot(previous[4]), seconds)
+            self._positions[plate_numb] = route_key + (stop_sequence, stop_id, seen_at)
+            self._positions.move_to_end(plate_numb)
+            while len(self._positions) > TRACKED_BUSES:
+                self._positions.popitem(last=False)
+
+    def _record(self, segment, slot, seconds):
+        segment_id = self._segment_ids.setdefault(segment, len(self._segment_ids))
+        position = self._next_position
+        if position < len(self._log_segments):
+            oldest_cell = self._cells[(self._log_segments[position], self._log_slots[position])]
+            del oldest_cell[bisect_left(oldest_cell, self._log_seconds[position])]
+            self._log_segments[position] = segment_id
+            self._log_slots[position] = slot
+            self._log_seconds[position] = seconds
+        else:
+            self._log_segments.append(segment_id)
+            self._log_slots.append(slot)
+            self._log_seconds.append(seconds)
+        self._next_position = (position + 1) % self.max_entries
+        # Stored back from the float32 column so removing it later finds the identical value.
+        insort(self._cells.setdefault((segment_id, slot), []), self._log_seconds[position])
+
+    def median_seconds(self, from_stop_id, to_stop_id, weekday, hour):
+        segment_id = self._segment_ids.get((from_stop_id, to_stop_id))
+        if segment_id is None:
+            return None
+        with self._lock:
+            samples = self._cells.get((segment_id, weekday * 24 + hour))
+            if not samples or len(samples) < self.min_samples:
+                return None
+            return samples[len(samples) // 2]
+
+    def __len__(self):
+        return len(self._log_segments)
+
+
+_store = SegmentTravelTimeStore() if TDX_LEARNED_TRAVEL_TIMES_ENABLED else None
+
+
+def observe_bus_positions(realtime_entries):
+    if _store is None or not isinstance(realtime_entries, list):
+        return
+    for bus in realtime_entries:
+        if isinstance(bus, dict):
+            _store.observe(bus)
+
+
+def learned_segment_seconds(moment, from_stop_id, to_stop_id):
+    # moment is the aware time the bus leaves from_stop_id; it picks the same local weekday/hour slot observe used.
+    if _store is None:
+        return None
+    local_moment = moment.astimezone(TDX_TIMEZONE)
+    return _store.median_seconds(from_stop_id, to_stop_id, local_moment.weekday(), local_moment.hour)
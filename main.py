@@ -1,8 +1,28 @@
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import contextvars
 from datetime import datetime, timedelta
-from flask import Flask, jsonify, request, send_from_directory
+from functools import lru_cache, partial, wraps
+from flask import Flask, Response, g, jsonify, request, send_from_directory, stream_with_context
 from flask_cors import CORS
 import os
-from auth_TDX import get_tdx_access_token, fetch_tdx_data_with_token, app_id as tdx_app_id, app_key as tdx_app_key
+import threading
+import time
+from auth_TDX import get_endpoint_stats, get_tdx_access_token, get_token_manager, app_id as tdx_app_id, app_key as tdx_app_key
+from tdx_cache import (
+    begin_stale_tracking, end_stale_tracking, fetch_tdx_data_cached, fetch_tdx_data_cached_async,
+    fetch_tdx_data_with_fallback, fetch_tdx_data_with_fallback_async, get_cache_stats, stale_reads
+)
+from eta_stream import ETA_STREAM_MAX_STREAMS, EtaStreamHub, format_sse_event
+from http_cache import conditional_json_response, upcoming_stops_delta
+from learned_travel_times import learned_segment_seconds, observe_bus_positions
+from metrics import begin_request, end_request, observe_request, render_prometheus, request_spans, server_timing_header, timed
+from request_budget import DEADLINE_EXCEEDED, begin_budget, end_budget, remaining_budget
+from route_data import decode_s2s_travel_time, parse_stop_of_route
+from route_index import get_route_index, index_eta_by_stop_id
+from route_poller import RoutePoller, TDX_POLLER_ENABLED
+from route_catalogue import RouteCatalogue, TDX_ROUTE_CATALOGUE_ENABLED
+from tdx_rate_limit import REALTIME_DATASETS
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 STATIC_DIR = os.path.join(BASE_DIR, 'static')
@@ -10,77 +30,232 @@ STATIC_DIR = os.path.join(BASE_DIR, 'static')
 app = Flask(__name__, static_folder=STATIC_DIR)
 
 
-CORS(app, origins=[
+CORS_ORIGINS = [
     "https://myybuss.netlify.app",
     "https://heronsky.github.io",
-])
+]
+CORS(app, origins=CORS_ORIGINS)
 
 
-TDX_API_BASE_URL = "https://tdx.transportdata.tw/api/basic"
+TDX_API_BASE_URL = os.environ.get("TDX_API_BASE_URL", "https://tdx.transportdata.tw/api/basic")
 
+# Fetch the first token in the background so requests only ever read an already valid token.
+get_token_manager().start()
 
-def get_bus_stop_info_logic(target_plate, route_name_param=None, direction_param=None):
-    results = {
+TDX_CONCURRENT_FETCH = os.environ.get('TDX_CONCURRENT_FETCH', '1') == '1'
+_fetch_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('TDX_FETCH_WORKERS', 8)), thread_name_prefix='tdx-fetch')
+
+
+class _DeferredCall():
+    def __init__(self, fn, args, kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+
+    def result(self):
+        return self.fn(*self.args, **self.kwargs)
+
+
+def _submit_fetch(fetch_fn, *args, **kwargs):
+    if TDX_CONCURRENT_FETCH:
+        # Run in a copy of the request's context so timing spans recorded by the worker land on this request.
+        return _fetch_executor.submit(contextvars.copy_context().run, fetch_fn, *args, **kwargs)
+    return _DeferredCall(fetch_fn, args, kwargs)
+
+
+NEARBY_DEFAULT_RADIUS = 500
+NEARBY_MAX_RADIUS = int(os.environ.get('TDX_NEARBY_MAX_RADIUS', 2000))
+NEARBY_MAX_STOPS = int(os.environ.get('TDX_NEARBY_MAX_STOPS', 30))
+# Each distinct route direction among the nearby stops costs one ETA query, so only the closest few are checked.
+NEARBY_MAX_ROUTES = int(os.environ.get('TDX_NEARBY_MAX_ROUTES', 8))
+
+_route_poller = RoutePoller(TDX_API_BASE_URL) if TDX_POLLER_ENABLED else None
+_route_catalogue = RouteCatalogue(TDX_API_BASE_URL) if TDX_ROUTE_CATALOGUE_ENABLED else None
+
+
+def _route_snapshot(route_name):
+    if _route_poller is None or not route_name:
+        return None
+    _route_poller.mark_hot(route_name)
+    return _route_poller.snapshot_for(route_name)
+
+
+def _fetch_realtime(route_name, access_token, params, match_fields):
+    snapshot = _route_snapshot(route_name)
+    if snapshot is not None:
+        return (snapshot.realtime_where(match_fields), None)
+    api_url_realtime = f"{TDX_API_BASE_URL}/v2/Bus/RealTimeNearStop/Streaming/InterCity/{route_name}"
+    return fetch_tdx_data_with_fallback(api_url_realtime, access_token, params=params)
+
+
+def _fetch_eta_for_bus(route_name, target_plate, direction, access_token):
+    snapshot = _route_snapshot(route_name)
+    if snapshot is not None:
+        return (snapshot.eta_for_bus(target_plate, direction), None)
+    api_url_eta = f"{TDX_API_BASE_URL}/v2/Bus/EstimatedTimeOfArrival/Streaming/InterCity/{route_name}"
+    params_eta = {'$filter': f"PlateNumb eq '{target_plate}' and Direction eq {direction}", '$format': 'JSON'}
+    return fetch_tdx_data_with_fallback(api_url_eta, access_token, params=params_eta)
+
+
+def _fetch_route_eta(route_name, direction, access_token):
+    snapshot = _route_snapshot(route_name)
+    if snapshot is not None:
+        return (snapshot.eta_where({'Direction': direction}), None)
+    api_url_eta = f"{TDX_API_BASE_URL}/v2/Bus/EstimatedTimeOfArrival/Streaming/InterCity/{route_name}"
+    return fetch_tdx_data_with_fallback(api_url_eta, access_token, params={'$filter': f"Direction eq {direction}", '$format': 'JSON'})
+
+
+async def _fetch_realtime_async(route_name, access_token, params, match_fields):
+    snapshot = _route_snapshot(route_name)
+    if snapshot is not None:
+        return (snapshot.realtime_where(match_fields), None)
+    api_url_realtime = f"{TDX_API_BASE_URL}/v2/Bus/RealTimeNearStop/Streaming/InterCity/{route_name}"
+    return await fetch_tdx_data_with_fallback_async(api_url_realtime, access_token, params=params)
+
+
+async def _fetch_eta_for_bus_async(route_name, target_plate, direction, access_token):
+    snapshot = _route_snapshot(route_name)
+    if snapshot is not None:
+        return (snapshot.eta_for_bus(target_plate, direction), None)
+    api_url_eta = f"{TDX_API_BASE_URL}/v2/Bus/EstimatedTimeOfArrival/Streaming/InterCity/{route_name}"
+    params_eta = {'$filter': f"PlateNumb eq '{target_plate}' and Direction eq {direction}", '$format': 'JSON'}
+    return await fetch_tdx_data_with_fallback_async(api_url_eta, access_token, params=params_eta)
+
+
+async def _fetch_route_eta_async(route_name, direction, access_token):
+    snapshot = _route_snapshot(route_name)
+    if snapshot is not None:
+        return (snapshot.eta_where({'Direction': direction}), None)
+    api_url_eta = f"{TDX_API_BASE_URL}/v2/Bus/EstimatedTimeOfArrival/Streaming/InterCity/{route_name}"
+    return await fetch_tdx_data_with_fallback_async(api_url_eta, access_token, params={'$filter': f"Direction eq {direction}", '$format': 'JSON'})
+
+
+async def _no_fetch():
+    return None
+
+
+def _optional_stage_result(call):
+    # S2S and ETA only enrich the answer, so they get whatever is left of the request's budget and are
+    # dropped, rather than waited for, once it runs out. Realtime and StopOfRoute are always awaited.
+    budget = remaining_budget()
+    if budget is None:
+        return call.result()
+    if isinstance(call, Future):
+        try:
+            return call.result(timeout=budget)
+        except FutureTimeoutError:
+            return (None, DEADLINE_EXCEEDED)
+    # Deferred calls check the budget in the fetch layer, and may still be answered from a poller snapshot.
+    return call.result()
+
+
+async def _optional_stage_async(fetch_coro):
+    budget = remaining_budget()
+    if budget is None:
+        return await fetch_coro
+    try:
+        return await asyncio.wait_for(fetch_coro, budget)
+    except asyncio.TimeoutError:
+        return (None, DEADLINE_EXCEEDED)
+
+
+def _with_request_budget(logic_fn):
+    # Bounds how long building a bus-info response may take; see request_budget.TDX_REQUEST_DEADLINE.
+    if asyncio.iscoroutinefunction(logic_fn):
+        @wraps(logic_fn)
+        async def async_wrapper(*args, **kwargs):
+            budget_token = begin_budget()
+            try:
+                return await logic_fn(*args, **kwargs)
+            finally:
+                end_budget(budget_token)
+        return async_wrapper
+
+    @wraps(logic_fn)
+    def wrapper(*args, **kwargs):
+        budget_token = begin_budget()
+        try:
+            return logic_fn(*args, **kwargs)
+        finally:
+            end_budget(budget_token)
+    return wrapper
+
+
+def _annotate_stale_data(results, stale):
+    if stale and isinstance(results, dict):
+        stale_datasets = {}
+        stale_static_datasets = {}
+        for dataset, age_seconds in stale:
+            # Only old realtime data makes the ETAs themselves out of date; route and S2S data past its TTL is
+            # still correct in practice, so its age is reported separately without flagging the response.
+            ages = stale_datasets if dataset in REALTIME_DATASETS else stale_static_datasets
+            ages[dataset] = max(ages.get(dataset, 0), int(age_seconds))
+        if stale_datasets:
+            results["stale"] = True
+            results["data_age_seconds"] = max(stale_datasets.values())
+            results["stale_datasets"] = stale_datasets
+        if stale_static_datasets:
+            results["stale_static_datasets"] = stale_static_datasets
+    return results
+
+
+def _reports_stale_data(logic_fn):
+    # Responses built from a stale cache entry or a last-known-good fallback say so, and how old the data is.
+    if asyncio.iscoroutinefunction(logic_fn):
+        @wraps(logic_fn)
+        async def async_wrapper(*args, **kwargs):
+            stale_token = begin_stale_tracking()
+            try:
+                return _annotate_stale_data(await logic_fn(*args, **kwargs), stale_reads())
+            finally:
+                end_stale_tracking(stale_token)
+        return async_wrapper
+
+    @wraps(logic_fn)
+    def wrapper(*args, **kwargs):
+        stale_token = begin_stale_tracking()
+        try:
+            return _annotate_stale_data(logic_fn(*args, **kwargs), stale_reads())
+        finally:
+            end_stale_tracking(stale_token)
+    return wrapper
+
+
+def _new_bus_info_results():
+    return {
         "bus_details": None,
         "upcoming_stops": [],
         "message": None,
         "error": None
     }
-    access_token = get_tdx_access_token()
-    if not access_token:
-        results["error"] = "無法獲取 TDX 存取權杖。"
-        return results
 
-    current_bus_info_tdx = None
-    if route_name_param and target_plate:
-        api_url_realtime = f"{TDX_API_BASE_URL}/v2/Bus/RealTimeNearStop/Streaming/InterCity/{route_name_param}"
-        params_realtime = {'$filter': f"PlateNumb eq '{target_plate}'", '$format': 'JSON'}
-        realtime_data_list, error_rt = fetch_tdx_data_with_token(api_url_realtime, access_token, params=params_realtime)
 
-        if error_rt is not None:
-            results["error"] = f"TDX API 錯誤 (代碼: {error_rt}) (查詢公車即時資訊時)。"
-            if error_rt == 429: results["error"] = "TDX API 請求過於頻繁 (查詢公車即時資訊時)。"
-            return results
-        
-        if isinstance(realtime_data_list, list):
-            for bus_rt_data in realtime_data_list:
-                if direction_param is None or bus_rt_data.get('Direction') == direction_param:
-                    current_bus_info_tdx = bus_rt_data
-                    break 
-            if not current_bus_info_tdx and realtime_data_list:
-                 current_bus_info_tdx = realtime_data_list[0]
+class _CompletedCall():
+    def __init__(self, value):
+        self.value = value
 
-    if not current_bus_info_tdx:
-        results["error"] = f"TDX 資料中找不到車牌為 {target_plate} 的公車即時資訊。"
-        return results
+    def result(self):
+        return self.value
 
-    bus_plate_numb = current_bus_info_tdx.get('PlateNumb')
-    bus_route_name_from_tdx = current_bus_info_tdx.get('RouteName', {}).get('Zh_tw', route_name_param or 'N/A')
-    bus_sub_route_name_from_tdx = current_bus_info_tdx.get('SubRouteName', {}).get('Zh_tw', bus_route_name_from_tdx)
-    bus_direction = current_bus_info_tdx.get('Direction')
-    bus_route_uid = current_bus_info_tdx.get('RouteUID')
-    bus_sub_route_uid = current_bus_info_tdx.get('SubRouteUID')
 
-    if direction_param is not None and bus_direction != direction_param:
-        app.logger.warning(f"Bus {target_plate} reported direction {bus_direction} differs from requested {direction_param}. Proceeding with bus's reported direction.")
+def _select_realtime_bus(realtime_data_list, direction_param):
+    current_bus_info_tdx = None
+    if isinstance(realtime_data_list, list):
+        for bus_rt_data in realtime_data_list:
+            if direction_param is None or bus_rt_data.get('Direction') == direction_param:
+                current_bus_info_tdx = bus_rt_data
+                break 
+        if not current_bus_info_tdx and realtime_data_list:
+             current_bus_info_tdx = realtime_data_list[0]
+    return current_bus_info_tdx
 
-    results["bus_details"] = {
-        "plate_numb": bus_plate_numb,
-        "route_name": bus_sub_route_name_from_tdx,
-        "direction": '返程' if bus_direction == 1 else '去程' if bus_direction == 0 else 'N/A',
-        "current_stop_name": current_bus_info_tdx.get('StopName', {}).get('Zh_tw', '未知'),
-        "current_stop_sequence": current_bus_info_tdx.get('StopSequence', 'N/A'),
-        "gps_time": current_bus_info_tdx.get('GPSTime')
-    }
-    
-    api_url_stops = f"{TDX_API_BASE_URL}/v2/Bus/StopOfRoute/InterCity/{route_name_param}" 
-    stops_of_route_data_full, error_stops = fetch_tdx_data_with_token(api_url_stops, access_token, params={'$format': 'JSON'})
 
-    if error_stops is not None:
-        results["error"] = f"TDX API 錯誤 (代碼: {error_stops})。"
-        if error_stops == 429: results["error"] = "TDX API 請求過於頻繁。"
-        return results
+def _bus_route_name_and_direction(current_bus_info_tdx, route_name_param):
+    bus_route_name_from_tdx = current_bus_info_tdx.get('RouteName', {}).get('Zh_tw', route_name_param or 'N/A')
+    return bus_route_name_from_tdx, current_bus_info_tdx.get('Direction')
+
 
+def _select_route_variant(stops_of_route_data_full, bus_route_uid, bus_sub_route_uid, bus_sub_route_name_from_tdx, bus_direction):
     route_specific_stops_data = None
     selected_variant_route_uid_for_s2s = None
     selected_variant_sub_route_uid_for_s2s = None
@@ -88,62 +263,42 @@ def get_bus_stop_info_logic(target_plate, route_name_param=None, direction_param
     if stops_of_route_data_full and isinstance(stops_of_route_data_full, list):
         if bus_sub_route_uid and bus_sub_route_uid != bus_route_uid:
             for route_variant in stops_of_route_data_full:
-                if route_variant.get('SubRouteUID') == bus_sub_route_uid and route_variant.get('Direction') == bus_direction:
-                    route_specific_stops_data = route_variant.get('Stops', [])
-                    selected_variant_route_uid_for_s2s = route_variant.get('RouteUID')
-                    selected_variant_sub_route_uid_for_s2s = route_variant.get('SubRouteUID')
+                if route_variant.sub_route_uid == bus_sub_route_uid and route_variant.direction == bus_direction:
+                    route_specific_stops_data = route_variant.stops
+                    selected_variant_route_uid_for_s2s = route_variant.route_uid
+                    selected_variant_sub_route_uid_for_s2s = route_variant.sub_route_uid
                     break
         
         if not route_specific_stops_data:
             for route_variant in stops_of_route_data_full:
-                if route_variant.get('RouteUID') == bus_route_uid and route_variant.get('Direction') == bus_direction:
-                    tdx_variant_sub_route_name = route_variant.get('SubRouteName',{}).get('Zh_tw')
+                if route_variant.route_uid == bus_route_uid and route_variant.direction == bus_direction:
+                    tdx_variant_sub_route_name = route_variant.sub_route_name
                     if bus_sub_route_uid == bus_route_uid and tdx_variant_sub_route_name and bus_sub_route_name_from_tdx != tdx_variant_sub_route_name:
                         continue
 
-                    route_specific_stops_data = route_variant.get('Stops', [])
-                    selected_variant_route_uid_for_s2s = route_variant.get('RouteUID')
-                    selected_variant_sub_route_uid_for_s2s = route_variant.get('SubRouteUID')
+                    route_specific_stops_data = route_variant.stops
+                    selected_variant_route_uid_for_s2s = route_variant.route_uid
+                    selected_variant_sub_route_uid_for_s2s = route_variant.sub_route_uid
                     break
 
         if not route_specific_stops_data:
             for route_variant in stops_of_route_data_full:
-                if route_variant.get('Direction') == bus_direction:
-                    route_specific_stops_data = route_variant.get('Stops', [])
-                    selected_variant_route_uid_for_s2s = route_variant.get('RouteUID')
-                    selected_variant_sub_route_uid_for_s2s = route_variant.get('SubRouteUID')
+                if route_variant.direction == bus_direction:
+                    route_specific_stops_data = route_variant.stops
+                    selected_variant_route_uid_for_s2s = route_variant.route_uid
+                    selected_variant_sub_route_uid_for_s2s = route_variant.sub_route_uid
                     break
     
-    if not route_specific_stops_data:
-        results["error"] = f"無法從 TDX 獲取路線 {bus_sub_route_name_from_tdx} (UID: {bus_route_uid}/{bus_sub_route_uid}) 方向 {bus_direction} 的精確站序資料。"
-        return results
-
-    api_url_eta = f"{TDX_API_BASE_URL}/v2/Bus/EstimatedTimeOfArrival/Streaming/InterCity/{bus_route_name_from_tdx}"
-    params_eta = {'$filter': f"PlateNumb eq '{target_plate}' and Direction eq {bus_direction}", '$format': 'JSON'}
-    eta_data_list_for_bus, error_eta = fetch_tdx_data_with_token(api_url_eta, access_token, params=params_eta)
-
-    if error_eta is not None:
-        if error_eta == 429 : results["message"] = ((results.get("message") or "") + " 注意: 預估到站API請求頻繁; ").strip()
-        eta_data_list_for_bus = None
+    return route_specific_stops_data, selected_variant_route_uid_for_s2s, selected_variant_sub_route_uid_for_s2s
 
-    if eta_data_list_for_bus and not isinstance(eta_data_list_for_bus, list):
-        eta_data_list_for_bus = None
 
+def _select_s2s_entry(s2s_data_list_full, selected_variant_route_uid_for_s2s, selected_variant_sub_route_uid_for_s2s, bus_direction):
     s2s_data_for_route_direction = None
-    api_url_s2s = f"{TDX_API_BASE_URL}/v2/Bus/S2STravelTime/InterCity/{route_name_param}" 
-    s2s_data_list_full, error_s2s = fetch_tdx_data_with_token(api_url_s2s, access_token, params={'$format': 'JSON'})
-
-    if error_s2s is not None:
-        message_addon = ""
-        if error_s2s == 429: message_addon = " 注意: S2S資料API請求頻繁; "
-        results["message"] = ((results.get("message") or "") + message_addon).strip()
-        s2s_data_list_full = None
-    
     if isinstance(s2s_data_list_full, list):
         for s2s_entry in s2s_data_list_full:
-            s2s_matches_route_uid = s2s_entry.get('RouteUID') == selected_variant_route_uid_for_s2s
-            s2s_matches_sub_route_uid = s2s_entry.get('SubRouteUID') == selected_variant_sub_route_uid_for_s2s
-            s2s_matches_direction = s2s_entry.get('Direction') == bus_direction
+            s2s_matches_route_uid = s2s_entry.route_uid == selected_variant_route_uid_for_s2s
+            s2s_matches_sub_route_uid = s2s_entry.sub_route_uid == selected_variant_sub_route_uid_for_s2s
+            s2s_matches_direction = s2s_entry.direction == bus_direction
 
             if selected_variant_sub_route_uid_for_s2s and \
                selected_variant_sub_route_uid_for_s2s != selected_variant_route_uid_for_s2s and \
@@ -153,142 +308,123 @@ def get_bus_stop_info_logic(target_plate, route_name_param=None, direction_param
             elif s2s_matches_route_uid and s2s_matches_sub_route_uid and s2s_matches_direction:
                 s2s_data_for_route_direction = s2s_entry
                 break
-        
-        if not s2s_data_for_route_direction and s2s_data_list_full:
-            pass
+
+    return s2s_data_for_route_direction
+
+
+@lru_cache(maxsize=4096)
+def _parse_tdx_datetime(value):
+    # ETA entries for one bus usually share a single DataTime string, so most lookups are cache hits.
+    return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S%z")
+
+
+def _build_upcoming_stops(results, route_name_param, bus_direction, route_specific_stops_data,
+                          selected_variant_route_uid_for_s2s, selected_variant_sub_route_uid_for_s2s,
+                          eta_data_list_for_bus, s2s_data_list_full, s2s_data_for_route_direction,
+                          s2s_unavailable_status="無法預估 (S2S API失敗)"):
+    route_index = get_route_index(
+        (route_name_param, selected_variant_route_uid_for_s2s, selected_variant_sub_route_uid_for_s2s, bus_direction),
+        route_specific_stops_data, s2s_data_for_route_direction
+    )
+    eta_by_stop_id = index_eta_by_stop_id(eta_data_list_for_bus)
 
     actual_current_stop_sequence = -1
     if results["bus_details"]["current_stop_name"] != '未知':
-        for idx, stop_obj in enumerate(route_specific_stops_data):
-            if stop_obj.get('StopName',{}).get('Zh_tw') == results["bus_details"]["current_stop_name"]:
-                actual_current_stop_sequence = stop_obj.get('StopSequence', idx)
-                results["bus_details"]["current_stop_sequence"] = actual_current_stop_sequence
-                break
-    
-    if actual_current_stop_sequence == -1 and isinstance(results["bus_details"]["current_stop_sequence"], str) :
-         pass
-
+        matched_sequence = route_index.sequence_by_stop_name.get(results["bus_details"]["current_stop_name"])
+        if matched_sequence is not None:
+            actual_current_stop_sequence = matched_sequence
+            results["bus_details"]["current_stop_sequence"] = actual_current_stop_sequence
 
     stops_found = False
     current_bus_time = None
     if results["bus_details"]["gps_time"]:
         try:
-            current_bus_time = datetime.strptime(results["bus_details"]["gps_time"], "%Y-%m-%dT%H:%M:%S%z")
+            current_bus_time = _parse_tdx_datetime(results["bus_details"]["gps_time"])
         except ValueError:
             pass
 
+    s2s_bucket = None
+    s2s_seconds_by_sequence = {}
+    if current_bus_time and s2s_data_for_route_direction:
+        s2s_bucket = route_index.s2s_bucket_for(current_bus_time.weekday(), current_bus_time.hour)
+        if s2s_bucket is not None:
+            s2s_seconds_by_sequence = route_index.travel_seconds_from(s2s_bucket, actual_current_stop_sequence)
+    # Built on first use: S2S run times with the gaps filled from travel times learned from observed buses.
+    learned_seconds_by_sequence = None
+
     for stop_in_route in route_specific_stops_data:
-        stop_sequence_tdx = stop_in_route.get('StopSequence')
+        stop_sequence_tdx = stop_in_route.sequence
         if isinstance(actual_current_stop_sequence, int) and actual_current_stop_sequence != -1 and \
            stop_sequence_tdx <= actual_current_stop_sequence:
             continue
         stops_found = True
 
-        stop_id_tdx = stop_in_route.get('StopID')
-        stop_name_tdx = stop_in_route.get('StopName', {}).get('Zh_tw', '未知站名')
+        stop_id_tdx = stop_in_route.stop_id
+        stop_name_tdx = stop_in_route.name if stop_in_route.name is not None else '未知站名'
         status = "未知 (TDX)"
 
-        stop_eta_found_in_list = False 
-        if eta_data_list_for_bus and isinstance(eta_data_list_for_bus, list):
-            for eta_entry in eta_data_list_for_bus:
-                if eta_entry.get('StopID') == stop_id_tdx:
-                    stop_eta_found_in_list = True
-                    estimate_time_seconds = eta_entry.get('EstimateTime')
-                    if estimate_time_seconds is not None:
-                        if estimate_time_seconds < 0:
-                            if estimate_time_seconds == -1: status = "尚未發車 (TDX)"
-                            elif estimate_time_seconds == -2: status = "交管不停靠 (TDX)"
-                            elif estimate_time_seconds == -3: status = "末班車已過 (TDX)"
-                            elif estimate_time_seconds == -4: status = "今日未營運 (TDX)"
-                            else: status = f"狀態 {estimate_time_seconds} (TDX)"
-                        else:
-                            data_time_str = eta_entry.get('DataTime')
-                            if data_time_str:
-                                try:
-                                    base_dt = datetime.strptime(data_time_str, "%Y-%m-%dT%H:%M:%S%z")
-                                    arrival_dt = base_dt + timedelta(seconds=estimate_time_seconds)
-                                    status = arrival_dt.strftime("%H:%M:%S") + " (動態資料)"
-                                except ValueError:
-                                    status = f"{estimate_time_seconds // 60}分{estimate_time_seconds % 60}秒 (TDX Raw)"
-                            else:
-                                status = f"{estimate_time_seconds // 60}分{estimate_time_seconds % 60}秒 (TDX Raw)"
-                    elif eta_entry.get('NextBusTime'):
+        eta_entry = eta_by_stop_id.get(stop_id_tdx)
+        if eta_entry is not None:
+            estimate_time_seconds = eta_entry.get('EstimateTime')
+            if estimate_time_seconds is not None:
+                if estimate_time_seconds < 0:
+                    if estimate_time_seconds == -1: status = "尚未發車 (TDX)"
+                    elif estimate_time_seconds == -2: status = "交管不停靠 (TDX)"
+                    elif estimate_time_seconds == -3: status = "末班車已過 (TDX)"
+                    elif estimate_time_seconds == -4: status = "今日未營運 (TDX)"
+                    else: status = f"狀態 {estimate_time_seconds} (TDX)"
+                else:
+                    data_time_str = eta_entry.get('DataTime')
+                    if data_time_str:
                         try:
-                            next_bus_dt = datetime.strptime(eta_entry.get('NextBusTime'), "%Y-%m-%dT%H:%M:%S%z")
-                            status = next_bus_dt.strftime("%H:%M:%S") + " (TDX NextBusTime)"
-                        except (ValueError, TypeError):
-                            status = "時間格式錯誤 (TDX NextBusTime)"
+                            base_dt = _parse_tdx_datetime(data_time_str)
+                            arrival_dt = base_dt + timedelta(seconds=estimate_time_seconds)
+                            status = arrival_dt.strftime("%H:%M:%S") + " (動態資料)"
+                        except ValueError:
+                            status = f"{estimate_time_seconds // 60}分{estimate_time_seconds % 60}秒 (TDX Raw)"
                     else:
-                        status = "API未提供預估秒數 (TDX)"
-                    break
-        
-        if not stop_eta_found_in_list and eta_data_list_for_bus:
-            pass
+                        status = f"{estimate_time_seconds // 60}分{estimate_time_seconds % 60}秒 (TDX Raw)"
+            elif eta_entry.get('NextBusTime'):
+                try:
+                    next_bus_dt = _parse_tdx_datetime(eta_entry.get('NextBusTime'))
+                    status = next_bus_dt.strftime("%H:%M:%S") + " (TDX NextBusTime)"
+                except (ValueError, TypeError):
+                    status = "時間格式錯誤 (TDX NextBusTime)"
+            else:
+                status = "API未提供預估秒數 (TDX)"
 
         if status in ["未知 (TDX)", "API未提供預估秒數 (TDX)"]:
             if s2s_data_list_full is None:
-                status = "無法預估 (S2S API失敗)"
+                status = s2s_unavailable_status
             elif not s2s_data_for_route_direction:
                 status = "無法預估 (S2S無適用路線資料)"
             elif not current_bus_time:
                 status = "無法預估 (缺公車GPS時間)"
             elif not (isinstance(actual_current_stop_sequence, int) and actual_current_stop_sequence != -1):
                 status = "無法預估 (未知目前站序)"
+            elif not s2s_data_for_route_direction.travel_times:
+                status = "無法預估 (S2S資料缺失TravelTimes)"
+            elif s2s_bucket is None:
+                status = "無法預估 (S2S無適用時段)"
             else:
-                s2s_applicable_times_collection = None
-
-                if s2s_data_for_route_direction.get('TravelTimes') and isinstance(s2s_data_for_route_direction['TravelTimes'], list):
-                    bus_weekday = current_bus_time.weekday()
-                    bus_hour = current_bus_time.hour
-
-                    for time_segment in s2s_data_for_route_direction['TravelTimes']:
-                        segment_weekday = time_segment.get('Weekday')
-                        segment_start_hour = time_segment.get('StartHour')
-                        segment_end_hour = time_segment.get('EndHour')
-
-                        if (segment_weekday is not None and
-                            segment_start_hour is not None and
-                            segment_end_hour is not None and
-                            segment_weekday == bus_weekday and
-                            segment_start_hour <= bus_hour < segment_end_hour):
-                            s2s_applicable_times_collection = time_segment.get('S2STimes')
-                            break
-                
-                if not isinstance(s2s_applicable_times_collection, list):
-                    if not s2s_data_for_route_direction.get('TravelTimes'):
-                        status = "無法預估 (S2S資料缺失TravelTimes)"
-                    elif s2s_data_for_route_direction.get('TravelTimes') and not s2s_applicable_times_collection:
-                         status = "無法預估 (S2S無適用時段)"
-                else :
-                    calculation_possible = True
-                    cumulative_s2s_time = 0 
-                    for i in range(actual_current_stop_sequence, stop_sequence_tdx):
-                        from_stop_obj_s2s = next((s for s in route_specific_stops_data if s.get('StopSequence') == i), None)
-                        to_stop_obj_s2s = next((s for s in route_specific_stops_data if s.get('StopSequence') == i + 1), None)
-
-                        if not from_stop_obj_s2s or not to_stop_obj_s2s:
-                            calculation_possible = False
-                            break
-                        
-                        from_stop_id_calc_s2s = from_stop_obj_s2s.get('StopID')
-                        to_stop_id_calc_s2s = to_stop_obj_s2s.get('StopID')
-
-                        segment_time_info_s2s = next((
-                            t for t in s2s_applicable_times_collection
-                            if t.get('FromStopID') == from_stop_id_calc_s2s and t.get('ToStopID') == to_stop_id_calc_s2s
-                        ), None)
-                        
-                        if segment_time_info_s2s and segment_time_info_s2s.get('RunTime', -1) >= 0:
-                            cumulative_s2s_time += segment_time_info_s2s.get('RunTime')
-                        else:
-                            calculation_possible = False
-                            break
-                
-                if calculation_possible:
+                cumulative_s2s_time = s2s_seconds_by_sequence.get(stop_sequence_tdx)
+                if cumulative_s2s_time is not None:
                     estimated_time_s2s = current_bus_time + timedelta(seconds=cumulative_s2s_time)
                     status = estimated_time_s2s.strftime("%H:%M:%S") + " (歷史數據計算)"
-                elif not calculation_possible:
+                else:
                     status = "無法預估 (缺少站間路程資料)"
+
+            if status.startswith("無法預估") and current_bus_time and \
+               isinstance(actual_current_stop_sequence, int) and actual_current_stop_sequence != -1:
+                if learned_seconds_by_sequence is None:
+                    learned_seconds_by_sequence = route_index.travel_seconds_with_fallback(
+                        s2s_bucket, actual_current_stop_sequence,
+                        partial(learned_segment_seconds, current_bus_time)
+                    )
+                cumulative_learned_time = learned_seconds_by_sequence.get(stop_sequence_tdx)
+                if cumulative_learned_time is not None:
+                    estimated_time_learned = current_bus_time + timedelta(seconds=cumulative_learned_time)
+                    status = estimated_time_learned.strftime("%H:%M:%S") + " (行車紀錄推估)"
         
         results["upcoming_stops"].append({
             "stop_sequence": stop_sequence_tdx,
@@ -304,16 +440,291 @@ def get_bus_stop_info_logic(target_plate, route_name_param=None, direction_param
     return results
 
 
+def _assemble_bus_stop_info(target_plate, route_name_param, direction_param, realtime_call, stops_call, s2s_call, eta_call_for):
+    results = _new_bus_info_results()
+
+    current_bus_info_tdx = None
+    if route_name_param and target_plate:
+        realtime_data_list, error_rt = realtime_call.result()
+
+        if error_rt is not None:
+            results["error"] = f"TDX API 錯誤 (代碼: {error_rt}) (查詢公車即時資訊時)。"
+            if error_rt == 429: results["error"] = "TDX API 請求過於頻繁 (查詢公車即時資訊時)。"
+            return results
+
+        current_bus_info_tdx = _select_realtime_bus(realtime_data_list, direction_param)
+
+    if not current_bus_info_tdx:
+        results["error"] = f"TDX 資料中找不到車牌為 {target_plate} 的公車即時資訊。"
+        return results
+    observe_bus_positions([current_bus_info_tdx])
+
+    bus_plate_numb = current_bus_info_tdx.get('PlateNumb')
+    bus_route_name_from_tdx, bus_direction = _bus_route_name_and_direction(current_bus_info_tdx, route_name_param)
+    bus_sub_route_name_from_tdx = current_bus_info_tdx.get('SubRouteName', {}).get('Zh_tw', bus_route_name_from_tdx)
+    bus_route_uid = current_bus_info_tdx.get('RouteUID')
+    bus_sub_route_uid = current_bus_info_tdx.get('SubRouteUID')
+
+    if direction_param is not None and bus_direction != direction_param:
+        app.logger.warning(f"Bus {target_plate} reported direction {bus_direction} differs from requested {direction_param}. Proceeding with bus's reported direction.")
+
+    results["bus_details"] = {
+        "plate_numb": bus_plate_numb,
+        "route_name": bus_sub_route_name_from_tdx,
+        "direction": '返程' if bus_direction == 1 else '去程' if bus_direction == 0 else 'N/A',
+        "current_stop_name": current_bus_info_tdx.get('StopName', {}).get('Zh_tw', '未知'),
+        "current_stop_sequence": current_bus_info_tdx.get('StopSequence', 'N/A'),
+        "gps_time": current_bus_info_tdx.get('GPSTime')
+    }
+    
+    stops_of_route_data_full, error_stops = stops_call.result()
+
+    if error_stops is not None:
+        results["error"] = f"TDX API 錯誤 (代碼: {error_stops})。"
+        if error_stops == 429: results["error"] = "TDX API 請求過於頻繁。"
+        return results
+
+    route_specific_stops_data, selected_variant_route_uid_for_s2s, selected_variant_sub_route_uid_for_s2s = _select_route_variant(
+        stops_of_route_data_full, bus_route_uid, bus_sub_route_uid, bus_sub_route_name_from_tdx, bus_direction
+    )
+    
+    if not route_specific_stops_data:
+        results["error"] = f"無法從 TDX 獲取路線 {bus_sub_route_name_from_tdx} (UID: {bus_route_uid}/{bus_sub_route_uid}) 方向 {bus_direction} 的精確站序資料。"
+        return results
+
+    eta_data_list_for_bus, error_eta = _optional_stage_result(eta_call_for(bus_route_name_from_tdx, bus_direction))
+
+    if error_eta is not None:
+        if error_eta == 429 : results["message"] = ((results.get("message") or "") + " 注意: 預估到站API請求頻繁; ").strip()
+        if error_eta == DEADLINE_EXCEEDED:
+            results["message"] = ((results.get("message") or "") + " 注意: 回應時間不足，已略過即時預估到站資料; ").strip()
+            results.setdefault("degraded_stages", []).append("eta")
+        eta_data_list_for_bus = None
+
+    if eta_data_list_for_bus and not isinstance(eta_data_list_for_bus, list):
+        eta_data_list_for_bus = None
+
+    s2s_data_list_full, error_s2s = _optional_stage_result(s2s_call)
+
+    s2s_unavailable_status = "無法預估 (S2S API失敗)"
+    if error_s2s is not None:
+        message_addon = ""
+        if error_s2s == 429: message_addon = " 注意: S2S資料API請求頻繁; "
+        if error_s2s == DEADLINE_EXCEEDED:
+            message_addon = " 注意: 回應時間不足，已略過歷史數據推估; "
+            s2s_unavailable_status = "無法預估 (回應時間不足)"
+            results.setdefault("degraded_stages", []).append("s2s")
+        results["message"] = ((results.get("message") or "") + message_addon).strip()
+        s2s_data_list_full = None
+
+    s2s_data_for_route_direction = _select_s2s_entry(
+        s2s_data_list_full, selected_variant_route_uid_for_s2s, selected_variant_sub_route_uid_for_s2s, bus_direction
+    )
+
+    with timed('upcoming_stops'):
+        return _build_upcoming_stops(
+            results, route_name_param, bus_direction, route_specific_stops_data,
+            selected_variant_route_uid_for_s2s, selected_variant_sub_route_uid_for_s2s,
+            eta_data_list_for_bus, s2s_data_list_full, s2s_data_for_route_direction, s2s_unavailable_status
+        )
+
+
+def _tdx_route_dataset_url(dataset, route_name):
+    return f"{TDX_API_BASE_URL}/v2/Bus/{dataset}/InterCity/{route_name}"
+
+
+@_reports_stale_data
+@_with_request_budget
+def get_bus_stop_info_logic(target_plate, route_name_param=None, direction_param=None):
+    access_token = get_tdx_access_token()
+    if not access_token:
+        results = _new_bus_info_results()
+        results["error"] = "無法獲取 TDX 存取權杖。"
+        return results
+
+    # StopOfRoute and S2S only depend on the requested route, and the ETA call is issued
+    # speculatively with the client's route/direction; all three overlap the realtime call.
+    stops_future = _submit_fetch(fetch_tdx_data_cached, _tdx_route_dataset_url('StopOfRoute', route_name_param), access_token, params={'$format': 'JSON'}, parse=parse_stop_of_route)
+    s2s_future = _submit_fetch(fetch_tdx_data_cached, _tdx_route_dataset_url('S2STravelTime', route_name_param), access_token, params={'$format': 'JSON'}, decode=decode_s2s_travel_time)
+    eta_future = None
+    if route_name_param and target_plate and direction_param is not None:
+        eta_future = _submit_fetch(_fetch_eta_for_bus, route_name_param, target_plate, direction_param, access_token)
+
+    params_realtime = {'$filter': f"PlateNumb eq '{target_plate}'", '$format': 'JSON'}
+    realtime_call = _DeferredCall(_fetch_realtime, (route_name_param, access_token, params_realtime, {'PlateNumb': target_plate}), {})
+
+    def eta_call_for(bus_route_name_from_tdx, bus_direction):
+        if eta_future is not None and bus_route_name_from_tdx == route_name_param and bus_direction == direction_param:
+            return eta_future
+        return _DeferredCall(_fetch_eta_for_bus, (bus_route_name_from_tdx, target_plate, bus_direction, access_token), {})
+
+    return _assemble_bus_stop_info(target_plate, route_name_param, direction_param, realtime_call, stops_future, s2s_future, eta_call_for)
+
+
+@_reports_stale_data
+@_with_request_budget
+async def get_bus_stop_info_logic_async(target_plate, route_name_param=None, direction_param=None):
+    access_token = await asyncio.to_thread(get_tdx_access_token)
+    if not access_token:
+        results = _new_bus_info_results()
+        results["error"] = "無法獲取 TDX 存取權杖。"
+        return results
+
+    has_realtime_query = bool(route_name_param and target_plate)
+    speculative_eta = has_realtime_query and direction_param is not None
+    params_realtime = {'$filter': f"PlateNumb eq '{target_plate}'", '$format': 'JSON'}
+    realtime_result, stops_result, s2s_result, speculative_eta_result = await asyncio.gather(
+        _fetch_realtime_async(route_name_param, access_token, params_realtime, {'PlateNumb': target_plate}) if has_realtime_query else _no_fetch(),
+        fetch_tdx_data_cached_async(_tdx_route_dataset_url('StopOfRoute', route_name_param), access_token, params={'$format': 'JSON'}, parse=parse_stop_of_route),
+        _optional_stage_async(fetch_tdx_data_cached_async(_tdx_route_dataset_url('S2STravelTime', route_name_param), access_token, params={'$format': 'JSON'}, decode=decode_s2s_travel_time)),
+        _optional_stage_async(_fetch_eta_for_bus_async(route_name_param, target_plate, direction_param, access_token)) if speculative_eta else _no_fetch(),
+    )
+
+    eta_results = {}
+    if speculative_eta:
+        eta_results[(route_name_param, direction_param)] = speculative_eta_result
+    if realtime_result is not None and realtime_result[1] is None:
+        current_bus_info_tdx = _select_realtime_bus(realtime_result[0], direction_param)
+        if current_bus_info_tdx:
+            bus_route_key = _bus_route_name_and_direction(current_bus_info_tdx, route_name_param)
+            if bus_route_key not in eta_results:
+                eta_results[bus_route_key] = await _optional_stage_async(_fetch_eta_for_bus_async(bus_route_key[0], target_plate, bus_route_key[1], access_token))
+
+    return _assemble_bus_stop_info(
+        target_plate, route_name_param, direction_param,
+        _CompletedCall(realtime_result), _CompletedCall(stops_result), _CompletedCall(s2s_result),
+        lambda bus_route_name_from_tdx, bus_direction: _CompletedCall(eta_results[(bus_route_name_from_tdx, bus_direction)])
+    )
+
+
+def _assemble_route_buses_info(route_name_param, direction_param, realtime_call, stops_call, s2s_call, route_eta_call):
+    results = {
+        "route_name": route_name_param,
+        "direction": direction_param,
+        "buses": [],
+        "message": None,
+        "error": None
+    }
+
+    realtime_data_list, error_rt = realtime_call.result()
+    if error_rt is not None:
+        results["error"] = f"TDX API 錯誤 (代碼: {error_rt}) (查詢公車即時資訊時)。"
+        if error_rt == 429: results["error"] = "TDX API 請求過於頻繁 (查詢公車即時資訊時)。"
+        return results
+
+    realtime_by_plate = {}
+    if isinstance(realtime_data_list, list):
+        for bus in realtime_data_list:
+            if not isinstance(bus, dict): continue
+            bus_plate = bus.get("PlateNumb")
+            if not bus_plate or bus_plate == "-1": continue
+            if bus.get('BusStatus') in [3, 4]: continue
+            realtime_by_plate.setdefault(bus_plate, []).append(bus)
+
+    if not realtime_by_plate:
+        results["message"] = f"路線 '{route_name_param}' 目前沒有公車在線上 (TDX)。"
+        return results
+
+    # Route-level payloads are fetched once and shared by every bus below.
+    stops_result = stops_call.result()
+    s2s_result = _optional_stage_result(s2s_call)
+    route_eta_data, error_eta = _optional_stage_result(route_eta_call)
+    eta_by_plate_direction = {}
+    if error_eta is None and isinstance(route_eta_data, list):
+        for eta_entry in route_eta_data:
+            eta_by_plate_direction.setdefault((eta_entry.get('PlateNumb'), eta_entry.get('Direction')), []).append(eta_entry)
+
+    for bus_plate, bus_realtime_entries in realtime_by_plate.items():
+        def eta_call_for(bus_route_name_from_tdx, bus_direction, bus_plate=bus_plate):
+            if error_eta is not None:
+                return _CompletedCall((None, error_eta))
+            return _CompletedCall((eta_by_plate_direction.get((bus_plate, bus_direction), []), None))
+
+        results["buses"].append(_assemble_bus_stop_info(
+            bus_plate, route_name_param, direction_param,
+            _CompletedCall((bus_realtime_entries, None)), _CompletedCall(stops_result), _CompletedCall(s2s_result), eta_call_for
+        ))
+    return results
+
+
+@_reports_stale_data
+@_with_request_budget
+def get_route_buses_info_logic(route_name_param, direction_param):
+    access_token = get_tdx_access_token()
+    if not access_token:
+        return {"route_name": route_name_param, "direction": direction_param, "buses": [], "message": None, "error": "無法獲取 TDX 存取權杖。"}
+
+    stops_future = _submit_fetch(fetch_tdx_data_cached, _tdx_route_dataset_url('StopOfRoute', route_name_param), access_token, params={'$format': 'JSON'}, parse=parse_stop_of_route)
+    s2s_future = _submit_fetch(fetch_tdx_data_cached, _tdx_route_dataset_url('S2STravelTime', route_name_param), access_token, params={'$format': 'JSON'}, decode=decode_s2s_travel_time)
+    route_eta_future = _submit_fetch(_fetch_route_eta, route_name_param, direction_param, access_token)
+    params_realtime = {'$filter': f"Direction eq {direction_param}", '$format': 'JSON'}
+    realtime_call = _DeferredCall(_fetch_realtime, (route_name_param, access_token, params_realtime, {'Direction': direction_param}), {})
+
+    return _assemble_route_buses_info(route_name_param, direction_param, realtime_call, stops_future, s2s_future, route_eta_future)
+
+
+@_reports_stale_data
+@_with_request_budget
+async def get_route_buses_info_logic_async(route_name_param, direction_param):
+    access_token = await asyncio.to_thread(get_tdx_access_token)
+    if not access_token:
+        return {"route_name": route_name_param, "direction": direction_param, "buses": [], "message": None, "error": "無法獲取 TDX 存取權杖。"}
+
+    params_realtime = {'$filter': f"Direction eq {direction_param}", '$format': 'JSON'}
+    realtime_result, stops_result, s2s_result, route_eta_result = await asyncio.gather(
+        _fetch_realtime_async(route_name_param, access_token, params_realtime, {'Direction': direction_param}),
+        fetch_tdx_data_cached_async(_tdx_route_dataset_url('StopOfRoute', route_name_param), access_token, params={'$format': 'JSON'}, parse=parse_stop_of_route),
+        _optional_stage_async(fetch_tdx_data_cached_async(_tdx_route_dataset_url('S2STravelTime', route_name_param), access_token, params={'$format': 'JSON'}, decode=decode_s2s_travel_time)),
+        _optional_stage_async(_fetch_route_eta_async(route_name_param, direction_param, access_token)),
+    )
+    return _assemble_route_buses_info(
+        route_name_param, direction_param,
+        _CompletedCall(realtime_result), _CompletedCall(stops_result), _CompletedCall(s2s_result), _CompletedCall(route_eta_result)
+    )
+
+
+def _search_route_catalogue(route_keyword):
+    if _route_catalogue is None:
+        return None
+    catalogue_matches = _route_catalogue.search(route_keyword)
+    if catalogue_matches is None:
+        return None
+    return _format_available_routes(route_keyword, catalogue_matches, None, keyword_from_route_name=True)
+
+
+@_reports_stale_data
 def fetch_available_routes_logic(route_keyword):
+    catalogue_result = _search_route_catalogue(route_keyword)
+    if catalogue_result is not None:
+        return catalogue_result
+
     access_token = get_tdx_access_token()
     if not access_token:
         return {"error": "無法獲取 TDX 存取權杖。", "routes": []}
 
-    api_url = f"{TDX_API_BASE_URL}/v2/Bus/StopOfRoute/InterCity/{route_keyword}"
+    api_url = _tdx_route_dataset_url('StopOfRoute', route_keyword)
     params = {'$format': 'JSON'}
     
-    tdx_route_data, error_code = fetch_tdx_data_with_token(api_url, access_token, params=params)
+    tdx_route_data, error_code = fetch_tdx_data_cached(api_url, access_token, params=params, parse=parse_stop_of_route)
+    return _format_available_routes(route_keyword, tdx_route_data, error_code)
+
+
+@_reports_stale_data
+async def fetch_available_routes_logic_async(route_keyword):
+    catalogue_result = _search_route_catalogue(route_keyword)
+    if catalogue_result is not None:
+        return catalogue_result
 
+    access_token = await asyncio.to_thread(get_tdx_access_token)
+    if not access_token:
+        return {"error": "無法獲取 TDX 存取權杖。", "routes": []}
+
+    api_url = _tdx_route_dataset_url('StopOfRoute', route_keyword)
+    tdx_route_data, error_code = await fetch_tdx_data_cached_async(api_url, access_token, params={'$format': 'JSON'}, parse=parse_stop_of_route)
+    return _format_available_routes(route_keyword, tdx_route_data, error_code)
+
+
+def _format_available_routes(route_keyword, tdx_route_data, error_code, keyword_from_route_name=False):
     if error_code is not None:
         error_msg = f"TDX API 錯誤 (代碼: {error_code})，無法獲取 '{route_keyword}' 路線資料。"
         if error_code == 429:
@@ -330,21 +741,18 @@ def fetch_available_routes_logic(route_keyword):
         sorted_tdx_route_data = sorted(
             tdx_route_data, 
             key=lambda rv: (
-                rv.get('RouteUID', ''), 
-                rv.get('SubRouteUID', ''), 
-                rv.get('Direction', -1)
+                rv.route_uid or '', 
+                rv.sub_route_uid or '', 
+                rv.direction if rv.direction is not None else -1
             )
         )
 
         for route_variant in sorted_tdx_route_data:
-            route_name_obj = route_variant.get('RouteName', {})
-            sub_route_name_obj = route_variant.get('SubRouteName', route_name_obj) 
-
-            display_name_str = sub_route_name_obj.get('Zh_tw')
+            display_name_str = route_variant.sub_route_name
             if not display_name_str:
-                display_name_str = route_name_obj.get('Zh_tw', '未知路線')
+                display_name_str = route_variant.route_name if route_variant.route_name is not None else '未知路線'
             
-            direction = route_variant.get('Direction')
+            direction = route_variant.direction
             direction_str = '返程' if direction == 1 else '去程' if direction == 0 else '未知方向'
             
             final_display_name = f"{display_name_str} ({direction_str})"
@@ -353,11 +761,16 @@ def fetch_available_routes_logic(route_keyword):
                 continue
             seen_display_names.add(final_display_name)
             
+            # Catalogue matches may be partial, so later lookups use the route's own name instead of the typed keyword.
+            tdx_route_name_keyword = route_keyword
+            if keyword_from_route_name:
+                tdx_route_name_keyword = route_variant.route_name or route_keyword
+
             route_entry = {
                 "display_name": final_display_name,
-                "tdx_route_name_keyword": route_keyword, 
-                "sub_route_uid": route_variant.get('SubRouteUID'),
-                "route_uid": route_variant.get('RouteUID'),
+                "tdx_route_name_keyword": tdx_route_name_keyword, 
+                "sub_route_uid": route_variant.sub_route_uid,
+                "route_uid": route_variant.route_uid,
                 "direction": direction,
                 "original_name_for_matching": display_name_str 
             }
@@ -368,6 +781,7 @@ def fetch_available_routes_logic(route_keyword):
     return {"routes": available_routes_info}
 
 
+@_reports_stale_data
 def fetch_buses_for_route_logic(selected_route_params):
     access_token = get_tdx_access_token()
     if not access_token:
@@ -383,17 +797,50 @@ def fetch_buses_for_route_logic(selected_route_params):
     if direction is None: 
         return {"error": "缺少路線方向。", "buses": []}
 
-    api_url = f"{TDX_API_BASE_URL}/v2/Bus/RealTimeNearStop/Streaming/InterCity/{route_name}"
+    params, match_fields = _buses_for_route_filter(direction, route_uid_filter, sub_route_uid_filter)
+    tdx_bus_data_raw, error_code = _fetch_realtime(route_name, access_token, params, match_fields)
+    return _format_buses_for_route(selected_route_params, params, tdx_bus_data_raw, error_code)
+
+
+@_reports_stale_data
+async def fetch_buses_for_route_logic_async(selected_route_params):
+    access_token = await asyncio.to_thread(get_tdx_access_token)
+    if not access_token:
+        return {"error": "無法獲取 TDX 存取權杖。", "buses": []}
+
+    route_name = selected_route_params.get("tdx_route_name_keyword") 
+    direction = selected_route_params.get("direction")
+    if not route_name:
+        return {"error": "缺少 TDX 路線名稱關鍵字。", "buses": []}
+    if direction is None: 
+        return {"error": "缺少路線方向。", "buses": []}
+
+    params, match_fields = _buses_for_route_filter(direction, selected_route_params.get("route_uid"), selected_route_params.get("sub_route_uid"))
+    tdx_bus_data_raw, error_code = await _fetch_realtime_async(route_name, access_token, params, match_fields)
+    return _format_buses_for_route(selected_route_params, params, tdx_bus_data_raw, error_code)
+
+
+def _buses_for_route_filter(direction, route_uid_filter, sub_route_uid_filter):
     params = {'$format': 'JSON'}
     filter_parts = []
+    match_fields = {}
     if sub_route_uid_filter and sub_route_uid_filter != route_uid_filter:
         filter_parts.append(f"SubRouteUID eq '{sub_route_uid_filter}'")
+        match_fields['SubRouteUID'] = sub_route_uid_filter
     elif route_uid_filter:
         filter_parts.append(f"RouteUID eq '{route_uid_filter}'")
+        match_fields['RouteUID'] = route_uid_filter
     filter_parts.append(f"Direction eq {direction}")
+    match_fields['Direction'] = direction
     params['$filter'] = " and ".join(filter_parts)
-    
-    tdx_bus_data_raw, error_code = fetch_tdx_data_with_token(api_url, access_token, params=params)
+    return params, match_fields
+
+
+def _format_buses_for_route(selected_route_params, params, tdx_bus_data_raw, error_code):
+    route_name = selected_route_params.get("tdx_route_name_keyword") 
+    direction = selected_route_params.get("direction")
+    route_uid_filter = selected_route_params.get("route_uid")
+    sub_route_uid_filter = selected_route_params.get("sub_route_uid")
 
     if error_code is not None:
         error_msg = f"TDX API 錯誤 (代碼: {error_code})，無法獲取公車資料。"
@@ -452,67 +899,303 @@ def fetch_buses_for_route_logic(selected_route_params):
     return {"buses": buses_on_selected_route}
 
 
+def _nearby_stops_payload(matches):
+    stops = []
+    route_keys = []
+    for distance, geo_stop in matches:
+        serving_routes = []
+        for route_variant, stop_sequence in geo_stop.served_by:
+            display_name = route_variant.sub_route_name or route_variant.route_name or '未知路線'
+            direction = route_variant.direction
+            serving_routes.append({
+                "display_name": f"{display_name} ({'返程' if direction == 1 else '去程' if direction == 0 else '未知方向'})",
+                "tdx_route_name_keyword": route_variant.route_name,
+                "route_uid": route_variant.route_uid,
+                "sub_route_uid": route_variant.sub_route_uid,
+                "direction": direction,
+                "stop_sequence": stop_sequence
+            })
+            route_key = (route_variant.route_name, direction)
+            if route_variant.route_name and direction is not None and route_key not in route_keys:
+                route_keys.append(route_key)
+        stops.append({
+            "stop_id": geo_stop.stop_id,
+            "stop_name": geo_stop.name,
+            "lat": geo_stop.lat,
+            "lon": geo_stop.lon,
+            "distance_m": round(distance),
+            "routes": serving_routes
+        })
+    return stops, route_keys[:NEARBY_MAX_ROUTES]
+
+
+def _approaching_buses(matches, route_keys, eta_results):
+    stops_by_id = {geo_stop.stop_id: geo_stop for _, geo_stop in matches}
+    buses = []
+    for (route_name, direction), (eta_data, error_eta) in zip(route_keys, eta_results):
+        if error_eta is not None or not isinstance(eta_data, list):
+            continue
+        for eta_entry in eta_data:
+            geo_stop = stops_by_id.get(eta_entry.get('StopID'))
+            estimate_seconds = eta_entry.get('EstimateTime')
+            plate_numb = eta_entry.get('PlateNumb')
+            if geo_stop is None or not isinstance(estimate_seconds, int) or estimate_seconds < 0 or not plate_numb or plate_numb == "-1":
+                continue
+            buses.append({
+                "plate_numb": plate_numb,
+                "route_name": route_name,
+                "direction": direction,
+                "stop_id": geo_stop.stop_id,
+                "stop_name": geo_stop.name,
+                "estimate_seconds": estimate_seconds
+            })
+    buses.sort(key=lambda bus: bus["estimate_seconds"])
+    return buses
+
+
+def _nearby_stop_matches(lat, lon, radius):
+    if _route_catalogue is None:
+        return None, {"error": "未啟用路線目錄，無法查詢附近站點。", "stops": [], "buses": []}
+    matches = _route_catalogue.nearby_stops(lat, lon, radius, NEARBY_MAX_STOPS)
+    if matches is None:
+        return None, {"error": "路線目錄尚未載入完成，請稍後再試。", "stops": [], "buses": []}
+    if not matches and not _route_catalogue.covers(lat, lon, radius):
+        return None, {"error": "座標不在公路客運站點的涵蓋範圍內。", "stops": [], "buses": []}
+    return matches, None
+
+
+@_reports_stale_data
+def fetch_nearby_stops_logic(lat, lon, radius):
+    matches, error_payload = _nearby_stop_matches(lat, lon, radius)
+    if error_payload:
+        return error_payload
+    stops, route_keys = _nearby_stops_payload(matches)
+    if not stops:
+        return {"message": f"半徑 {radius} 公尺內沒有公車站點。", "stops": [], "buses": []}
+
+    access_token = get_tdx_access_token()
+    if not access_token:
+        return {"stops": stops, "buses": [], "message": "無法獲取 TDX 存取權杖，僅列出站點。"}
+    eta_futures = [_submit_fetch(_fetch_route_eta, route_name, direction, access_token) for route_name, direction in route_keys]
+    return {"stops": stops, "buses": _approaching_buses(matches, route_keys, [future.result() for future in eta_futures])}
+
+
+@_reports_stale_data
+async def fetch_nearby_stops_logic_async(lat, lon, radius):
+    matches, error_payload = _nearby_stop_matches(lat, lon, radius)
+    if error_payload:
+        return error_payload
+    stops, route_keys = _nearby_stops_payload(matches)
+    if not stops:
+        return {"message": f"半徑 {radius} 公尺內沒有公車站點。", "stops": [], "buses": []}
+
+    access_token = await asyncio.to_thread(get_tdx_access_token)
+    if not access_token:
+        return {"stops": stops, "buses": [], "message": "無法獲取 TDX 存取權杖，僅列出站點。"}
+    eta_results = await asyncio.gather(*(_fetch_route_eta_async(route_name, direction, access_token) for route_name, direction in route_keys))
+    return {"stops": stops, "buses": _approaching_buses(matches, route_keys, eta_results)}
+
+
+def _compute_bus_stop_info_for_stream(plate_numb, route_name, direction):
+    return get_bus_stop_info_logic(plate_numb, route_name_param=route_name, direction_param=direction)
+
+
+eta_stream_hub = EtaStreamHub(_compute_bus_stop_info_for_stream)
+_stream_slots = threading.BoundedSemaphore(ETA_STREAM_MAX_STREAMS)
+
+SSE_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+
+@app.before_request
+def _begin_request_timing():
+    g.request_started = time.perf_counter()
+    g.request_spans_token = begin_request()
+
+
+@app.after_request
+def _add_server_timing(response):
+    if request.path.startswith('/api/'):
+        elapsed = time.perf_counter() - g.request_started
+        observe_request(request.url_rule.rule if request.url_rule else 'unmatched', response.status_code, elapsed)
+        response.headers['Server-Timing'] = server_timing_header(request_spans(), elapsed)
+    return response
+
+
+@app.after_request
+def _conditional_and_compressed(response):
+    if not request.path.startswith('/api/') or request.method not in ('GET', 'HEAD') or response.status_code != 200:
+        return response
+    if response.mimetype != 'application/json' or response.direct_passthrough:
+        return response
+    status, body, headers = conditional_json_response(
+        response.get_data(), request.headers.get('If-None-Match'), request.headers.get('Accept-Encoding')
+    )
+    response.status_code = status
+    response.set_data(body)
+    for name, value in headers:
+        response.headers[name] = value
+    return response
+
+
+@app.teardown_request
+def _end_request_timing(exc):
+    spans_token = g.pop('request_spans_token', None)
+    if spans_token is not None:
+        end_request(spans_token)
+
+
+@app.route('/metrics')
+def metrics():
+    return Response(render_prometheus(get_endpoint_stats(), get_cache_stats()), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/')
 def index():
     return send_from_directory(app.static_folder, 'index.html')
 
-@app.route('/api/routes', methods=['GET'])
-def api_get_routes():
-    route_keyword = request.args.get('keyword')
+def parse_routes_args(args):
+    route_keyword = args.get('keyword')
     if not route_keyword:
-        return jsonify({"error": "缺少 'keyword' (路線關鍵字) 參數"}), 400
-    return jsonify(fetch_available_routes_logic(route_keyword))
+        return {"error": "缺少 'keyword' (路線關鍵字) 參數"}, None
+    return None, route_keyword
 
-@app.route('/api/buses_for_route', methods=['GET'])
-def api_get_buses_for_route():
+
+def parse_buses_for_route_args(args):
+    direction_str = args.get('direction')
+    if direction_str is None:
+        return {"error": "缺少 'direction' 參數"}, None
     try:
-        direction_str = request.args.get('direction')
-        if direction_str is None:
-            return jsonify({"error": "缺少 'direction' 參數"}), 400
         direction = int(direction_str)
-
-        tdx_route_name_keyword = request.args.get('tdx_route_name_keyword')
-        route_uid = request.args.get('route_uid') 
-        sub_route_uid = request.args.get('sub_route_uid')
-        display_name = request.args.get('display_name')
-
-        if not tdx_route_name_keyword:
-            return jsonify({"error": "缺少 'tdx_route_name_keyword' 參數"}), 400
-        
-        selected_route_params = {
-            "tdx_route_name_keyword": tdx_route_name_keyword,
-            "route_uid": route_uid, 
-            "sub_route_uid": sub_route_uid,
-            "direction": direction,
-            "display_name": display_name 
-        }
-        
-        return jsonify(fetch_buses_for_route_logic(selected_route_params))
     except ValueError:
-        return jsonify({"error": "'direction' 參數必須是整數。"}), 400
-    except Exception as e:
-        app.logger.error(f"/api/buses_for_route 發生錯誤: {e}", exc_info=True)
-        return jsonify({"error": "伺服器內部錯誤"}), 500
+        return {"error": "'direction' 參數必須是整數。"}, None
+
+    tdx_route_name_keyword = args.get('tdx_route_name_keyword')
+    if not tdx_route_name_keyword:
+        return {"error": "缺少 'tdx_route_name_keyword' 參數"}, None
+
+    selected_route_params = {
+        "tdx_route_name_keyword": tdx_route_name_keyword,
+        "route_uid": args.get('route_uid'), 
+        "sub_route_uid": args.get('sub_route_uid'),
+        "direction": direction,
+        "display_name": args.get('display_name') 
+    }
+    return None, selected_route_params
 
-@app.route('/api/bus_info/<plate_numb>', methods=['GET'])
-def api_get_bus_info(plate_numb):
+
+def parse_bus_info_args(plate_numb, args):
     if not plate_numb:
-        return jsonify({"error": "車牌號碼不可為空。"}), 400
+        return {"error": "車牌號碼不可為空。"}, None, None
     
-    route_name = request.args.get('route_name')
-    direction_str = request.args.get('direction')
+    route_name = args.get('route_name')
+    direction_str = args.get('direction')
     
     if not route_name:
-        return jsonify({"error": "缺少 'route_name' 參數以查詢公車資訊。"}), 400
+        return {"error": "缺少 'route_name' 參數以查詢公車資訊。"}, None, None
     if direction_str is None:
-        return jsonify({"error": "缺少 'direction' 參數以查詢公車資訊。"}), 400
+        return {"error": "缺少 'direction' 參數以查詢公車資訊。"}, None, None
     
     try:
         direction = int(direction_str)
     except ValueError:
-        return jsonify({"error": "'direction' 參數必須是整數。"}), 400
-        
-    return jsonify(get_bus_stop_info_logic(plate_numb, route_name_param=route_name, direction_param=direction))
+        return {"error": "'direction' 參數必須是整數。"}, None, None
+    return None, route_name, direction
+
+
+def parse_nearby_stops_args(args):
+    try:
+        lat = float(args.get('lat', ''))
+        lon = float(args.get('lon', ''))
+    except ValueError:
+        return {"error": "缺少或無效的 'lat'、'lon' 座標參數。"}, None, None, None
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return {"error": "'lat'、'lon' 座標超出範圍。"}, None, None, None
+
+    radius_str = args.get('radius')
+    try:
+        radius = int(radius_str) if radius_str else NEARBY_DEFAULT_RADIUS
+    except ValueError:
+        return {"error": "'radius' 參數必須是整數 (公尺)。"}, None, None, None
+    if not 0 < radius <= NEARBY_MAX_RADIUS:
+        return {"error": f"'radius' 必須介於 1 到 {NEARBY_MAX_RADIUS} 公尺之間。"}, None, None, None
+    return None, lat, lon, radius
+
+
+def parse_route_bus_info_args(args):
+    route_name = args.get('route_name')
+    direction_str = args.get('direction')
+
+    if not route_name:
+        return {"error": "缺少 'route_name' 參數以查詢公車資訊。"}, None, None
+    if direction_str is None:
+        return {"error": "缺少 'direction' 參數以查詢公車資訊。"}, None, None
+
+    try:
+        direction = int(direction_str)
+    except ValueError:
+        return {"error": "'direction' 參數必須是整數。"}, None, None
+    return None, route_name, direction
+
+
+@app.route('/api/routes', methods=['GET'])
+def api_get_routes():
+    error_payload, route_keyword = parse_routes_args(request.args)
+    if error_payload:
+        return jsonify(error_payload), 400
+    return jsonify(fetch_available_routes_logic(route_keyword))
+
+@app.route('/api/buses_for_route', methods=['GET'])
+def api_get_buses_for_route():
+    try:
+        error_payload, selected_route_params = parse_buses_for_route_args(request.args)
+        if error_payload:
+            return jsonify(error_payload), 400
+        return jsonify(fetch_buses_for_route_logic(selected_route_params))
+    except Exception as e:
+        app.logger.error(f"/api/buses_for_route 發生錯誤: {e}", exc_info=True)
+        return jsonify({"error": "伺服器內部錯誤"}), 500
+
+@app.route('/api/bus_info/<plate_numb>', methods=['GET'])
+def api_get_bus_info(plate_numb):
+    error_payload, route_name, direction = parse_bus_info_args(plate_numb, request.args)
+    if error_payload:
+        return jsonify(error_payload), 400
+    bus_info = get_bus_stop_info_logic(plate_numb, route_name_param=route_name, direction_param=direction)
+    since = request.args.get('since')
+    return jsonify(upcoming_stops_delta(bus_info, since) if since is not None else bus_info)
+
+@app.route('/api/bus_info_for_route', methods=['GET'])
+def api_get_bus_info_for_route():
+    error_payload, route_name, direction = parse_route_bus_info_args(request.args)
+    if error_payload:
+        return jsonify(error_payload), 400
+    return jsonify(get_route_buses_info_logic(route_name, direction))
+
+@app.route('/api/nearby_stops', methods=['GET'])
+def api_get_nearby_stops():
+    error_payload, lat, lon, radius = parse_nearby_stops_args(request.args)
+    if error_payload:
+        return jsonify(error_payload), 400
+    return jsonify(fetch_nearby_stops_logic(lat, lon, radius))
+
+@app.route('/api/bus_info_stream/<plate_numb>', methods=['GET'])
+def api_stream_bus_info(plate_numb):
+    error_payload, route_name, direction = parse_bus_info_args(plate_numb, request.args)
+    if error_payload:
+        return jsonify(error_payload), 400
+
+    if not _stream_slots.acquire(blocking=False):
+        # The frontend treats a failed stream as a cue to fall back to polling /api/bus_info.
+        return jsonify({"error": "目前串流連線數已達上限，請改用一般查詢。"}), 503
+
+    def generate_events():
+        for version, payload in eta_stream_hub.subscribe((plate_numb, route_name, direction)):
+            yield format_sse_event(version, payload)
+
+    response = Response(stream_with_context(generate_events()), mimetype='text/event-stream', headers=SSE_HEADERS)
+    # Released when the server closes the response, even if the client left before the first event.
+    response.call_on_close(_stream_slots.release)
+    return response
 
 if __name__ == '__main__':
     static_index_html_path = os.path.join(STATIC_DIR, 'index.html')
@@ -0,0 +1,127 @@
+import contextvars
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+METRICS_PREFIX = 'mybus'
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Spans recorded while serving the current request; None outside a request (e.g. background threads).
+_request_spans = contextvars.ContextVar('request_spans', default=None)
+
+
+class Histogram():
+    def __init__(self, name, help_text, label_names, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series_items = sorted((labels, (list(counts), total)) for labels, (counts, total) in self._series.items())
+        for label_values, (counts, total) in series_items:
+            labels = ','.join(f'{name}="{_escape_label(value)}"' for name, value in zip(self.label_names, label_values))
+            cumulative = 0
+            for upper_bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels},le="{upper_bound}"}} {cumulative}')
+            cumulative += counts[-1]
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{labels}}} {total}')
+            lines.append(f'{self.name}_count{{{labels}}} {cumulative}')
+        return lines
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+stage_duration = Histogram(
+    f"{METRICS_PREFIX}_stage_duration_seconds", "Time spent in each stage of serving a request.", ('stage', 'dataset')
+)
+request_duration = Histogram(
+    f"{METRICS_PREFIX}_request_duration_seconds", "End-to-end API request latency.", ('endpoint', 'status')
+)
+
+
+@contextmanager
+def timed(stage, dataset=''):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        stage_duration.observe(elapsed, (stage, dataset))
+        spans = _request_spans.get()
+        if spans is not None:
+            spans.append((f"{stage}_{dataset}" if dataset else stage, elapsed))
+
+
+def begin_request():
+    # The list is shared, not copied, by contexts derived from this one, so executor threads started with
+    # contextvars.copy_context() append their spans to the same request.
+    return _request_spans.set([])
+
+
+def request_spans():
+    return list(_request_spans.get() or [])
+
+
+def end_request(context_token):
+    _request_spans.reset(context_token)
+
+
+def observe_request(endpoint, status, elapsed_seconds):
+    request_duration.observe(elapsed_seconds, (endpoint, str(status)))
+
+
+def server_timing_header(spans, total_seconds=None):
+    entries = [f"{name};dur={elapsed * 1000:.1f}" for name, elapsed in spans]
+    if total_seconds is not None:
+        entries.append(f"total;dur={total_seconds * 1000:.1f}")
+    return ', '.join(entries)
+
+
+def render_prometheus(endpoint_stats=None, cache_stats=None):
+    lines = stage_duration.render() + request_duration.render()
+
+    if endpoint_stats:
+        for counter, help_text in (
+            ('calls', "Upstream TDX requests made."),
+            ('errors', "Upstream TDX requests that failed."),
+            ('retries', "Upstream TDX requests retried after 429/5xx."),
+            ('coalesced', "TDX fetches served by joining an identical in-flight request."),
+            ('throttled', "TDX requests dropped by the client-side rate limiter without being sent."),
+        ):
+            name = f"{METRICS_PREFIX}_tdx_{counter}_total"
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} counter")
+            for endpoint, stats in sorted(endpoint_stats.items()):
+                lines.append(f'{name}{{dataset="{_escape_label(endpoint)}"}} {stats[counter]}')
+
+    if cache_stats:
+        name = f"{METRICS_PREFIX}_cache_lookups_total"
+        lines.append(f"# HELP {name} Static TDX dataset cache lookups by outcome.")
+        lines.append(f"# TYPE {name} counter")
+        for dataset, counts in sorted(cache_stats.get("datasets", {}).items()):
+            for outcome, count in sorted(counts.items()):
+                lines.append(f'{name}{{dataset="{_escape_label(dataset)}",outcome="{outcome}"}} {count}')
+        name = f"{METRICS_PREFIX}_cache_memory_entries"
+        lines.append(f"# HELP {name} Entries held in the in-process TDX cache.")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {cache_stats.get('memory_entries', 0)}")
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,39 @@
+import contextvars
+import os
+import time
+
+# Wall-clock budget for building one bus-info response; 0 disables it.
+TDX_REQUEST_DEADLINE = float(os.environ.get('TDX_REQUEST_DEADLINE', 8))
+DEADLINE_EXCEEDED = "DEADLINE_EXCEEDED"
+
+# time.monotonic() by which the current request must be answered; None when it has no budget.
+_deadline = contextvars.ContextVar('request_deadline', default=None)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def begin_budget(seconds=TDX_REQUEST_DEADLINE):
+    deadline = _deadline.get()
+    if seconds > 0:
+        # A nested budget can only shorten the one already running.
+        new_deadline = time.monotonic() + seconds
+        deadline = new_deadline if deadline is None else min(deadline, new_deadline)
+    return _deadline.set(deadline)
+
+
+def remaining_budget():
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic())
+
+
+def end_budget(context_token):
+    _deadline.reset(context_token)
+
+
+def cap_timeout(timeout):
+    budget = remaining_budget()
+    return timeout if budget is None else min(timeout, budget)
@@ -0,0 +1,137 @@
+import os
+import threading
+import time
+
+from auth_TDX import get_tdx_access_token
+from route_data import parse_stop_of_route
+from spatial_index import StopGridIndex
+from tdx_cache import begin_stale_tracking, end_stale_tracking, fetch_tdx_data_cached, stale_reads
+from tdx_rate_limit import PRIORITY_BACKGROUND, tdx_priority
+
+TDX_ROUTE_CATALOGUE_ENABLED = os.environ.get('TDX_ROUTE_CATALOGUE_ENABLED', '1') == '1'
+TDX_ROUTE_CATALOGUE_REFRESH = float(os.environ.get('TDX_ROUTE_CATALOGUE_REFRESH', 6 * 3600))
+TDX_ROUTE_CATALOGUE_RETRY_INTERVAL = float(os.environ.get('TDX_ROUTE_CATALOGUE_RETRY_INTERVAL', 60))
+TDX_NEARBY_CELL_METERS = float(os.environ.get('TDX_NEARBY_CELL_METERS', 500))
+CATALOGUE_GRAM_SIZE = 3
+CATALOGUE_FIELDS = 'RouteUID,RouteName,SubRouteUID,SubRouteName,Direction,Stops'
+
+
+def _normalize(text):
+    return ''.join(text.split()).casefold()
+
+
+def _grams(text, size):
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+class RouteCatalogueIndex():
+    def __init__(self, route_variants, cell_meters=TDX_NEARBY_CELL_METERS):
+        # Kept in the same order /api/routes has always sorted TDX results in, so match positions sort for free.
+        raw_variants = sorted(
+            (rv for rv in route_variants if isinstance(rv, dict)),
+            key=lambda rv: (rv.get('RouteUID', ''), rv.get('SubRouteUID', ''), rv.get('Direction', -1))
+        )
+        self.route_variants = parse_stop_of_route(raw_variants)
+        self.stop_grid = StopGridIndex(raw_variants, self.route_variants, cell_meters)
+        self.search_names = []
+        self._positions_by_gram = {}
+        for position, route_variant in enumerate(raw_variants):
+            names = set()
+            for name_field in ('RouteName', 'SubRouteName'):
+                name_obj = route_variant.get(name_field) or {}
+                for lang in ('Zh_tw', 'En'):
+                    if name_obj.get(lang):
+                        names.add(_normalize(name_obj[lang]))
+            self.search_names.append(names)
+            for name in names:
+                for size in range(1, CATALOGUE_GRAM_SIZE + 1):
+                    for gram in _grams(name, size):
+                        self._positions_by_gram.setdefault(gram, set()).add(position)
+
+    def search(self, keyword):
+        query = _normalize(keyword)
+        if not query:
+            return []
+        if len(query) <= CATALOGUE_GRAM_SIZE:
+            positions = self._positions_by_gram.get(query, set())
+        else:
+            gram_sets = [self._positions_by_gram.get(gram, set()) for gram in _grams(query, CATALOGUE_GRAM_SIZE)]
+            positions = set.intersection(*sorted(gram_sets, key=len))
+            positions = {p for p in positions if any(query in name for name in self.search_names[p])}
+        return [self.route_variants[p] for p in sorted(positions)]
+
+
+def build_catalogue_index(data):
+    # parse hook for the catalogue download: the cache's memory tier then holds the index the catalogue
+    # serves from, not the full StopOfRoute tree it was built from.
+    if not isinstance(data, list):
+        return data
+    return RouteCatalogueIndex(data)
+
+
+class RouteCatalogue():
+    def __init__(self, api_base_url, refresh_interval=TDX_ROUTE_CATALOGUE_REFRESH, retry_interval=TDX_ROUTE_CATALOGUE_RETRY_INTERVAL):
+        self.api_base_url = api_base_url
+        self.refresh_interval = refresh_interval
+        self.retry_interval = retry_interval
+        self._index = None
+        self._loaded_at = 0
+        self._last_attempt = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def search(self, keyword):
+        # None means no catalogue has been loaded yet, as opposed to an empty match.
+        self._refresh_if_stale()
+        index = self._index
+        if index is None:
+            return None
+        return index.search(keyword)
+
+    def nearby_stops(self, lat, lon, radius_meters, limit=None):
+        # Same contract as search: None until the catalogue (and with it the stop grid) has loaded.
+        self._refresh_if_stale()
+        index = self._index
+        if index is None:
+            return None
+        return index.stop_grid.nearby(lat, lon, radius_meters, limit)
+
+    def covers(self, lat, lon, radius_meters):
+        index = self._index
+        return index is not None and index.stop_grid.covers(lat, lon, radius_meters)
+
+    def _refresh_if_stale(self):
+        now = time.time()
+        if self._index is not None and now - self._loaded_at < self.refresh_interval:
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            if now - self._last_attempt < self.retry_interval:
+                return
+            self._last_attempt = now
+            # Loaded off the request path; callers fall back to querying TDX until the first load lands.
+            self._thread = threading.Thread(target=self.refresh, name='tdx-route-catalogue', daemon=True)
+            self._thread.start()
+
+    def refresh(self):
+        access_token = get_tdx_access_token()
+        if not access_token:
+            return False
+        api_url = f"{self.api_base_url}/v2/Bus/StopOfRoute/InterCity"
+        stale_token = begin_stale_tracking()
+        try:
+            with tdx_priority(PRIORITY_BACKGROUND):
+                index, error_code = fetch_tdx_data_cached(
+                    api_url, access_token, params={'$select': CATALOGUE_FIELDS, '$format': 'JSON'}, parse=build_catalogue_index
+                )
+            reads = stale_reads()
+        finally:
+            end_stale_tracking(stale_token)
+        if error_code is not None or not isinstance(index, RouteCatalogueIndex) or not index.route_variants:
+            return False
+        self._index = index
+        # A stale copy (e.g. an old route snapshot) is dated from when it was stored, so the catalogue reloads
+        # on the next retry, once the cache's background revalidation has replaced it.
+        self._loaded_at = time.time() - max((age for _, age in reads), default=0)
+        return True
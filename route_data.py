@@ -0,0 +1,150 @@
+import json
+import re
+import sys
+from array import array
+
+# Compact, read-only forms of the static TDX datasets. Only the fields this service reads are kept;
+# UIDs, stop IDs and names repeat across variants and workers' caches, so they are interned.
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+_json_decoder = json.JSONDecoder()
+_json_whitespace = re.compile(r'[ \t\n\r]*')
+
+
+def _zh_tw(name_obj):
+    return _intern(name_obj.get('Zh_tw')) if isinstance(name_obj, dict) else None
+
+
+class CompactStop():
+    __slots__ = ('sequence', 'stop_id', 'name')
+
+    def __init__(self, sequence, stop_id, name):
+        self.sequence = sequence
+        self.stop_id = stop_id
+        self.name = name
+
+
+class CompactRouteVariant():
+    __slots__ = ('route_uid', 'sub_route_uid', 'route_name', 'sub_route_name', 'direction', 'stops')
+
+    def __init__(self, route_uid, sub_route_uid, route_name, sub_route_name, direction, stops):
+        self.route_uid = route_uid
+        self.sub_route_uid = sub_route_uid
+        self.route_name = route_name
+        self.sub_route_name = sub_route_name
+        self.direction = direction
+        self.stops = stops
+
+
+class CompactTravelTime():
+    __slots__ = ('weekday', 'start_hour', 'end_hour', 'from_stop_ids', 'to_stop_ids', 'run_times')
+
+    def __init__(self, weekday, start_hour, end_hour, from_stop_ids, to_stop_ids, run_times):
+        self.weekday = weekday
+        self.start_hour = start_hour
+        self.end_hour = end_hour
+        # Parallel columns; None when TDX sent no S2STimes list. Unusable RunTimes are stored as NaN.
+        self.from_stop_ids = from_stop_ids
+        self.to_stop_ids = to_stop_ids
+        self.run_times = run_times
+
+
+class CompactS2SEntry():
+    __slots__ = ('route_uid', 'sub_route_uid', 'direction', 'travel_times')
+
+    def __init__(self, route_uid, sub_route_uid, direction, travel_times):
+        self.route_uid = route_uid
+        self.sub_route_uid = sub_route_uid
+        self.direction = direction
+        self.travel_times = travel_times
+
+
+def _compact_stop(stop):
+    return CompactStop(stop.get('StopSequence'), _intern(stop.get('StopID')), _zh_tw(stop.get('StopName', {})))
+
+
+def parse_stop_of_route(data):
+    if not isinstance(data, list):
+        return data
+    variants = []
+    for route_variant in data:
+        if not isinstance(route_variant, dict):
+            continue
+        stops = route_variant.get('Stops', [])
+        variants.append(CompactRouteVariant(
+            _intern(route_variant.get('RouteUID')),
+            _intern(route_variant.get('SubRouteUID')),
+            _zh_tw(route_variant.get('RouteName', {})),
+            _zh_tw(route_variant.get('SubRouteName', {})),
+            route_variant.get('Direction'),
+            tuple(_compact_stop(stop) for stop in stops if isinstance(stop, dict)) if isinstance(stops, list) else ()
+        ))
+    return variants
+
+
+def _compact_travel_time(time_segment):
+    s2s_times = time_segment.get('S2STimes')
+    from_stop_ids = to_stop_ids = run_times = None
+    if isinstance(s2s_times, list):
+        from_stop_ids = tuple(_intern(s2s_time.get('FromStopID')) for s2s_time in s2s_times)
+        to_stop_ids = tuple(_intern(s2s_time.get('ToStopID')) for s2s_time in s2s_times)
+        run_times = array('d', (
+            s2s_time.get('RunTime') if isinstance(s2s_time.get('RunTime'), (int, float)) and s2s_time.get('RunTime') >= 0 else float('nan')
+            for s2s_time in s2s_times
+        ))
+    return CompactTravelTime(
+        time_segment.get('Weekday'), time_segment.get('StartHour'), time_segment.get('EndHour'),
+        from_stop_ids, to_stop_ids, run_times
+    )
+
+
+def _compact_s2s_entry(s2s_entry):
+    travel_times = s2s_entry.get('TravelTimes')
+    return CompactS2SEntry(
+        _intern(s2s_entry.get('RouteUID')),
+        _intern(s2s_entry.get('SubRouteUID')),
+        s2s_entry.get('Direction'),
+        [_compact_travel_time(t) for t in travel_times if isinstance(t, dict)] if isinstance(travel_times, list) else None
+    )
+
+
+def parse_s2s_travel_time(data):
+    if not isinstance(data, list):
+        return data
+    return [_compact_s2s_entry(s2s_entry) for s2s_entry in data if isinstance(s2s_entry, dict)]
+
+
+def iter_json_array(text):
+    # Decodes a top-level JSON array one element at a time, so only the element being handled is ever
+    # held as Python objects rather than the whole document.
+    position = _json_whitespace.match(text, 0).end()
+    if text[position:position + 1] != '[':
+        raise json.JSONDecodeError("Expecting '['", text, position)
+    position = _json_whitespace.match(text, position + 1).end()
+    if text[position:position + 1] != ']':
+        while True:
+            element, position = _json_decoder.raw_decode(text, position)
+            yield element
+            position = _json_whitespace.match(text, position).end()
+            delimiter = text[position:position + 1]
+            if delimiter == ']':
+                break
+            if delimiter != ',':
+                raise json.JSONDecodeError("Expecting ',' delimiter", text, position)
+            position = _json_whitespace.match(text, position + 1).end()
+    position = _json_whitespace.match(text, position + 1).end()
+    if position != len(text):
+        raise json.JSONDecodeError("Extra data", text, position)
+
+
+def decode_s2s_travel_time(text):
+    # Same result as parse_s2s_travel_time(json.loads(text)), compacting each route entry as soon as it is
+    # decoded instead of first building the full weekday x hour x segment object tree.
+    position = _json_whitespace.match(text, 0).end()
+    if text[position:position + 1] != '[':
+        return parse_s2s_travel_time(json.loads(text))
+    return [_compact_s2s_entry(s2s_entry) for s2s_entry in iter_json_array(text) if isinstance(s2s_entry, dict)]
@@ -0,0 +1,155 @@
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+
+ROUTE_INDEX_CACHE_SIZE = 128
+
+
+class S2SBucket():
+    def __init__(self, cumulative_run_time, cumulative_missing, first_sequence):
+        self.cumulative_run_time = cumulative_run_time
+        self.cumulative_missing = cumulative_missing
+        self.first_sequence = first_sequence
+
+
+class RouteIndex():
+    def __init__(self, stops, s2s_entry=None):
+        self.stops = stops
+        self.stop_by_sequence = {}
+        self.sequence_by_stop_name = {}
+        for idx, stop in enumerate(stops):
+            self.stop_by_sequence.setdefault(stop.sequence, stop)
+            if stop.name:
+                self.sequence_by_stop_name.setdefault(stop.name, stop.sequence if stop.sequence is not None else idx)
+
+        int_sequences = [seq for seq in self.stop_by_sequence if isinstance(seq, int)]
+        self.min_sequence = min(int_sequences) if int_sequences else None
+        self.max_sequence = max(int_sequences) if int_sequences else None
+
+        self.travel_times = s2s_entry.travel_times if s2s_entry else None
+        self._bucket_position_by_weekday_hour = {}
+        if self.travel_times:
+            for position, time_segment in enumerate(self.travel_times):
+                segment_weekday = time_segment.weekday
+                segment_start_hour = time_segment.start_hour
+                segment_end_hour = time_segment.end_hour
+                if segment_weekday is None or segment_start_hour is None or segment_end_hour is None:
+                    continue
+                for hour in range(max(segment_start_hour, 0), min(segment_end_hour, 24)):
+                    self._bucket_position_by_weekday_hour.setdefault((segment_weekday, hour), position)
+        self._compiled_buckets = {}
+        self._lock = threading.Lock()
+
+    def s2s_bucket_for(self, weekday, hour):
+        position = self._bucket_position_by_weekday_hour.get((weekday, hour))
+        if position is None:
+            return None
+        bucket = self._compiled_buckets.get(position)
+        if bucket is None:
+            time_segment = self.travel_times[position]
+            if time_segment.run_times is None:
+                return None
+            with self._lock:
+                bucket = self._compiled_buckets.get(position)
+                if bucket is None:
+                    bucket = self._compile_bucket(time_segment)
+                    self._compiled_buckets[position] = bucket
+        return bucket
+
+    def _compile_bucket(self, time_segment):
+        run_time_by_segment = {}
+        for segment in zip(time_segment.from_stop_ids, time_segment.to_stop_ids, time_segment.run_times):
+            run_time_by_segment.setdefault(segment[:2], segment[2])
+
+        cumulative_run_time = [0]
+        cumulative_missing = [0]
+        if self.min_sequence is not None:
+            for sequence in range(self.min_sequence, self.max_sequence):
+                from_stop = self.stop_by_sequence.get(sequence)
+                to_stop = self.stop_by_sequence.get(sequence + 1)
+                run_time = None
+                if from_stop and to_stop:
+                    run_time = run_time_by_segment.get((from_stop.stop_id, to_stop.stop_id))
+                # Unusable RunTimes were stored as NaN when the payload was parsed.
+                if run_time is not None and run_time == run_time:
+                    cumulative_run_time.append(cumulative_run_time[-1] + run_time)
+                    cumulative_missing.append(cumulative_missing[-1])
+                else:
+                    cumulative_run_time.append(cumulative_run_time[-1])
+                    cumulative_missing.append(cumulative_missing[-1] + 1)
+        return S2SBucket(cumulative_run_time, cumulative_missing, self.min_sequence)
+
+    def travel_seconds_from(self, bucket, from_sequence):
+        # {to_sequence: seconds} for every sequence reachable from from_sequence without a missing segment.
+        if bucket.first_sequence is None or not isinstance(from_sequence, int):
+            return {}
+        from_offset = from_sequence - bucket.first_sequence
+        if from_offset < 0 or from_offset >= len(bucket.cumulative_run_time):
+            return {}
+        # cumulative_missing never decreases, so the stops reachable without crossing a missing segment are
+        # exactly those up to where it first grows past its value at from_offset.
+        end_offset = bisect_right(bucket.cumulative_missing, bucket.cumulative_missing[from_offset], lo=from_offset)
+        base = bucket.cumulative_run_time[from_offset]
+        return {from_sequence + step: seconds - base
+                for step, seconds in enumerate(bucket.cumulative_run_time[from_offset:end_offset])}
+
+    def segment_seconds(self, bucket, sequence):
+        # S2S run time from sequence to sequence + 1, or None if the bucket has none.
+        if bucket is None or bucket.first_sequence is None or not isinstance(sequence, int):
+            return None
+        offset = sequence - bucket.first_sequence
+        if offset < 0 or offset + 1 >= len(bucket.cumulative_run_time):
+            return None
+        if bucket.cumulative_missing[offset + 1] != bucket.cumulative_missing[offset]:
+            return None
+        return bucket.cumulative_run_time[offset + 1] - bucket.cumulative_run_time[offset]
+
+    def travel_seconds_with_fallback(self, bucket, from_sequence, fallback_seconds):
+        # Like travel_seconds_from, but a segment the S2S bucket (which may be None) has no run time for is
+        # filled in by fallback_seconds(from_stop_id, to_stop_id); the walk ends at a segment neither knows.
+        if self.min_sequence is None or not isinstance(from_sequence, int) or from_sequence < self.min_sequence:
+            return {}
+        seconds_by_sequence = {from_sequence: 0}
+        elapsed = 0
+        for sequence in range(from_sequence, self.max_sequence):
+            from_stop = self.stop_by_sequence.get(sequence)
+            to_stop = self.stop_by_sequence.get(sequence + 1)
+            if not from_stop or not to_stop:
+                break
+            run_time = self.segment_seconds(bucket, sequence)
+            if run_time is None:
+                run_time = fallback_seconds(from_stop.stop_id, to_stop.stop_id)
+                if run_time is None:
+                    break
+            elapsed += run_time
+            seconds_by_sequence[sequence + 1] = elapsed
+        return seconds_by_sequence
+
+
+_route_index_cache = OrderedDict()
+_route_index_cache_lock = threading.Lock()
+
+
+def get_route_index(cache_key, stops, s2s_entry=None):
+    # Indexes are reused only while the cached TDX payloads they were built from are still the same objects.
+    with _route_index_cache_lock:
+        cached = _route_index_cache.get(cache_key)
+        if cached is not None and cached[0] is stops and cached[1] is s2s_entry:
+            _route_index_cache.move_to_end(cache_key)
+            return cached[2]
+
+    route_index = RouteIndex(stops, s2s_entry)
+    with _route_index_cache_lock:
+        _route_index_cache[cache_key] = (stops, s2s_entry, route_index)
+        _route_index_cache.move_to_end(cache_key)
+        while len(_route_index_cache) > ROUTE_INDEX_CACHE_SIZE:
+            _route_index_cache.popitem(last=False)
+    return route_index
+
+
+def index_eta_by_stop_id(eta_data_list):
+    eta_by_stop_id = {}
+    if isinstance(eta_data_list, list):
+        for eta_entry in eta_data_list:
+            eta_by_stop_id.setdefault(eta_entry.get('StopID'), eta_entry)
+    return eta_by_stop_id
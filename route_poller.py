@@ -0,0 +1,114 @@
+import os
+import threading
+import time
+
+from auth_TDX import get_tdx_access_token, fetch_tdx_data_with_token
+from learned_travel_times import observe_bus_positions
+from tdx_rate_limit import PRIORITY_BACKGROUND, tdx_priority
+
+TDX_POLLER_ENABLED = os.environ.get('TDX_POLLER_ENABLED', '0') == '1'
+TDX_POLL_INTERVAL = float(os.environ.get('TDX_POLL_INTERVAL', 15))
+TDX_HOT_ROUTE_TTL = float(os.environ.get('TDX_HOT_ROUTE_TTL', 300))
+TDX_SNAPSHOT_MAX_AGE = float(os.environ.get('TDX_SNAPSHOT_MAX_AGE', 3 * TDX_POLL_INTERVAL))
+
+
+class RouteSnapshot():
+    def __init__(self, route_name, realtime_data, eta_data, fetched_at):
+        self.route_name = route_name
+        self.realtime_data = realtime_data
+        self.eta_data = eta_data
+        self.fetched_at = fetched_at
+        self.realtime_by_plate = {}
+        self.eta_by_plate_direction = {}
+        for bus in realtime_data:
+            self.realtime_by_plate.setdefault(bus.get('PlateNumb'), []).append(bus)
+        for eta_entry in eta_data:
+            self.eta_by_plate_direction.setdefault((eta_entry.get('PlateNumb'), eta_entry.get('Direction')), []).append(eta_entry)
+
+    def age(self):
+        return time.time() - self.fetched_at
+
+    def realtime_where(self, match_fields):
+        candidates = self.realtime_data
+        if 'PlateNumb' in match_fields:
+            candidates = self.realtime_by_plate.get(match_fields['PlateNumb'], [])
+        return [bus for bus in candidates if all(bus.get(field) == value for field, value in match_fields.items())]
+
+    def eta_where(self, match_fields):
+        return [eta_entry for eta_entry in self.eta_data if all(eta_entry.get(field) == value for field, value in match_fields.items())]
+
+    def eta_for_bus(self, plate_numb, direction):
+        return list(self.eta_by_plate_direction.get((plate_numb, direction), []))
+
+
+class RoutePoller():
+    def __init__(self, api_base_url, interval=TDX_POLL_INTERVAL, hot_route_ttl=TDX_HOT_ROUTE_TTL, max_snapshot_age=TDX_SNAPSHOT_MAX_AGE):
+        self.api_base_url = api_base_url
+        self.interval = interval
+        self.hot_route_ttl = hot_route_ttl
+        self.max_snapshot_age = max_snapshot_age
+        self._last_requested = {}
+        self._snapshots = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def mark_hot(self, route_name):
+        with self._lock:
+            is_new_route = route_name not in self._last_requested
+            self._last_requested[route_name] = time.time()
+            if self._thread is None or not self._thread.is_alive():
+                # Started lazily so each gunicorn worker gets its own thread after fork.
+                self._thread = threading.Thread(target=self._run, name='tdx-route-poller', daemon=True)
+                self._thread.start()
+        if is_new_route:
+            self._wakeup.set()
+
+    def snapshot_for(self, route_name):
+        with self._lock:
+            snapshot = self._snapshots.get(route_name)
+        if snapshot is None or snapshot.age() > self.max_snapshot_age:
+            return None
+        return snapshot
+
+    def hot_routes(self):
+        with self._lock:
+            return list(self._last_requested)
+
+    def _expire_cold_routes(self):
+        cutoff = time.time() - self.hot_route_ttl
+        with self._lock:
+            for route_name in [name for name, requested_at in self._last_requested.items() if requested_at < cutoff]:
+                del self._last_requested[route_name]
+                self._snapshots.pop(route_name, None)
+
+    def poll_route(self, route_name, access_token):
+        realtime_url = f"{self.api_base_url}/v2/Bus/RealTimeNearStop/Streaming/InterCity/{route_name}"
+        eta_url = f"{self.api_base_url}/v2/Bus/EstimatedTimeOfArrival/Streaming/InterCity/{route_name}"
+        realtime_data, error_rt = fetch_tdx_data_with_token(realtime_url, access_token, params={'$format': 'JSON'})
+        if error_rt is not None or not isinstance(realtime_data, list):
+            return False
+        observe_bus_positions(realtime_data)
+        eta_data, error_eta = fetch_tdx_data_with_token(eta_url, access_token, params={'$format': 'JSON'})
+        if error_eta is not None or not isinstance(eta_data, list):
+            return False
+        snapshot = RouteSnapshot(route_name, realtime_data, eta_data, time.time())
+        with self._lock:
+            if route_name in self._last_requested:
+                self._snapshots[route_name] = snapshot
+        return True
+
+    def _run(self):
+        # Prefetching is background work even though it pulls realtime datasets: requests that find no fresh
+        # snapshot query TDX themselves, so the poller must not queue ahead of them.
+        with tdx_priority(PRIORITY_BACKGROUND):
+            while True:
+                self._expire_cold_routes()
+                routes = self.hot_routes()
+                if routes:
+                    access_token = get_tdx_access_token()
+                    if access_token:
+                        for route_name in routes:
+                            self.poll_route(route_name, access_token)
+                self._wakeup.wait(self.interval)
+                self._wakeup.clear()
@@ -0,0 +1,160 @@
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+from urllib.parse import unquote, urlparse
+
+from auth_TDX import fetch_tdx_data_with_token, get_tdx_access_token
+
+# Static route data compiled ahead of time so a fresh worker can answer without downloading StopOfRoute and
+# S2STravelTime first. Layout: a fixed header (magic, format version, directory length), a JSON directory
+# mapping entry names to (offset, length), then the entries' compact JSON back to back. Workers mmap the
+# file read-only, so its pages are shared through the OS page cache and an entry is only decoded on use.
+SNAPSHOT_MAGIC = b'MYBUSSNP'
+SNAPSHOT_FORMAT_VERSION = 1
+_HEADER = struct.Struct('<8sII')
+
+CATALOGUE_ENTRY = 'StopOfRoute'
+SNAPSHOT_DATASETS = ('StopOfRoute', 'S2STravelTime')
+
+
+def snapshot_entry_name(api_url, params=None):
+    # Maps a TDX request onto the snapshot entry holding the same data, or None if the snapshot has no
+    # equivalent (e.g. a $filter query). Entries are named independently of the API host they were built from.
+    if params and any(name not in ('$format', '$select') for name in params):
+        return None
+    path_parts = [unquote(part) for part in urlparse(api_url).path.split('/') if part]
+    if 'Bus' not in path_parts:
+        return None
+    route_parts = path_parts[path_parts.index('Bus') + 1:]
+    if len(route_parts) == 2 and route_parts == [CATALOGUE_ENTRY, 'InterCity']:
+        return CATALOGUE_ENTRY
+    if len(route_parts) == 3 and route_parts[0] in SNAPSHOT_DATASETS and route_parts[1] == 'InterCity':
+        if params and '$select' in params:
+            return None
+        return f"{route_parts[0]}/{route_parts[2]}"
+    return None
+
+
+class RouteSnapshotFile():
+    def __init__(self, path, mapped, built_at, entries):
+        self.path = path
+        self.built_at = built_at
+        self._mapped = mapped
+        self._entries = entries
+
+    @classmethod
+    def open(cls, path):
+        # None when there is no usable snapshot; the service then simply starts cold.
+        try:
+            with open(path, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        try:
+            magic, format_version, directory_length = _HEADER.unpack_from(mapped, 0)
+            if magic != SNAPSHOT_MAGIC or format_version != SNAPSHOT_FORMAT_VERSION:
+                raise ValueError("unsupported snapshot")
+            directory = json.loads(mapped[_HEADER.size:_HEADER.size + directory_length].decode('utf-8'))
+            return cls(path, mapped, float(directory['built_at']), directory['entries'])
+        except (struct.error, ValueError, KeyError, TypeError):
+            mapped.close()
+            return None
+
+    def get_text(self, entry_name):
+        location = self._entries.get(entry_name)
+        if location is None:
+            return None
+        offset, length = location
+        return (self.built_at, self._mapped[offset:offset + length].decode('utf-8'))
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def write_route_snapshot(path, entries, built_at=None):
+    directory_entries = {}
+    blobs = []
+    # Offsets depend on the directory's own length, so lay the blobs out relative to the end of the
+    # directory first and shift them once its size is known.
+    relative_offset = 0
+    for entry_name, text in sorted(entries.items()):
+        blob = text.encode('utf-8')
+        directory_entries[entry_name] = [relative_offset, len(blob)]
+        blobs.append(blob)
+        relative_offset += len(blob)
+
+    built_at = time.time() if built_at is None else built_at
+    directory_length = 0
+    while True:
+        data_start = _HEADER.size + directory_length
+        directory = json.dumps({
+            "built_at": built_at,
+            "entries": {name: [data_start + offset, length] for name, (offset, length) in directory_entries.items()}
+        }, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        if len(directory) <= directory_length:
+            directory = directory.ljust(directory_length)
+            break
+        directory_length = len(directory)
+
+    # Written next to the target and swapped in, so running workers keep their mapping of the old file.
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT_VERSION, directory_length))
+        f.write(directory)
+        for blob in blobs:
+            f.write(blob)
+    os.replace(temp_path, path)
+
+
+def _compact_json(data):
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+
+def build_route_snapshot(api_base_url, path, route_names=None):
+    access_token = get_tdx_access_token()
+    if not access_token:
+        raise RuntimeError("無法獲取 TDX 存取權杖。")
+
+    all_variants, error_code = fetch_tdx_data_with_token(f"{api_base_url}/v2/Bus/StopOfRoute/InterCity", access_token, params={'$format': 'JSON'})
+    if error_code is not None or not isinstance(all_variants, list):
+        raise RuntimeError(f"無法下載 StopOfRoute 路線目錄 (代碼: {error_code})。")
+
+    variants_by_route = {}
+    for route_variant in all_variants:
+        route_name = (route_variant.get('RouteName') or {}).get('Zh_tw') if isinstance(route_variant, dict) else None
+        if route_name:
+            variants_by_route.setdefault(route_name, []).append(route_variant)
+
+    entries = {CATALOGUE_ENTRY: _compact_json(all_variants)}
+    for route_name in sorted(route_names or variants_by_route):
+        if route_name not in variants_by_route:
+            print(f"略過: TDX 路線目錄中沒有路線 '{route_name}'。", file=sys.stderr)
+            continue
+        entries[f"StopOfRoute/{route_name}"] = _compact_json(variants_by_route[route_name])
+        s2s_data, error_code = fetch_tdx_data_with_token(f"{api_base_url}/v2/Bus/S2STravelTime/InterCity/{route_name}", access_token, params={'$format': 'JSON'})
+        if error_code is not None or not isinstance(s2s_data, list):
+            print(f"略過: 路線 '{route_name}' 的 S2S 資料下載失敗 (代碼: {error_code})。", file=sys.stderr)
+            continue
+        entries[f"S2STravelTime/{route_name}"] = _compact_json(s2s_data)
+
+    write_route_snapshot(path, entries)
+    return entries
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Download static TDX route data into a snapshot file workers load at start-up.")
+    parser.add_argument('--out', default=os.environ.get('TDX_ROUTE_SNAPSHOT', 'route_snapshot.bin'), help="snapshot file to write")
+    parser.add_argument('--api-base-url', default=os.environ.get('TDX_API_BASE_URL', 'https://tdx.transportdata.tw/api/basic'))
+    parser.add_argument('--route', action='append', help="only include these route names (default: every InterCity route)")
+    args = parser.parse_args()
+
+    entries = build_route_snapshot(args.api_base_url.rstrip('/'), args.out, args.route)
+    print(f"已寫入 {args.out}: {len(entries)} 筆資料，{os.path.getsize(args.out)} bytes。")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+import math
+
+EARTH_RADIUS_METERS = 6371008.8
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS_METERS / 180
+
+
+def distance_meters(lat1, lon1, lat2, lon2):
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    half_dphi = math.radians(lat2 - lat1) / 2
+    half_dlambda = math.radians(lon2 - lon1) / 2
+    a = math.sin(half_dphi) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(half_dlambda) ** 2
+    return 2 * EARTH_RADIUS_METERS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _stop_position(stop):
+    position = stop.get('StopPosition')
+    if not isinstance(position, dict):
+        return None
+    lat, lon = position.get('PositionLat'), position.get('PositionLon')
+    if not isinstance(lat, (int, float)) or not isinstance(lon, (int, float)) or (lat == 0 and lon == 0):
+        return None
+    return (float(lat), float(lon))
+
+
+class GeoStop():
+    __slots__ = ('stop_id', 'name', 'lat', 'lon', 'served_by')
+
+    def __init__(self, stop_id, name, lat, lon):
+        self.stop_id = stop_id
+        self.name = name
+        self.lat = lat
+        self.lon = lon
+        # (route variant, stop sequence) for every route direction that calls here.
+        self.served_by = []
+
+
+class StopGridIndex():
+    # Buckets stops into fixed-size lat/lon cells; a radius query only looks at the few cells its bounding box
+    # touches instead of every stop on every route.
+    def __init__(self, raw_variants, route_variants, cell_meters):
+        self.cell_degrees = cell_meters / METERS_PER_DEGREE
+        self.stops = []
+        self._cells = {}
+        # Cell rows/columns that hold any stop; queries never scan outside them.
+        self._row_range = None
+        self._col_range = None
+        stops_by_id = {}
+        for raw_variant, route_variant in zip(raw_variants, route_variants):
+            raw_stops = raw_variant.get('Stops')
+            if not isinstance(raw_stops, list):
+                continue
+            for stop in raw_stops:
+                if not isinstance(stop, dict) or not stop.get('StopID'):
+                    continue
+                geo_stop = stops_by_id.get(stop['StopID'])
+                if geo_stop is None:
+                    position = _stop_position(stop)
+                    if position is None:
+                        continue
+                    geo_stop = stops_by_id[stop['StopID']] = GeoStop(
+                        stop['StopID'], (stop.get('StopName') or {}).get('Zh_tw'), position[0], position[1]
+                    )
+                    self.stops.append(geo_stop)
+                    self._cells.setdefault(self._cell(*position), []).append(geo_stop)
+                geo_stop.served_by.append((route_variant, stop.get('StopSequence')))
+        if self._cells:
+            rows = [row for row, _ in self._cells]
+            cols = [col for _, col in self._cells]
+            self._row_range = (min(rows), max(rows))
+            self._col_range = (min(cols), max(cols))
+
+    def _cell(self, lat, lon):
+        # Longitude cells use the same angular width as latitude ones; that only makes cells narrower (in
+        # metres) away from the equator, which a query compensates for by scanning more columns.
+        return (math.floor(lat / self.cell_degrees), math.floor(lon / self.cell_degrees))
+
+    def _cell_ranges(self, lat, lon, radius_meters):
+        # Rows and columns the query's bounding box touches, clipped to the populated ones; None if it misses them.
+        if self._row_range is None:
+            return None
+        lat_span = radius_meters / METERS_PER_DEGREE
+        # Capped at half the globe: near the poles the span would otherwise run to millions of columns.
+        lon_span = min(radius_meters / (METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 1e-6)), 180.0)
+        min_row, min_col = self._cell(lat - lat_span, lon - lon_span)
+        max_row, max_col = self._cell(lat + lat_span, lon + lon_span)
+        min_row, max_row = max(min_row, self._row_range[0]), min(max_row, self._row_range[1])
+        min_col, max_col = max(min_col, self._col_range[0]), min(max_col, self._col_range[1])
+        if min_row > max_row or min_col > max_col:
+            return None
+        return (min_row, max_row), (min_col, max_col)
+
+    def covers(self, lat, lon, radius_meters):
+        return self._cell_ranges(lat, lon, radius_meters) is not None
+
+    def nearby(self, lat, lon, radius_meters, limit=None):
+        cell_ranges = self._cell_ranges(lat, lon, radius_meters)
+        if cell_ranges is None:
+            return []
+        (min_row, max_row), (min_col, max_col) = cell_ranges
+        if (max_row - min_row + 1) * (max_col - min_col + 1) > len(self._cells):
+            # A box wider than the whole index is cheaper to answer by walking the populated cells.
+            candidate_cells = [
+                geo_stops for (row, col), geo_stops in self._cells.items()
+                if min_row <= row <= max_row and min_col <= col <= max_col
+            ]
+        else:
+            candidate_cells = [
+                self._cells.get((row, col), ())
+                for row in range(min_row, max_row + 1) for col in range(min_col, max_col + 1)
+            ]
+        matches = []
+        for geo_stops in candidate_cells:
+            for geo_stop in geo_stops:
+                distance = distance_meters(lat, lon, geo_stop.lat, geo_stop.lon)
+                if distance <= radius_meters:
+                    matches.append((distance, geo_stop))
+        matches.sort(key=lambda match: match[0])
+        return matches[:limit] if limit is not None else matches
@@ -50,6 +50,15 @@ document.addEventListener('DOMContentLoaded', () => {
         etaList.innerHTML = '';
     }
 
+    let etaEventSource = null;
+
+    function closeEtaStream() {
+        if (etaEventSource) {
+            etaEventSource.close();
+            etaEventSource = null;
+        }
+    }
+
     routeInput.addEventListener('input', () => {
         searchRouteBtn.disabled = !routeInput.value.trim();
     });
@@ -61,6 +70,7 @@ document.addEventListener('DOMContentLoaded', () => {
     });
 
     searchRouteBtn.addEventListener('click', async () => {
+        closeEtaStream();
         clearMessages();
         const routeKeyword = routeInput.value.trim();
         if (!routeKeyword) {
@@ -160,6 +170,7 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 
     routeSelect.addEventListener('change', () => {
+        closeEtaStream();
         resetEtaResults();
         
         if (routeSelect.value) {
@@ -199,63 +210,96 @@ document.addEventListener('DOMContentLoaded', () => {
             return;
         }
 
+        const busInfoQuery = `${plateNumber}?route_name=${encodeURIComponent(routeNameForETA)}&direction=${directionForETA}`;
+
+        closeEtaStream();
+        if (window.EventSource) {
+            // The server pushes a new payload only when the bus's TDX data changes.
+            const eventSource = new EventSource(`${API_BASE_URL}/api/bus_info_stream/${busInfoQuery}`);
+            etaEventSource = eventSource;
+            eventSource.addEventListener('eta', (event) => {
+                toggleLoader(false);
+                clearMessages();
+                resetEtaResults();
+                renderEtaData(JSON.parse(event.data));
+            });
+            eventSource.onerror = () => {
+                if (eventSource.readyState === EventSource.CLOSED && etaEventSource === eventSource) {
+                    etaEventSource = null;
+                    fetchETAOnce(busInfoQuery);
+                }
+            };
+            return;
+        }
+        fetchETAOnce(busInfoQuery);
+    }
+
+    async function fetchETAOnce(busInfoQuery) {
         try {
-            const response = await fetch(`${API_BASE_URL}/api/bus_info/${plateNumber}?route_name=${encodeURIComponent(routeNameForETA)}&direction=${directionForETA}`);
+            const response = await fetch(`${API_BASE_URL}/api/bus_info/${busInfoQuery}`);
             const data = await response.json();
             
             if (!response.ok) {
                  throw new Error(data.error || `無法取得預估到站時間 (HTTP ${response.status})`);
             }
-            if (data.error) {
-                showMessage(data.error, 'error');
-                if (data.bus_details) {
-                     busDetailsInfoDiv.innerHTML = `
-                        <h3>公車 ${data.bus_details.plate_numb} (${data.bus_details.route_name} - ${data.bus_details.direction})</h3>
-                        <p>
-                            <strong>目前位置:</strong> ${data.bus_details.current_stop_name} (站序 ${data.bus_details.current_stop_sequence || 'N/A'})<br>
-                            <strong>GPS時間:</strong> ${data.bus_details.gps_time || 'N/A'}
-                        </p>`;
-                }
-                etaResultsContainer.style.display = 'block';
-                return; 
-            }
-            
+            renderEtaData(data);
+        } catch (error) {
+            showMessage(`無法取得預估到站時間: ${error.message}`, 'error');
+        } finally {
+            toggleLoader(false);
+        }
+    }
+
+    function renderEtaData(data) {
+        if (data.error) {
+            showMessage(data.error, 'error');
             if (data.bus_details) {
-                busDetailsInfoDiv.innerHTML = `
+                 busDetailsInfoDiv.innerHTML = `
                     <h3>公車 ${data.bus_details.plate_numb} (${data.bus_details.route_name} - ${data.bus_details.direction})</h3>
                     <p>
                         <strong>目前位置:</strong> ${data.bus_details.current_stop_name} (站序 ${data.bus_details.current_stop_sequence || 'N/A'})<br>
                         <strong>GPS時間:</strong> ${data.bus_details.gps_time || 'N/A'}
-                    </p>
-                `;
-            }
-
-            if (data.upcoming_stops && data.upcoming_stops.length > 0) {
-                data.upcoming_stops.forEach(stop => {
-                    const li = document.createElement('li');
-                    li.textContent = `停靠站 ${stop.stop_sequence}: ${stop.stop_name} - ${stop.arrival_status}`;
-                    etaList.appendChild(li);
-                });
-            } else if (data.message) {
-                const messageItem = document.createElement('li');
-                messageItem.textContent = data.message;
-                etaList.appendChild(messageItem);
-            } else { 
-                const noStopsItem = document.createElement('li');
-                noStopsItem.textContent = "目前無此公車後續停靠站的預估時間。";
-                etaList.appendChild(noStopsItem);
+                    </p>`;
             }
             etaResultsContainer.style.display = 'block';
+            return; 
+        }
+        
+        if (data.stale) {
+            showMessage(`TDX 暫時無法取得最新資料，以下為約 ${data.data_age_seconds} 秒前的資料。`, 'info');
+        }
 
-        } catch (error) {
-            showMessage(`無法取得預估到站時間: ${error.message}`, 'error');
-        } finally {
-            toggleLoader(false);
+        if (data.bus_details) {
+            busDetailsInfoDiv.innerHTML = `
+                <h3>公車 ${data.bus_details.plate_numb} (${data.bus_details.route_name} - ${data.bus_details.direction})</h3>
+                <p>
+                    <strong>目前位置:</strong> ${data.bus_details.current_stop_name} (站序 ${data.bus_details.current_stop_sequence || 'N/A'})<br>
+                    <strong>GPS時間:</strong> ${data.bus_details.gps_time || 'N/A'}
+                </p>
+            `;
+        }
+
+        if (data.upcoming_stops && data.upcoming_stops.length > 0) {
+            data.upcoming_stops.forEach(stop => {
+                const li = document.createElement('li');
+                li.textContent = `停靠站 ${stop.stop_sequence}: ${stop.stop_name} - ${stop.arrival_status}`;
+                etaList.appendChild(li);
+            });
+        } else if (data.message) {
+            const messageItem = document.createElement('li');
+            messageItem.textContent = data.message;
+            etaList.appendChild(messageItem);
+        } else { 
+            const noStopsItem = document.createElement('li');
+            noStopsItem.textContent = "目前無此公車後續停靠站的預估時間。";
+            etaList.appendChild(noStopsItem);
         }
+        etaResultsContainer.style.display = 'block';
     }
 
     busSelect.addEventListener('change', () => {
         getEtaButton.disabled = !(routeSelect.value && busSelect.value);
+        closeEtaStream();
         resetEtaResults();
     });
 
@@ -0,0 +1,375 @@
+import asyncio
+import contextvars
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from auth_TDX import fetch_tdx_data_async, fetch_tdx_data_with_token, tdx_dataset_name, tdx_request_key
+from metrics import timed
+from route_snapshot import RouteSnapshotFile, snapshot_entry_name
+from tdx_rate_limit import PRIORITY_BACKGROUND, tdx_priority
+
+CACHE_TTL_SECONDS = {
+    'StopOfRoute': int(os.environ.get('TDX_CACHE_TTL_STOP_OF_ROUTE', 6 * 3600)),
+    'S2STravelTime': int(os.environ.get('TDX_CACHE_TTL_S2S', 12 * 3600)),
+}
+# Past its TTL an entry is still served, flagged as stale, for this long while it is refreshed in the background.
+CACHE_MAX_STALE_SECONDS = {
+    'StopOfRoute': int(os.environ.get('TDX_CACHE_MAX_STALE_STOP_OF_ROUTE', 7 * 24 * 3600)),
+    'S2STravelTime': int(os.environ.get('TDX_CACHE_MAX_STALE_S2S', 7 * 24 * 3600)),
+}
+CACHE_MAX_ENTRIES = int(os.environ.get('TDX_CACHE_MAX_ENTRIES', 256))
+CACHE_DB_PATH = os.environ.get('TDX_CACHE_DB')
+# Built by `python route_snapshot.py`; used as a read-only tier below memory and SQLite when the file exists.
+TDX_ROUTE_SNAPSHOT = os.environ.get('TDX_ROUTE_SNAPSHOT', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'route_snapshot.bin'))
+
+# Realtime responses are never served from cache, but when TDX fails the last good response for the same
+# query is used instead if it is at most this old.
+TDX_REALTIME_MAX_STALE = float(os.environ.get('TDX_REALTIME_MAX_STALE', 90))
+TDX_LAST_KNOWN_GOOD_ENTRIES = int(os.environ.get('TDX_LAST_KNOWN_GOOD_ENTRIES', 1024))
+
+# (dataset, age_seconds) for every stale payload used while building the current response; None when untracked.
+_stale_reads = contextvars.ContextVar('stale_reads', default=None)
+
+
+class MemoryLRUStore():
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, stored_at, data):
+        with self._lock:
+            self._entries[key] = (stored_at, data)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteStore():
+    def __init__(self, db_path, max_entries):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS tdx_cache ("
+                "key TEXT PRIMARY KEY, stored_at REAL NOT NULL, "
+                "accessed_at REAL NOT NULL, payload TEXT NOT NULL)"
+            )
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        entry = self.get_text(key)
+        if entry is None:
+            return None
+        try:
+            return (entry[0], json.loads(entry[1]))
+        except json.JSONDecodeError:
+            return None
+
+    def get_text(self, key):
+        try:
+            conn = self._connect()
+            row = conn.execute("SELECT stored_at, payload FROM tdx_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            with conn:
+                conn.execute("UPDATE tdx_cache SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            return (row[0], row[1])
+        except sqlite3.Error:
+            return None
+
+    def put(self, key, stored_at, data):
+        self.put_text(key, stored_at, json.dumps(data, ensure_ascii=False))
+
+    def put_text(self, key, stored_at, payload):
+        try:
+            conn = self._connect()
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO tdx_cache (key, stored_at, accessed_at, payload) VALUES (?, ?, ?, ?)",
+                    (key, stored_at, time.time(), payload)
+                )
+                conn.execute(
+                    "DELETE FROM tdx_cache WHERE key IN ("
+                    "SELECT key FROM tdx_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,)
+                )
+        except sqlite3.Error:
+            pass
+
+    def delete(self, key):
+        try:
+            conn = self._connect()
+            with conn:
+                conn.execute("DELETE FROM tdx_cache WHERE key = ?", (key,))
+        except sqlite3.Error:
+            pass
+
+
+class TDXCache():
+    def __init__(self, ttl_seconds, max_entries, db_path=None, max_stale_seconds=None, snapshot=None):
+        self.ttl_seconds = ttl_seconds
+        self.max_stale_seconds = max_stale_seconds or {}
+        self.memory = MemoryLRUStore(max_entries)
+        self.disk = SQLiteStore(db_path, max_entries) if db_path else None
+        self.snapshot = snapshot
+        self._stats_lock = threading.Lock()
+        self._stats = {}
+
+    def _count(self, dataset, outcome):
+        with self._stats_lock:
+            dataset_stats = self._stats.setdefault(dataset, {"hits": 0, "disk_hits": 0, "snapshot_hits": 0, "stale_hits": 0, "misses": 0})
+            dataset_stats[outcome] += 1
+
+    @staticmethod
+    def _memory_key(key, parse):
+        # The memory tier holds parsed objects, the disk tier the raw JSON they were parsed from.
+        return key if parse is None else f"{key}#{parse.__name__}"
+
+    def is_fresh(self, dataset, stored_at):
+        return time.time() - stored_at < self.ttl_seconds[dataset]
+
+    def _max_age(self, dataset):
+        return self.ttl_seconds[dataset] + self.max_stale_seconds.get(dataset, 0)
+
+    def get_memory(self, key, dataset, parse=None, decode=None):
+        # The memory tier alone: no JSON decoding or disk access, so it is safe to call from the event loop.
+        memory_key = self._memory_key(key, decode or parse)
+        entry = self.memory.get(memory_key)
+        if entry is None:
+            return None
+        if time.time() - entry[0] >= self._max_age(dataset):
+            self.memory.delete(memory_key)
+            return None
+        self._count(dataset, "hits" if self.is_fresh(dataset, entry[0]) else "stale_hits")
+        return entry
+
+    def get(self, key, dataset, parse=None, decode=None, snapshot_name=None):
+        # Returns (stored_at, data) for an entry that may still be served, fresh or stale, otherwise None.
+        entry = self.get_memory(key, dataset, parse, decode)
+        if entry is not None:
+            return entry
+        max_age = self._max_age(dataset)
+        now = time.time()
+        memory_key = self._memory_key(key, decode or parse)
+
+        if self.disk is not None:
+            entry = self.disk.get_text(key) if decode is not None else self.disk.get(key)
+            if entry is not None:
+                if now - entry[0] < max_age:
+                    if decode is not None:
+                        data, error_code = decode_tdx_text(entry[1], decode, dataset)
+                    else:
+                        data, error_code = (parse(entry[1]) if parse is not None else entry[1], None)
+                    if error_code is None:
+                        self.memory.put(memory_key, entry[0], data)
+                        self._count(dataset, "disk_hits" if self.is_fresh(dataset, entry[0]) else "stale_hits")
+                        return (entry[0], data)
+                self.disk.delete(key)
+
+        if self.snapshot is not None and snapshot_name is not None:
+            entry = self.snapshot.get_text(snapshot_name)
+            if entry is not None and now - entry[0] < max_age:
+                data, error_code = decode_tdx_text(entry[1], decode or json.loads, dataset)
+                if error_code is None:
+                    data = parse(data) if parse is not None and decode is None else data
+                    self.memory.put(memory_key, entry[0], data)
+                    self._count(dataset, "snapshot_hits" if self.is_fresh(dataset, entry[0]) else "stale_hits")
+                    return (entry[0], data)
+
+        self._count(dataset, "misses")
+        return None
+
+    def put(self, key, data, parse=None):
+        stored_at = time.time()
+        if self.disk is not None:
+            self.disk.put(key, stored_at, data)
+        if parse is not None:
+            data = parse(data)
+        self.memory.put(self._memory_key(key, parse), stored_at, data)
+        return data
+
+    def put_text(self, key, text, data, decode):
+        # data is decode(text); the text itself is what the disk tier keeps.
+        stored_at = time.time()
+        if self.disk is not None:
+            self.disk.put_text(key, stored_at, text)
+        self.memory.put(self._memory_key(key, decode), stored_at, data)
+
+    def stats(self):
+        with self._stats_lock:
+            per_dataset = {dataset: dict(counts) for dataset, counts in self._stats.items()}
+        return {
+            "hits": sum(c["hits"] + c["disk_hits"] + c["snapshot_hits"] + c["stale_hits"] for c in per_dataset.values()),
+            "misses": sum(c["misses"] for c in per_dataset.values()),
+            "memory_entries": len(self.memory),
+            "datasets": per_dataset
+        }
+
+
+_tdx_cache = TDXCache(
+    CACHE_TTL_SECONDS, CACHE_MAX_ENTRIES, CACHE_DB_PATH, CACHE_MAX_STALE_SECONDS,
+    RouteSnapshotFile.open(TDX_ROUTE_SNAPSHOT) if TDX_ROUTE_SNAPSHOT else None
+)
+_last_known_good = MemoryLRUStore(TDX_LAST_KNOWN_GOOD_ENTRIES)
+
+_revalidating = set()
+_revalidating_lock = threading.Lock()
+
+
+def begin_stale_tracking():
+    return _stale_reads.set([])
+
+
+def stale_reads():
+    return list(_stale_reads.get() or [])
+
+
+def end_stale_tracking(context_token):
+    _stale_reads.reset(context_token)
+
+
+def _record_stale_read(dataset, stored_at):
+    reads = _stale_reads.get()
+    if reads is not None:
+        reads.append((dataset, time.time() - stored_at))
+
+
+def decode_tdx_text(text, decode, dataset):
+    with timed('json_decode', dataset):
+        try:
+            return (decode(text), None)
+        except ValueError:
+            return (None, "JSON_DECODE_ERROR")
+
+
+def _store_fetched(key, dataset, data, error_code, parse, decode):
+    if error_code is not None or data is None:
+        return (data, error_code)
+    if decode is not None:
+        text = data
+        data, error_code = decode_tdx_text(text, decode, dataset)
+        if error_code is None and dataset in CACHE_TTL_SECONDS:
+            _tdx_cache.put_text(key, text, data, decode)
+        return (data, error_code)
+    if dataset in CACHE_TTL_SECONDS:
+        return (_tdx_cache.put(key, data, parse), None)
+    return (parse(data) if parse is not None else data, None)
+
+
+def _revalidate(api_url, access_token, params, parse, decode, key):
+    try:
+        with tdx_priority(PRIORITY_BACKGROUND):
+            data, error_code = fetch_tdx_data_with_token(api_url, access_token, params=params, as_text=decode is not None)
+            _store_fetched(key, tdx_dataset_name(api_url), data, error_code, parse, decode)
+    finally:
+        with _revalidating_lock:
+            _revalidating.discard(key)
+
+
+def _serve_cached(api_url, access_token, params, parse, decode, key, dataset):
+    return _serve_entry(
+        _tdx_cache.get(key, dataset, parse, decode, snapshot_entry_name(api_url, params)),
+        api_url, access_token, params, parse, decode, key, dataset
+    )
+
+
+def _serve_entry(entry, api_url, access_token, params, parse, decode, key, dataset):
+    if entry is None:
+        return None
+    stored_at, data = entry
+    if not _tdx_cache.is_fresh(dataset, stored_at):
+        # Stale-while-revalidate: answer with the old copy now and refresh it off the request path.
+        _record_stale_read(dataset, stored_at)
+        with _revalidating_lock:
+            start_refresh = key not in _revalidating
+            _revalidating.add(key)
+        if start_refresh:
+            threading.Thread(
+                target=_revalidate, args=(api_url, access_token, params, parse, decode, key), name='tdx-revalidate', daemon=True
+            ).start()
+    return (data, None)
+
+
+def fetch_tdx_data_cached(api_url, access_token, params=None, parse=None, decode=None):
+    # parse, when given, turns the decoded payload into the form callers keep (see route_data). decode
+    # replaces both steps: it builds that form straight from the response text, e.g. incrementally.
+    dataset = tdx_dataset_name(api_url)
+    key = tdx_request_key(api_url, params)
+    if dataset in CACHE_TTL_SECONDS:
+        cached_result = _serve_cached(api_url, access_token, params, parse, decode, key, dataset)
+        if cached_result is not None:
+            return cached_result
+
+    data, error_code = fetch_tdx_data_with_token(api_url, access_token, params=params, as_text=decode is not None)
+    return _store_fetched(key, dataset, data, error_code, parse, decode)
+
+
+async def fetch_tdx_data_cached_async(api_url, access_token, params=None, parse=None, decode=None):
+    dataset = tdx_dataset_name(api_url)
+    key = tdx_request_key(api_url, params)
+    if dataset in CACHE_TTL_SECONDS:
+        entry = _tdx_cache.get_memory(key, dataset, parse, decode)
+        if entry is None:
+            # Lower tiers read SQLite and decode JSON, which would stall every request sharing the loop.
+            entry = await asyncio.to_thread(_tdx_cache.get, key, dataset, parse, decode, snapshot_entry_name(api_url, params))
+        cached_result = _serve_entry(entry, api_url, access_token, params, parse, decode, key, dataset)
+        if cached_result is not None:
+            return cached_result
+
+    data, error_code = await fetch_tdx_data_async(api_url, access_token, params=params, as_text=decode is not None)
+    if error_code is not None:
+        return (data, error_code)
+    return await asyncio.to_thread(_store_fetched, key, dataset, data, error_code, parse, decode)
+
+
+def _with_last_known_good(api_url, params, result):
+    key = tdx_request_key(api_url, params)
+    data, error_code = result
+    if error_code is None:
+        _last_known_good.put(key, time.time(), data)
+        return result
+    entry = _last_known_good.get(key)
+    if entry is None or time.time() - entry[0] > TDX_REALTIME_MAX_STALE:
+        return result
+    _record_stale_read(tdx_dataset_name(api_url), entry[0])
+    return (entry[1], None)
+
+
+def fetch_tdx_data_with_fallback(api_url, access_token, params=None):
+    # For realtime datasets: always asks TDX, and only falls back to the last good answer when that fails.
+    return _with_last_known_good(api_url, params, fetch_tdx_data_with_token(api_url, access_token, params=params))
+
+
+async def fetch_tdx_data_with_fallback_async(api_url, access_token, params=None):
+    return _with_last_known_good(api_url, params, await fetch_tdx_data_async(api_url, access_token, params=params))
+
+
+def get_cache_stats():
+    return _tdx_cache.stats()
@@ -0,0 +1,130 @@
+import asyncio
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from request_budget import cap_timeout
+
+# Client-side token bucket in front of every TDX data request. The bucket is per process, so with several
+# gunicorn workers set TDX_RATE_LIMIT_RPS to the account quota divided by the worker count. 0 disables it.
+TDX_RATE_LIMIT_RPS = float(os.environ.get('TDX_RATE_LIMIT_RPS', 5))
+TDX_RATE_LIMIT_BURST = float(os.environ.get('TDX_RATE_LIMIT_BURST', 10))
+
+PRIORITY_REALTIME = 0
+PRIORITY_STATIC = 1
+PRIORITY_BACKGROUND = 2
+
+# How long a request of each priority may queue for a token before it is given up without being sent.
+RATE_LIMIT_MAX_WAIT = {
+    PRIORITY_REALTIME: float(os.environ.get('TDX_RATE_LIMIT_MAX_WAIT', 3)),
+    PRIORITY_STATIC: float(os.environ.get('TDX_RATE_LIMIT_MAX_WAIT_STATIC', 10)),
+    PRIORITY_BACKGROUND: float(os.environ.get('TDX_RATE_LIMIT_MAX_WAIT_BACKGROUND', 120)),
+}
+# Tokens background work must leave in the bucket, so a burst of user requests right after it still fits.
+TDX_RATE_LIMIT_BACKGROUND_HEADROOM = float(os.environ.get('TDX_RATE_LIMIT_BACKGROUND_HEADROOM', TDX_RATE_LIMIT_BURST / 2))
+
+REALTIME_DATASETS = {'RealTimeByFrequency', 'RealTimeNearStop', 'EstimatedTimeOfArrival'}
+
+_priority_override = contextvars.ContextVar('tdx_priority', default=None)
+
+
+class TDXRateLimited(Exception):
+    pass
+
+
+class TokenBucketScheduler():
+    def __init__(self, rate, burst, background_headroom=0.0):
+        self.rate = rate
+        self.burst = burst
+        self.headroom = {PRIORITY_REALTIME: 0.0, PRIORITY_STATIC: 0.0, PRIORITY_BACKGROUND: background_headroom}
+        self._tokens = burst
+        self._updated_at = time.monotonic()
+        self._waiting = {priority: 0 for priority in self.headroom}
+        self._lock = threading.Lock()
+
+    def _take(self, priority):
+        # Takes a token if this priority may go now; otherwise returns how long to wait before trying again.
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            needed = min(1 + self.headroom[priority], self.burst)
+            if any(self._waiting[higher] for higher in range(priority)):
+                return 1 / self.rate
+            if self._tokens >= needed:
+                self._tokens -= 1
+                return 0.0
+            return (needed - self._tokens) / self.rate
+
+    def _set_waiting(self, priority, delta):
+        with self._lock:
+            self._waiting[priority] += delta
+
+    def acquire(self, priority, max_wait):
+        deadline = time.monotonic() + max_wait
+        self._set_waiting(priority, 1)
+        try:
+            while True:
+                delay = self._take(priority)
+                if delay == 0.0:
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                time.sleep(min(delay, remaining))
+        finally:
+            self._set_waiting(priority, -1)
+
+    async def acquire_async(self, priority, max_wait):
+        deadline = time.monotonic() + max_wait
+        self._set_waiting(priority, 1)
+        try:
+            while True:
+                delay = self._take(priority)
+                if delay == 0.0:
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                await asyncio.sleep(min(delay, remaining))
+        finally:
+            self._set_waiting(priority, -1)
+
+
+_scheduler = TokenBucketScheduler(TDX_RATE_LIMIT_RPS, TDX_RATE_LIMIT_BURST, TDX_RATE_LIMIT_BACKGROUND_HEADROOM) if TDX_RATE_LIMIT_RPS > 0 else None
+
+
+@contextmanager
+def tdx_priority(priority):
+    # Marks TDX calls made inside the block, e.g. a background prefetch, regardless of their dataset.
+    context_token = _priority_override.set(priority)
+    try:
+        yield
+    finally:
+        _priority_override.reset(context_token)
+
+
+def request_priority(dataset):
+    priority = _priority_override.get()
+    if priority is not None:
+        return priority
+    return PRIORITY_REALTIME if dataset in REALTIME_DATASETS else PRIORITY_STATIC
+
+
+def wait_for_slot(dataset):
+    if _scheduler is None:
+        return
+    priority = request_priority(dataset)
+    if not _scheduler.acquire(priority, cap_timeout(RATE_LIMIT_MAX_WAIT[priority])):
+        raise TDXRateLimited(dataset)
+
+
+async def wait_for_slot_async(dataset):
+    if _scheduler is None:
+        return
+    priority = request_priority(dataset)
+    if not await _scheduler.acquire_async(priority, cap_timeout(RATE_LIMIT_MAX_WAIT[priority])):
+        raise TDXRateLimited(dataset)
+
@@ -0,0 +1,123 @@
+from datetime import datetime, timedelta
+
+from learned_travel_times import TDX_TIMEZONE, SegmentTravelTimeStore, _slot
+
+MONDAY_8AM = datetime(2024, 1, 1, 8, 0, tzinfo=TDX_TIMEZONE)
+
+
+def _bus(plate, sequence, stop_id, gps_time, sub_route_uid='THB181501', direction=0):
+    return {
+        'PlateNumb': plate, 'SubRouteUID': sub_route_uid, 'Direction': direction,
+        'StopSequence': sequence, 'StopID': stop_id, 'GPSTime': gps_time
+    }
+
+
+def _drive(store, plate, run_times, start=MONDAY_8AM):
+    # Reports the bus at stops 1, 2, ... with the given seconds between consecutive stops.
+    moment = start
+    store.observe(_bus(plate, 1, 'S1', moment.isoformat()))
+    for offset, seconds in enumerate(run_times, start=2):
+        moment += timedelta(seconds=seconds)
+        store.observe(_bus(plate, offset, f'S{offset}', moment.isoformat()))
+
+
+def test_median_of_observed_segment():
+    store = SegmentTravelTimeStore(max_entries=100, min_samples=3)
+    for plate, seconds in (('A', 100), ('B', 300), ('C', 200)):
+        _drive(store, plate, [seconds])
+    assert len(store) == 3
+    assert store.median_seconds('S1', 'S2', 0, 8) == 200
+    assert store.median_seconds('S1', 'S2', 0, 9) is None
+    assert store.median_seconds('S2', 'S1', 0, 8) is None
+
+
+def test_median_needs_min_samples():
+    store = SegmentTravelTimeStore(max_entries=100, min_samples=3)
+    _drive(store, 'A', [100])
+    _drive(store, 'B', [300])
+    assert store.median_seconds('S1', 'S2', 0, 8) is None
+    _drive(store, 'C', [200])
+    assert store.median_seconds('S1', 'S2', 0, 8) == 200
+
+
+def test_median_of_even_count_takes_upper_middle():
+    store = SegmentTravelTimeStore(max_entries=100, min_samples=1)
+    for seconds in (40, 10, 30, 20):
+        store._record(('S1', 'S2'), _slot(MONDAY_8AM), seconds)
+    assert store.median_seconds('S1', 'S2', 0, 8) == 30
+
+
+def test_ring_log_wraps_and_drops_oldest_observations():
+    store = SegmentTravelTimeStore(max_entries=3, min_samples=1)
+    slot = _slot(MONDAY_8AM)
+    for seconds in (10, 20, 30):
+        store._record(('S1', 'S2'), slot, seconds)
+    assert len(store) == 3
+    assert store.median_seconds('S1', 'S2', 0, 8) == 20
+
+    # Each further observation overwrites the oldest one, so the cell only ever holds the latest three.
+    for seconds in (400, 500):
+        store._record(('S1', 'S2'), slot, seconds)
+    assert len(store) == 3
+    assert store._cells[(0, slot)] == [30, 400, 500]
+    assert store.median_seconds('S1', 'S2', 0, 8) == 400
+
+
+def test_ring_log_wraparound_across_cells():
+    store = SegmentTravelTimeStore(max_entries=2, min_samples=1)
+    slot = _slot(MONDAY_8AM)
+    store._record(('S1', 'S2'), slot, 100)
+    store._record(('S2', 'S3'), slot, 50)
+    store._record(('S2', 'S3'), slot, 70)
+    # The S1 -> S2 observation was the oldest in the log and is gone; its cell is empty, not stale.
+    assert store.median_seconds('S1', 'S2', 0, 8) is None
+    assert store.median_seconds('S2', 'S3', 0, 8) == 70
+    store._record(('S1', 'S2'), slot + 1, 120)
+    assert store.median_seconds('S2', 'S3', 0, 8) == 70
+    assert store.median_seconds('S1', 'S2', 0, 9) == 120
+    assert sum(len(samples) for samples in store._cells.values()) == 2
+
+
+def test_fractional_seconds_survive_eviction():
+    # Values are read back from the float32 column, so one that float32 cannot represent exactly still
+    # matches its sorted-list copy when the ring evicts it.
+    store = SegmentTravelTimeStore(max_entries=2, min_samples=1)
+    slot = _slot(MONDAY_8AM)
+    for seconds in (0.1, 0.2, 0.3, 0.4):
+        store._record(('S1', 'S2'), slot, seconds)
+    assert len(store._cells[(0, slot)]) == 2
+
+
+def test_ignores_repeated_skipped_and_slow_reports():
+    store = SegmentTravelTimeStore(max_entries=100, min_samples=1, max_segment_seconds=600)
+    store.observe(_bus('A', 1, 'S1', '2024-01-01T08:00:00+08:00'))
+    # Same position reported again (cached data), then an older report: neither is a segment.
+    store.observe(_bus('A', 1, 'S1', '2024-01-01T08:01:00+08:00'))
+    store.observe(_bus('A', 2, 'S2', '2024-01-01T07:59:00+08:00'))
+    assert len(store) == 0
+    # Skipping a stop, switching sub route, or a gap over max_segment_seconds records nothing.
+    store.observe(_bus('A', 3, 'S3', '2024-01-01T08:02:00+08:00'))
+    store.observe(_bus('A', 4, 'S4', '2024-01-01T08:03:00+08:00', sub_route_uid='THB181502'))
+    store.observe(_bus('A', 5, 'S5', '2024-01-01T08:20:00+08:00', sub_route_uid='THB181502'))
+    assert len(store) == 0
+    store.observe(_bus('A', 6, 'S6', '2024-01-01T08:21:30+08:00', sub_route_uid='THB181502'))
+    assert store.median_seconds('S5', 'S6', 0, 8) == 90
+
+
+def test_ignores_unusable_reports():
+    store = SegmentTravelTimeStore(max_entries=100, min_samples=1)
+    store.observe(_bus('-1', 1, 'S1', '2024-01-01T08:00:00+08:00'))
+    store.observe(_bus('A', '1', 'S1', '2024-01-01T08:00:00+08:00'))
+    store.observe(_bus('A', 1, 'S1', 'not a time'))
+    store.observe(_bus('A', 1, 'S1', None))
+    assert len(store._positions) == 0
+
+
+def test_mixed_offset_and_naive_gps_times():
+    # A naive GPSTime is local Taiwan time; slots use the local hour whatever offset the report carried.
+    store = SegmentTravelTimeStore(max_entries=100, min_samples=1)
+    store.observe(_bus('A', 1, 'S1', '2024-01-01T08:00:00'))
+    store.observe(_bus('A', 2, 'S2', '2024-01-01T00:02:00+00:00'))
+    store.observe(_bus('A', 3, 'S3', '2024-01-01T08:05:00+08:00'))
+    assert store.median_seconds('S1', 'S2', 0, 8) == 120
+    assert store.median_seconds('S2', 'S3', 0, 8) == 180
@@ -0,0 +1,103 @@
+import json
+import math
+
+import pytest
+
+from route_data import decode_s2s_travel_time, iter_json_array, parse_s2s_travel_time
+
+S2S_PAYLOAD = [
+    {
+        'RouteUID': 'THB1815', 'SubRouteUID': 'THB181501', 'Direction': 0,
+        'TravelTimes': [
+            {
+                'Weekday': 1, 'StartHour': 7, 'EndHour': 9,
+                'S2STimes': [
+                    {'FromStopID': 'A', 'ToStopID': 'B', 'RunTime': 120},
+                    {'FromStopID': 'B', 'ToStopID': 'C', 'RunTime': -1}
+                ]
+            },
+            {'Weekday': 2, 'StartHour': 7, 'EndHour': 9}
+        ]
+    },
+    'not an entry',
+    {'RouteUID': 'THB1816', 'SubRouteUID': 'THB181601', 'Direction': 1, 'TravelTimes': None}
+]
+
+
+def _as_tuples(entries):
+    return [
+        (entry.route_uid, entry.sub_route_uid, entry.direction, None if entry.travel_times is None else [
+            (t.weekday, t.start_hour, t.end_hour, t.from_stop_ids, t.to_stop_ids,
+             None if t.run_times is None else ['nan' if math.isnan(r) else r for r in t.run_times])
+            for t in entry.travel_times
+        ])
+        for entry in entries
+    ]
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('[]', []),
+    (' \n[ \t]\r\n', []),
+    ('[1]', [1]),
+    ('[{"a": [1, 2]}, "x" , null,true]', [{'a': [1, 2]}, 'x', None, True]),
+])
+def test_iter_json_array_matches_json_loads(text, expected):
+    assert list(iter_json_array(text)) == expected == json.loads(text)
+
+
+@pytest.mark.parametrize('text', [
+    '',
+    '   ',
+    '{"a": 1}',
+    '[',
+    '[1',
+    '[1,',
+    '[1,]',
+    '[,1]',
+    '[1 2]',
+    '[{"a": 1}',
+    '[{"a": ',
+    '[1]]',
+    '[1] x',
+    '[][]',
+])
+def test_iter_json_array_rejects_malformed_and_truncated_input(text):
+    with pytest.raises(ValueError):
+        list(iter_json_array(text))
+
+
+def test_iter_json_array_yields_elements_before_a_truncation():
+    elements = iter_json_array('[1, 2, {"a"')
+    assert next(elements) == 1
+    assert next(elements) == 2
+    with pytest.raises(ValueError):
+        next(elements)
+
+
+def test_decode_s2s_travel_time_matches_parsing_the_loaded_payload():
+    text = json.dumps(S2S_PAYLOAD)
+    decoded = decode_s2s_travel_time(text)
+    assert _as_tuples(decoded) == _as_tuples(parse_s2s_travel_time(json.loads(text)))
+    assert _as_tuples(decoded)[0][3][0][5] == [120, 'nan']
+
+
+def test_decode_s2s_travel_time_empty_array():
+    assert decode_s2s_travel_time('[]') == []
+    assert decode_s2s_travel_time('  [ ]  ') == []
+
+
+def test_decode_s2s_travel_time_passes_non_array_payloads_through():
+    # TDX error bodies are objects; they are returned as-is, like parse_s2s_travel_time does.
+    assert decode_s2s_travel_time('{"Message": "error"}') == {'Message': 'error'}
+
+
+@pytest.mark.parametrize('text', [
+    '',
+    '[',
+    json.dumps(S2S_PAYLOAD)[:-1],
+    json.dumps(S2S_PAYLOAD)[:40],
+    json.dumps(S2S_PAYLOAD) + ',',
+])
+def test_decode_s2s_travel_time_rejects_malformed_and_truncated_input(text):
+    with pytest.raises(ValueError):
+        decode_s2s_travel_time(text)
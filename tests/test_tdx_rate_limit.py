@@ -0,0 +1,121 @@
+import asyncio
+
+import pytest
+
+import tdx_rate_limit
+from tdx_rate_limit import PRIORITY_BACKGROUND, PRIORITY_REALTIME, PRIORITY_STATIC, TokenBucketScheduler
+
+
+class FakeClock():
+    # Stands in for the time module inside tdx_rate_limit; sleeping just moves the clock forward.
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(tdx_rate_limit, 'time', fake)
+    return fake
+
+
+def test_bucket_starts_full_then_paces_at_rate(clock):
+    scheduler = TokenBucketScheduler(rate=4, burst=3)
+    assert [scheduler._take(PRIORITY_REALTIME) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert scheduler._take(PRIORITY_REALTIME) == pytest.approx(0.25)
+
+
+def test_tokens_refill_over_time_up_to_burst(clock):
+    scheduler = TokenBucketScheduler(rate=4, burst=3)
+    for _ in range(3):
+        scheduler._take(PRIORITY_REALTIME)
+    clock.now += 0.5
+    assert [scheduler._take(PRIORITY_REALTIME) for _ in range(2)] == [0.0, 0.0]
+    assert scheduler._take(PRIORITY_REALTIME) > 0
+
+    # A long idle period refills only up to burst.
+    clock.now += 60
+    assert [scheduler._take(PRIORITY_REALTIME) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert scheduler._take(PRIORITY_REALTIME) > 0
+
+
+def test_background_leaves_headroom_for_user_requests(clock):
+    scheduler = TokenBucketScheduler(rate=2, burst=4, background_headroom=2)
+    assert scheduler._take(PRIORITY_BACKGROUND) == 0.0
+    assert scheduler._take(PRIORITY_BACKGROUND) == 0.0
+    # Two tokens left: background needs three, so it waits for one more to refill.
+    assert scheduler._take(PRIORITY_BACKGROUND) == pytest.approx(0.5)
+    assert scheduler._take(PRIORITY_STATIC) == 0.0
+    assert scheduler._take(PRIORITY_REALTIME) == 0.0
+
+
+def test_headroom_is_capped_at_burst(clock):
+    scheduler = TokenBucketScheduler(rate=1, burst=2, background_headroom=10)
+    assert scheduler._take(PRIORITY_BACKGROUND) == 0.0
+
+
+def test_waiting_higher_priority_goes_first(clock):
+    scheduler = TokenBucketScheduler(rate=5, burst=10, background_headroom=0)
+    scheduler._set_waiting(PRIORITY_REALTIME, 1)
+    # Tokens are available, but lower priorities yield while a realtime request is queued.
+    assert scheduler._take(PRIORITY_STATIC) == pytest.approx(0.2)
+    assert scheduler._take(PRIORITY_BACKGROUND) == pytest.approx(0.2)
+    assert scheduler._take(PRIORITY_REALTIME) == 0.0
+
+    scheduler._set_waiting(PRIORITY_REALTIME, -1)
+    scheduler._set_waiting(PRIORITY_STATIC, 1)
+    assert scheduler._take(PRIORITY_BACKGROUND) == pytest.approx(0.2)
+    assert scheduler._take(PRIORITY_STATIC) == 0.0
+    # Lower priorities waiting never hold back a higher one.
+    scheduler._set_waiting(PRIORITY_BACKGROUND, 1)
+    assert scheduler._take(PRIORITY_REALTIME) == 0.0
+
+
+def test_acquire_sleeps_until_a_token_refills(clock):
+    scheduler = TokenBucketScheduler(rate=4, burst=1)
+    assert scheduler.acquire(PRIORITY_REALTIME, max_wait=1) is True
+    assert scheduler.acquire(PRIORITY_REALTIME, max_wait=1) is True
+    assert sum(clock.slept) == pytest.approx(0.25)
+    assert scheduler._waiting[PRIORITY_REALTIME] == 0
+
+
+def test_acquire_gives_up_after_max_wait(clock):
+    scheduler = TokenBucketScheduler(rate=1, burst=1)
+    scheduler._take(PRIORITY_STATIC)
+    assert scheduler.acquire(PRIORITY_STATIC, max_wait=0.5) is False
+    assert sum(clock.slept) == pytest.approx(0.5)
+    assert scheduler._waiting[PRIORITY_STATIC] == 0
+    # Giving up took no token: the one that refills next is still there.
+    clock.now += 0.5
+    assert scheduler._take(PRIORITY_STATIC) == 0.0
+
+
+def test_static_gives_up_while_realtime_is_queued(clock):
+    scheduler = TokenBucketScheduler(rate=5, burst=10)
+    scheduler._set_waiting(PRIORITY_REALTIME, 1)
+    assert scheduler.acquire(PRIORITY_STATIC, max_wait=1) is False
+    scheduler._set_waiting(PRIORITY_REALTIME, -1)
+    assert scheduler.acquire(PRIORITY_STATIC, max_wait=1) is True
+
+
+def test_acquire_async_waits_for_refill(clock, monkeypatch):
+    async def fake_sleep(seconds):
+        clock.sleep(seconds)
+
+    monkeypatch.setattr(tdx_rate_limit.asyncio, 'sleep', fake_sleep)
+    scheduler = TokenBucketScheduler(rate=2, burst=1)
+
+    async def acquire_twice():
+        return [await scheduler.acquire_async(PRIORITY_REALTIME, max_wait=1) for _ in range(2)]
+
+    assert asyncio.run(acquire_twice()) == [True, True]
+    assert sum(clock.slept) == pytest.approx(0.5)
+    assert scheduler._waiting[PRIORITY_REALTIME] == 0